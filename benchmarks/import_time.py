@@ -0,0 +1,77 @@
+"""
+Import-time benchmark for superpipe.
+
+Each scenario is timed in a fresh interpreter. A scenario fails if it imports any
+of the heavy dependencies it's not supposed to need, or if its median import time
+exceeds --max-seconds. Exits with a non-zero status on failure so it can be used as
+a regression guard in CI.
+
+Usage:
+    python benchmarks/import_time.py [--repeat 5] [--max-seconds 0.5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ["faiss", "numpy", "pandas", "openai",
+                 "anthropic", "requests", "httpx", "prettytable"]
+
+# (name, import statement, heavy modules the statement is allowed to load)
+SCENARIOS = [
+    ("import superpipe", "import superpipe", []),
+    ("import superpipe.steps", "import superpipe.steps", []),
+    ("LLMStep", "from superpipe.steps import LLMStep", []),
+    ("LLMStructuredStep", "from superpipe.steps import LLMStructuredStep", []),
+    ("Pipeline", "from superpipe.pipeline import Pipeline", []),
+    ("EmbeddingSearchStep",
+     "from superpipe.steps import EmbeddingSearchStep", []),
+    ("GridSearch", "from superpipe.grid_search import GridSearch",
+     ["pandas", "numpy"]),
+]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{"elapsed": elapsed, "heavy": heavy}}))
+"""
+
+
+def _probe(statement):
+    code = _PROBE.format(statement=statement, heavy=HEAVY_MODULES)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(
+        filter(None, [root, os.environ.get("PYTHONPATH")]))}
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True,
+                         text=True, check=True, env=env)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=0.5)
+    args = parser.parse_args()
+
+    failed = False
+    for name, statement, allowed in SCENARIOS:
+        runs = [_probe(statement) for _ in range(args.repeat)]
+        median = statistics.median(r["elapsed"] for r in runs)
+        unexpected = sorted(set(runs[0]["heavy"]) - set(allowed))
+        status = "ok"
+        if unexpected:
+            status = f"FAIL (loaded {', '.join(unexpected)})"
+        elif not allowed and median > args.max_seconds:
+            status = f"FAIL (> {args.max_seconds}s)"
+        failed = failed or status != "ok"
+        print(f"{name:<22} {median * 1000:8.1f} ms  {status}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
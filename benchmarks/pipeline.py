@@ -0,0 +1,194 @@
+"""
+Execution benchmarks for superpipe pipelines and steps.
+
+Each scenario runs in a fresh interpreter at each row count, against a local mock LLM
+provider (see superpipe.mock_server), and reports throughput and peak memory. Results can
+be written to a JSON file and compared against a previous run; a scenario fails if its
+throughput drops by more than --max-regression. Exits with a non-zero status on failure
+so it can be used as a regression guard in CI.
+
+Scenarios:
+    pipeline_row_wise     Pipeline.run row-wise, an LLM step and a custom step
+    pipeline_step_wise    Pipeline.run step-wise, same pipeline
+    step_run              Step.run on a DataFrame (per-row results assembled into columns)
+    aggregate_statistics  Pipeline._aggregate_statistics over precomputed step metadata
+    grid_search           GridSearch over 4 configurations of a custom step pipeline
+    embedding_search      EmbeddingSearchStep over 1000 candidates
+
+Usage:
+    python benchmarks/pipeline.py [--rows 1000 100000 1000000] [--scenarios step_run ...]
+        [--output results.json] [--baseline results.json] [--max-regression 0.2]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+SCENARIOS = ["pipeline_row_wise", "pipeline_step_wise", "step_run",
+             "aggregate_statistics", "grid_search", "embedding_search"]
+# scenarios that call the mock provider over HTTP, much slower per row than the rest
+LLM_SCENARIOS = ["pipeline_row_wise", "pipeline_step_wise"]
+MOCK_MODEL = "mock-model"
+EMBEDDING_DIM = 64
+NUM_CANDIDATES = 1000
+
+
+def _make_df(rows):
+    import pandas as pd
+    return pd.DataFrame({"id": range(rows), "text": [f"item {i}" for i in range(rows)]})
+
+
+def _embed(texts):
+    import numpy as np
+    vectors = [np.random.default_rng(abs(hash(t)) % (2**32)).random(EMBEDDING_DIM, dtype=np.float32)
+               for t in texts]
+    return np.stack(vectors)
+
+
+def _llm_pipeline():
+    from superpipe.mock_server import MockLLMServer
+    from superpipe.pipeline import Pipeline
+    from superpipe.steps import LLMStep, CustomStep
+    server = MockLLMServer(output_tokens=20).start()
+    server.register([MOCK_MODEL], pricing=(1, 2))
+    llm = LLMStep(MOCK_MODEL, lambda row: f"Describe {row['text']}", name="describe")
+    length = CustomStep(lambda row: len(row["describe"] or ""), name="length")
+    return Pipeline([llm, length])
+
+
+def _run_scenario(scenario, rows):
+    """
+    Runs a scenario once. Returns the timed seconds and the number of rows processed.
+    """
+    from superpipe.pipeline import Pipeline
+    from superpipe.steps import CustomStep, EmbeddingSearchStep
+    df = _make_df(rows)
+
+    if scenario in LLM_SCENARIOS:
+        pipeline = _llm_pipeline()
+        start = time.perf_counter()
+        pipeline.run(df, row_wise=scenario == "pipeline_row_wise", verbose=False)
+        return time.perf_counter() - start, rows
+
+    if scenario == "step_run":
+        step = CustomStep(lambda row: row["id"] * 2, name="double")
+        start = time.perf_counter()
+        step.run(df, verbose=False)
+        return time.perf_counter() - start, rows
+
+    if scenario == "aggregate_statistics":
+        from superpipe.steps import LLMStep
+        steps = [LLMStep(MOCK_MODEL, lambda row: "", name=f"llm{i}") for i in range(3)]
+        metadata = {"success": True, "input_tokens": 10, "output_tokens": 20,
+                    "input_cost": 1e-5, "output_cost": 4e-5, "latency": 0.1}
+        for step in steps:
+            df[f"__{step.name}__"] = [metadata] * rows
+            step.statistics.num_success = rows
+        pipeline = Pipeline(steps)
+        start = time.perf_counter()
+        pipeline._aggregate_statistics(df)
+        return time.perf_counter() - start, rows
+
+    if scenario == "grid_search":
+        from superpipe.grid_search import GridSearch
+
+        def scaler(factor):
+            def scale(row):
+                return row["id"] * factor
+            scale.__name__ = f"scale_{factor}"
+            return scale
+        step = CustomStep(scaler(1), name="scale")
+        pipeline = Pipeline([step])
+        # sweep a parameter the step uses, renaming it would leave later configurations matching no step
+        grid = GridSearch(pipeline, {step.name: {
+            "transform": [scaler(factor) for factor in (2, 3, 4, 5)]}})
+        start = time.perf_counter()
+        grid.run(df, styled=False)
+        return time.perf_counter() - start, rows * len(grid.params_list)
+
+    if scenario == "embedding_search":
+        step = EmbeddingSearchStep(
+            search_prompt=lambda row: row["text"],
+            embed_fn=_embed,
+            candidates=[f"candidate {i}" for i in range(NUM_CANDIDATES)],
+            name="search")
+        start = time.perf_counter()
+        step.run(df, verbose=False)
+        return time.perf_counter() - start, rows
+
+    raise ValueError(f"Unknown scenario {scenario}")
+
+
+def _child(scenario, rows):
+    import resource
+    elapsed, processed = _run_scenario(scenario, rows)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak_kb /= 1024
+    print(json.dumps({
+        "scenario": scenario,
+        "rows": rows,
+        "seconds": elapsed,
+        "rows_per_second": processed / elapsed if elapsed > 0 else float("inf"),
+        "peak_memory_mb": peak_kb / 1024,
+    }))
+
+
+def _probe(scenario, rows):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "SUPERPIPE_ENV": "production", "PYTHONPATH": os.pathsep.join(
+        filter(None, [root, os.environ.get("PYTHONPATH")]))}
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", scenario, str(rows)],
+                         capture_output=True, text=True, check=True, env=env)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare throughput against results from a previous run.")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="Maximum allowed drop in throughput relative to the baseline.")
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child(args.child[0], int(args.child[1]))
+        return
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {(r["scenario"], r["rows"]): r for r in json.load(f)}
+
+    results = []
+    failed = False
+    print(f"{'scenario':<22} {'rows':>9} {'rows/s':>12} {'peak MB':>9}  status")
+    for scenario in args.scenarios:
+        for rows in args.rows:
+            result = _probe(scenario, rows)
+            results.append(result)
+            status = "ok"
+            previous = baseline.get((scenario, rows))
+            if previous is not None:
+                change = result["rows_per_second"] / \
+                    previous["rows_per_second"] - 1
+                status = f"{change:+.0%}"
+                if change < -args.max_regression:
+                    status = f"FAIL ({status} throughput)"
+                    failed = True
+            print(f"{scenario:<22} {rows:>9} {result['rows_per_second']:>12.1f} "
+                  f"{result['peak_memory_mb']:>9.1f}  {status}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,25 @@
-from . import grid_search
-from . import pipeline
-from . import steps
-from . import models
-from . import pydantic
-from . import clients
-from . import llm
+import importlib
+
+# Submodules are imported on first attribute access so that `import superpipe`
+# stays cheap and heavy dependencies are only loaded when they're used.
+__all__ = [
+    "grid_search",
+    "pipeline",
+    "steps",
+    "models",
+    "pydantic",
+    "clients",
+    "llm",
+]
+
+
+def __getattr__(name):
+    if name in __all__:
+        module = importlib.import_module(f".{name}", __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(__all__))
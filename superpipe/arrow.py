@@ -0,0 +1,173 @@
+from __future__ import annotations
+import json
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, Optional, Union, get_args
+from superpipe.util import is_dataframe
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
+
+# pyarrow is imported lazily, so it's only required when Arrow data or Parquet output is used
+
+
+def record_batches(data: Union[pa.Table, pa.RecordBatchReader]) -> Iterator[pa.RecordBatch]:
+    """
+    Yields the record batches of a Table or a RecordBatchReader. A reader is consumed as it's iterated,
+    so only one batch needs to be in memory at a time.
+    """
+    import pyarrow as pa
+    if isinstance(data, pa.Table):
+        yield from data.to_batches()
+    else:
+        yield from data
+
+
+def to_pandas(data: Union[pa.Table, pa.RecordBatch]) -> pd.DataFrame:
+    """
+    Converts a Table or a record batch to a DataFrame with Arrow-backed dtypes, so strings, nested values
+    and nullable integers keep their Arrow types and the conversion doesn't copy them to Python objects.
+    """
+    import pandas as pd
+    return data.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def metadata_type() -> pa.DataType:
+    """
+    Returns the Arrow type of the `__step__` metadata columns: the per-row statistics, error, prompt,
+    skip reason and fallback flag of a step. Giving every metadata column the same type keeps the schema
+    of a run's batches the same, whichever fields the rows of each batch happened to set.
+    """
+    import pyarrow as pa
+    from superpipe.steps.step import StepRowStatistics
+    arrow_types = {int: pa.int64(), float: pa.float64(),
+                   bool: pa.bool_(), str: pa.string()}
+    fields = []
+    for name, info in StepRowStatistics.model_fields.items():
+        # Optional[X] -> X, the dicts by model have no scalar type and are left out
+        annotation = next((arg for arg in get_args(info.annotation) if arg is not type(None)),
+                          info.annotation)
+        if annotation in arrow_types:
+            fields.append(pa.field(name, arrow_types[annotation]))
+    fields += [pa.field("error", pa.string()), pa.field("prompt", pa.string()),
+               pa.field("skipped", pa.string()), pa.field("fallback", pa.bool_())]
+    return pa.struct(fields)
+
+
+def _to_json(value: Any) -> str:
+    return value if isinstance(value, str) else json.dumps(value, default=str)
+
+
+def to_arrow(df: pd.DataFrame,
+             metadata_columns: Iterable[str] = (),
+             types: Optional[Dict[str, pa.DataType]] = None) -> pa.Table:
+    """
+    Converts a DataFrame to a Table, without its index. Arrow-backed columns are passed through as is.
+
+    Args:
+        df (pd.DataFrame): The DataFrame to convert.
+        metadata_columns (Iterable[str]): The `__step__` metadata columns, stored as structs of
+            `metadata_type()`.
+        types (Dict[str, pa.DataType], optional): Arrow types of other columns, inferred if not given.
+            Columns of Python objects Arrow can't type, e.g. a step output that's a number on some rows
+            and "" on others, are stored as JSON strings.
+
+    Returns:
+        pa.Table: The table.
+    """
+    import pyarrow as pa
+    types = {**{name: metadata_type() for name in metadata_columns}, **(types or {})}
+    arrays, names = [], []
+    for name in df.columns:
+        column = df[name]
+        try:
+            array = pa.array(column, type=types.get(name), from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            array = pa.array(column.map(_to_json, na_action="ignore"),
+                             type=pa.string(), from_pandas=True)
+        arrays.append(array)
+        names.append(str(name))
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+class ParquetSink:
+    """
+    Writes tables to a Parquet file as they're produced, each as one or more row groups, so a large output
+    is never serialized all at once. The file's schema is the first table's, with columns that were all
+    null in it typed as strings, plus the `columns` the first write declares that it doesn't have, e.g.
+    the outputs of a step that failed on every row of the first batch. Later tables are cast to it, and
+    missing columns are written as nulls. A column that isn't in the schema raises instead of being dropped.
+
+    Attributes:
+        path (str): The Parquet file.
+        row_group_size (int, optional): Maximum rows per row group. Each table is at least one row group.
+        types (Dict[str, pa.DataType], optional): Arrow types of columns of the DataFrames written.
+        schema (pa.Schema, optional): The file's schema, once the first table was written.
+        num_rows (int): Rows written so far.
+    """
+
+    def __init__(self, path: str, row_group_size: Optional[int] = None,
+                 types: Optional[Dict[str, pa.DataType]] = None):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.types = types
+        self.schema: Optional[pa.Schema] = None
+        self.num_rows = 0
+        self._writer = None
+
+    def write(self,
+              data: Union[pd.DataFrame, pa.Table],
+              metadata_columns: Iterable[str] = (),
+              columns: Optional[Dict[str, pa.DataType]] = None):
+        """
+        Appends a DataFrame or a Table to the file.
+
+        Args:
+            data (Union[pd.DataFrame, pa.Table]): The rows to write.
+            metadata_columns (Iterable[str]): The `__step__` metadata columns of a DataFrame.
+            columns (Dict[str, pa.DataType], optional): Every column later writes may have, with its type,
+                overridden by `types`. Only used by the first write, to build the file's schema.
+
+        Raises:
+            ValueError: If a column isn't in the file's schema or can't be cast to its type there.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = to_arrow(data, metadata_columns, self.types) if is_dataframe(data) else data
+        if self._writer is None:
+            fields = [field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                      for field in table.schema]
+            fields += [pa.field(name, (self.types or {}).get(name, type))
+                       for name, type in (columns or {}).items() if name not in table.column_names]
+            self.schema = pa.schema(fields)
+            self._writer = pq.ParquetWriter(self.path, self.schema)
+        extra = [name for name in table.column_names if name not in self.schema.names]
+        if extra:
+            raise ValueError(
+                f"Columns {', '.join(extra)} aren't in {self.path}'s schema, which was built from the first write")
+        columns = []
+        for field in self.schema:
+            if field.name not in table.column_names:
+                columns.append(pa.nulls(table.num_rows, field.type))
+                continue
+            column = table[field.name]
+            if column.type != field.type:
+                try:
+                    column = column.cast(field.type)
+                except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+                    raise ValueError(
+                        f"Column {field.name} is {column.type}, which can't be written as {field.type}") from e
+            columns.append(column)
+        self._writer.write_table(pa.Table.from_arrays(columns, schema=self.schema),
+                                 row_group_size=self.row_group_size)
+        self.num_rows += table.num_rows
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,234 @@
+import time
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+from superpipe.models import get_cost
+from superpipe.tokenizer import count_tokens
+
+# budgets that apply to LLM calls made in the current context (pipeline, grid search and step budgets)
+_active_budgets: ContextVar[tuple] = ContextVar("active_budgets", default=())
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised before an LLM call that would exceed a budget. The call is not made.
+    """
+    pass
+
+
+class Budget:
+    """
+    Hard limits on the dollars and tokens spent by LLM calls, overall and per model.
+
+    Before each call the cost is estimated from a local token count of the prompt and the average
+    number of output tokens seen so far for the model, and the call is refused with BudgetExceeded if
+    it could exceed a limit. After the call the estimate is replaced with the actual usage.
+
+    Budgets can be set on a Pipeline run, a GridSearch run, or an individual step (`step.budget`).
+    Once a budget refuses a call it's marked exhausted and pipeline and grid search runs stop cleanly,
+    keeping the results and statistics of the rows that were processed.
+
+    Attributes:
+        max_cost (float, optional): Maximum total cost in dollars.
+        max_tokens (int, optional): Maximum total input + output tokens.
+        max_cost_per_model (Dict[str, float], optional): Maximum cost in dollars per model.
+        max_tokens_per_model (Dict[str, int], optional): Maximum input + output tokens per model.
+        max_cost_per_minute (float, optional): Throttles calls so that no more than this many dollars
+            are spent in any 60 second window.
+        default_output_tokens (int): Output tokens assumed for a model before any of its calls completed.
+    """
+
+    def __init__(self,
+                 max_cost: Optional[float] = None,
+                 max_tokens: Optional[int] = None,
+                 max_cost_per_model: Optional[Dict[str, float]] = None,
+                 max_tokens_per_model: Optional[Dict[str, int]] = None,
+                 max_cost_per_minute: Optional[float] = None,
+                 default_output_tokens: int = 256):
+        self.max_cost = max_cost
+        self.max_tokens = max_tokens
+        self.max_cost_per_model = max_cost_per_model or {}
+        self.max_tokens_per_model = max_tokens_per_model or {}
+        self.max_cost_per_minute = max_cost_per_minute
+        self.default_output_tokens = default_output_tokens
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.exhausted = False
+            self.cost = 0.0
+            self.tokens = 0
+            self.cost_per_model = defaultdict(float)
+            self.tokens_per_model = defaultdict(int)
+            self.num_calls_per_model = defaultdict(int)
+            self.output_tokens_per_model = defaultdict(int)
+            self._reserved_cost = 0.0
+            self._reserved_tokens = 0
+            self._reserved_cost_per_model = defaultdict(float)
+            self._reserved_tokens_per_model = defaultdict(int)
+            self._recent_costs = deque()
+
+    def estimate_output_tokens(self, model: str, max_tokens: Optional[int] = None) -> int:
+        num_calls = self.num_calls_per_model[model]
+        estimate = self.output_tokens_per_model[model] / num_calls if num_calls \
+            else self.default_output_tokens
+        if max_tokens is not None:
+            estimate = min(estimate, max_tokens)
+        return int(estimate)
+
+    def _check(self, model, cost, tokens):
+        def over(limit, spent, reserved, amount):
+            return limit is not None and spent + reserved + amount > limit
+        if over(self.max_cost, self.cost, self._reserved_cost, cost):
+            return f"max_cost of ${self.max_cost}"
+        if over(self.max_tokens, self.tokens, self._reserved_tokens, tokens):
+            return f"max_tokens of {self.max_tokens}"
+        if over(self.max_cost_per_model.get(model), self.cost_per_model[model],
+                self._reserved_cost_per_model[model], cost):
+            return f"max_cost of ${self.max_cost_per_model[model]} for {model}"
+        if over(self.max_tokens_per_model.get(model), self.tokens_per_model[model],
+                self._reserved_tokens_per_model[model], tokens):
+            return f"max_tokens of {self.max_tokens_per_model[model]} for {model}"
+        return None
+
+    def _throttle(self, cost):
+        if self.max_cost_per_minute is None:
+            return
+        while True:
+            with self._lock:
+                now = time.time()
+                while self._recent_costs and self._recent_costs[0][0] < now - 60:
+                    self._recent_costs.popleft()
+                recent = sum(c for _, c in self._recent_costs)
+                if not self._recent_costs or recent + cost <= self.max_cost_per_minute:
+                    return
+                wait = self._recent_costs[0][0] + 60 - now
+            time.sleep(max(wait, 0.01))
+
+    def reserve(self, model: str, input_tokens: int, output_tokens: int):
+        """
+        Reserves the estimated cost of a call, or raises BudgetExceeded if it could exceed a limit.
+
+        Returns:
+            Tuple[float, int]: The reserved cost and tokens, to be passed to `settle`.
+        """
+        input_cost, output_cost = get_cost(input_tokens, output_tokens, model)
+        cost = input_cost + output_cost
+        tokens = input_tokens + output_tokens
+        self._throttle(cost)
+        with self._lock:
+            exceeded = self._check(model, cost, tokens)
+            if exceeded is not None:
+                self.exhausted = True
+                raise BudgetExceeded(
+                    f"Budget exceeded: call to {model} could exceed {exceeded}")
+            self._reserved_cost += cost
+            self._reserved_tokens += tokens
+            self._reserved_cost_per_model[model] += cost
+            self._reserved_tokens_per_model[model] += tokens
+        return cost, tokens
+
+    def settle(self, model: str, reserved, input_tokens: int, output_tokens: int, completed: bool = True,
+               cached_tokens: int = 0, cache_write_tokens: int = 0):
+        """
+        Replaces a reservation with the actual usage of the call. Cached prompt tokens are priced with
+        the model's cache pricing.
+        """
+        reserved_cost, reserved_tokens = reserved
+        input_cost, output_cost = get_cost(
+            input_tokens, output_tokens, model, cached_tokens, cache_write_tokens)
+        cost = input_cost + output_cost
+        tokens = input_tokens + output_tokens
+        with self._lock:
+            self._reserved_cost -= reserved_cost
+            self._reserved_tokens -= reserved_tokens
+            self._reserved_cost_per_model[model] -= reserved_cost
+            self._reserved_tokens_per_model[model] -= reserved_tokens
+            self.cost += cost
+            self.tokens += tokens
+            self.cost_per_model[model] += cost
+            self.tokens_per_model[model] += tokens
+            if completed:
+                self.num_calls_per_model[model] += 1
+                self.output_tokens_per_model[model] += output_tokens
+            if self.max_cost_per_minute is not None:
+                self._recent_costs.append((time.time(), cost))
+
+    @contextmanager
+    def track(self):
+        """
+        Applies the budget to every LLM call made in the current context for the duration of the block.
+        """
+        token = _active_budgets.set(_active_budgets.get() + (self,))
+        try:
+            yield self
+        finally:
+            _active_budgets.reset(token)
+
+
+def any_budget_exhausted() -> bool:
+    """
+    Returns True if any budget active in the current context is exhausted.
+    """
+    return any(budget.exhausted for budget in _active_budgets.get())
+
+
+class Spend:
+    """
+    The usage of a single LLM call, recorded by the caller once the provider responds.
+    """
+
+    def __init__(self):
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cached_tokens = 0
+        self.cache_write_tokens = 0
+        self.completed = False
+
+    def record(self, input_tokens: int, output_tokens: int, cached_tokens: int = 0, cache_write_tokens: int = 0):
+        """
+        Records the usage of the call. `input_tokens` includes the prompt tokens read from and written to
+        the provider's prompt cache.
+        """
+        self.input_tokens = input_tokens or 0
+        self.output_tokens = output_tokens or 0
+        self.cached_tokens = cached_tokens or 0
+        self.cache_write_tokens = cache_write_tokens or 0
+        self.completed = True
+
+
+@contextmanager
+def spend(model: str, prompt: str, args: Optional[Dict] = None):
+    """
+    Checks an LLM call against every active budget before it's made, and reconciles the budgets with the
+    actual usage recorded on the yielded Spend afterwards.
+
+    Args:
+        model (str): The model being called.
+        prompt (str): The full prompt text (including any system prompt), used to estimate input tokens.
+        args (Dict, optional): The provider args, used to cap the output token estimate with max_tokens.
+
+    Raises:
+        BudgetExceeded: If the call could exceed any active budget.
+    """
+    budgets = _active_budgets.get()
+    usage = Spend()
+    if not budgets:
+        yield usage
+        return
+    input_tokens = count_tokens(prompt, model)
+    max_tokens = (args or {}).get("max_tokens")
+    reservations = []
+    try:
+        for budget in budgets:
+            output_tokens = budget.estimate_output_tokens(model, max_tokens)
+            reservations.append(
+                (budget, budget.reserve(model, input_tokens, output_tokens)))
+        yield usage
+    finally:
+        for budget, reserved in reservations:
+            budget.settle(model, reserved, usage.input_tokens, usage.output_tokens, usage.completed,
+                          usage.cached_tokens, usage.cache_write_tokens)
@@ -0,0 +1,81 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Any, Optional, Tuple
+from superpipe import config
+
+
+class DiskCache:
+    """
+    A simple on-disk JSON cache with a time-to-live.
+
+    Each entry is stored in its own file under `<cache_dir>/<namespace>/`, named by a hash of its key,
+    so concurrent processes can share a cache directory without locking. Writes are atomic.
+
+    Attributes:
+        namespace (str): Subdirectory of the cache directory this cache writes to.
+        ttl (float, optional): Number of seconds an entry stays fresh. None means entries never expire.
+        cache_dir (str): Root cache directory. Defaults to `config.cache_dir` ($SUPERPIPE_CACHE_DIR).
+    """
+
+    def __init__(self, namespace: str, ttl: Optional[float] = None, cache_dir: str = None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.cache_dir = cache_dir or config.cache_dir
+
+    @property
+    def path(self):
+        return os.path.join(self.cache_dir, self.namespace)
+
+    def _entry_path(self, key: str):
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, f"{digest}.json")
+
+    def get_entry(self, key: str) -> Optional[Tuple[Any, float]]:
+        """
+        Returns the cached value and the time it was written, whether or not it has expired.
+
+        Returns:
+            Optional[Tuple[Any, float]]: (value, written_at) or None if the key isn't cached.
+        """
+        try:
+            with open(self._entry_path(key), "r") as f:
+                entry = json.load(f)
+            return entry["value"], entry["written_at"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def is_fresh(self, written_at: float) -> bool:
+        return self.ttl is None or time.time() - written_at < self.ttl
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Returns the cached value for key, or None if it's missing or expired.
+        """
+        entry = self.get_entry(key)
+        if entry is None or not self.is_fresh(entry[1]):
+            return None
+        return entry[0]
+
+    def set(self, key: str, value: Any):
+        """
+        Writes value (which must be JSON serializable) to the cache.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        path = self._entry_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"key": key, "written_at": time.time(), "value": value}, f)
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        """
+        Removes all entries in this cache's namespace.
+        """
+        if not os.path.isdir(self.path):
+            return
+        for filename in os.listdir(self.path):
+            if filename.endswith(".json"):
+                os.remove(os.path.join(self.path, filename))
@@ -0,0 +1,166 @@
+import os
+import json
+import atexit
+import hashlib
+import threading
+import httpx
+
+
+# the cassettes of the open files, by absolute path, so transports on the same file share their recordings
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+class Cassette:
+    """
+    The responses recorded to a cassette file. Shared by every CassetteTransport on the file, so
+    providers recording to the same path don't overwrite each other's recordings.
+
+    Attributes:
+        path (str): The cassette file, a JSON object of request key to a list of recorded responses.
+        recordings (dict): The recorded responses, by request key.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.recordings = self._load()
+        # keys recorded since the cassette was loaded, which replace what the file has for them
+        self.recorded_this_session = set()
+        # whether responses were recorded since the cassette was last written
+        self._dirty = False
+        atexit.register(self.flush)
+
+    @classmethod
+    def open(cls, path: str) -> "Cassette":
+        """
+        Returns the cassette of a file, loading it on first use.
+        """
+        key = os.path.abspath(path)
+        with _cassettes_lock:
+            if key not in _cassettes:
+                _cassettes[key] = cls(path)
+            return _cassettes[key]
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def record(self, key: str, entry: dict):
+        with self.lock:
+            if key not in self.recorded_this_session:
+                # re-recording a request replaces what was recorded for it previously
+                self.recordings[key] = []
+                self.recorded_this_session.add(key)
+            self.recordings[key].append(entry)
+            self._dirty = True
+
+    def flush(self):
+        """
+        Writes the cassette file, if responses were recorded since it was last written. Responses another
+        process wrote to the file in the meantime are kept, unless this cassette re-recorded their requests.
+        """
+        with self.lock:
+            if not self._dirty:
+                return
+            recordings = self._load()
+            recordings.update({key: self.recordings[key] for key in self.recorded_this_session})
+            self.recordings = recordings
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(recordings, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+
+class CassetteTransport(httpx.BaseTransport):
+    """
+    An httpx transport that records provider responses to a cassette file and replays them.
+
+    Requests are matched on method, URL and JSON body (headers, including api keys, are ignored).
+    Identical requests recorded several times are replayed in the order they were recorded.
+    Recorded responses are kept in memory, in a `Cassette` shared by the transports on the same file, and
+    written to the cassette file by `flush()`, which runs when the transport is closed and when the process exits.
+
+    Modes:
+        "record": always send requests and record the responses, replacing what was previously
+            recorded for them. Error responses are recorded too, so retries replay faithfully.
+        "replay": never send requests; requests with no recorded response get a 404 error response.
+        "auto": replay recorded responses, send the rest and record the successful ones.
+
+    Attributes:
+        path (str): The cassette file, a JSON object of request key to a list of recorded responses.
+        mode (str): One of "record", "replay" or "auto".
+        transport (httpx.BaseTransport): The transport used to send requests that aren't replayed.
+    """
+
+    def __init__(self, path: str, mode: str = "auto", transport: httpx.BaseTransport = None):
+        if mode not in ("record", "replay", "auto"):
+            raise ValueError("mode must be one of 'record', 'replay' or 'auto'")
+        self.path = path
+        self.mode = mode
+        self.transport = transport or httpx.HTTPTransport()
+        self.cassette = Cassette.open(path)
+        self._replay_counts = {}
+
+    @staticmethod
+    def request_key(request: httpx.Request) -> str:
+        body = request.read()
+        try:
+            body = json.dumps(json.loads(body), sort_keys=True).encode("utf-8")
+        except ValueError:
+            pass
+        hash_object = hashlib.sha256()
+        hash_object.update(f"{request.method} {request.url.path}\n".encode("utf-8"))
+        hash_object.update(body)
+        return hash_object.hexdigest()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        key = self.request_key(request)
+        if self.mode != "record":
+            with self.cassette.lock:
+                recorded = self.cassette.recordings.get(key)
+                if recorded:
+                    i = self._replay_counts.get(key, 0)
+                    self._replay_counts[key] = i + 1
+                    entry = recorded[i % len(recorded)]
+                    return httpx.Response(
+                        entry["status_code"],
+                        headers=entry["headers"],
+                        content=entry["content"].encode("utf-8"),
+                        request=request)
+            if self.mode == "replay":
+                return httpx.Response(
+                    404,
+                    json={"error": {"message": f"No recorded response in {self.path} for {request.method} {request.url}",
+                                    "type": "cassette_miss"}},
+                    request=request)
+
+        response = self.transport.handle_request(request)
+        content = response.read()
+        response.close()
+        headers = {k: v for k, v in response.headers.items()
+                   if k.lower() not in ("content-encoding", "content-length", "transfer-encoding")}
+        entry = {
+            "status_code": response.status_code,
+            "headers": headers,
+            "content": content.decode("utf-8", errors="replace"),
+        }
+        if self.mode == "auto" and response.status_code >= 400:
+            return httpx.Response(entry["status_code"], headers=headers, content=content, request=request)
+        self.cassette.record(key, entry)
+        return httpx.Response(entry["status_code"], headers=headers, content=content, request=request)
+
+    def flush(self):
+        """
+        Writes the cassette file, if responses were recorded since it was last written.
+        """
+        self.cassette.flush()
+
+    def close(self):
+        self.flush()
+        self.transport.close()
@@ -1,63 +1,182 @@
-import requests
 import os
-from openai import OpenAI
-from anthropic import Anthropic
+import time
+import threading
 from superpipe.models import *
+from superpipe.cache import DiskCache
+from superpipe.transport import get_http_client, get_requests_session, get_transport_config
 
 # TODO: add support for non-openai providers
 
 client_for_model = {}
-openrouter_models = []
+openrouter_models = set()
+
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+# how long the cached OpenRouter model catalog is used before it's refreshed in the background
+OPENROUTER_CATALOG_TTL = float(
+    os.environ.get("SUPERPIPE_OPENROUTER_CATALOG_TTL", 24 * 60 * 60))
+openrouter_catalog_cache = DiskCache("openrouter", ttl=OPENROUTER_CATALOG_TTL)
+
+# env var holding each provider's api key, in the order providers are initialized
+_providers = {
+    "openrouter": "OPENROUTER_API_KEY",
+    "openai": "OPENAI_API_KEY",
+    "anthropic": "ANTHROPIC_API_KEY",
+}
+_initialized_providers = set()
+_init_lock = threading.Lock()
+# seconds before initializing a provider from the environment is tried again after it failed
+INIT_RETRY_INTERVAL = 60.0
+# time.monotonic() before which a provider that failed to initialize isn't tried again
+_retry_after = {}
 
 
 def init_openai(api_key, base_url=None):
-    openai_client = OpenAI(api_key=api_key, base_url=base_url)
+    from openai import OpenAI
+    openai_client = OpenAI(api_key=api_key, base_url=base_url,
+                           http_client=get_http_client("openai"),
+                           timeout=get_transport_config("openai").httpx_timeout())
     client_for_model[gpt35] = openai_client
     client_for_model[gpt4] = openai_client
     client_for_model[gpt4o] = openai_client
+    _initialized_providers.add("openai")
 
 
-def init_anthropic(api_key):
-    anthropic_client = Anthropic(api_key=api_key)
+def init_anthropic(api_key, base_url=None):
+    from anthropic import Anthropic
+    anthropic_client = Anthropic(api_key=api_key, base_url=base_url,
+                                 http_client=get_http_client("anthropic"),
+                                 timeout=get_transport_config("anthropic").httpx_timeout())
     client_for_model[claude3_haiku] = anthropic_client
     client_for_model[claude3_sonnet] = anthropic_client
     client_for_model[claude3_opus] = anthropic_client
+    _initialized_providers.add("anthropic")
+
+
+def _fetch_openrouter_catalog():
+    """
+    Fetches the OpenRouter model catalog and writes the model ids and pricing to the on-disk cache.
+
+    Returns:
+        List[Dict]: A list of {"id", "pricing"} dicts, with pricing in $ per 1M tokens.
+    """
+    session = get_requests_session("openrouter")
+    models_json = session.get(f"{OPENROUTER_BASE_URL}/models",
+                              timeout=get_transport_config("openrouter").requests_timeout()).json()
+    catalog = []
+    for model in models_json['data']:
+        prompt = float(model['pricing']['prompt'])
+        completion = float(model['pricing']['completion'])
+        pricing = (prompt*1e6, completion*1e6) if prompt > 0 else (0, 0)
+        catalog.append({"id": model['id'], "pricing": pricing})
+    openrouter_catalog_cache.set("models", catalog)
+    return catalog
+
+
+def _register_openrouter_catalog(catalog, openrouter_client):
+    for model in catalog:
+        client_for_model[model["id"]] = openrouter_client
+        set_pricing({model["id"]: tuple(model["pricing"])})
+    openrouter_models.update(model["id"] for model in catalog)
+
+
+def _refresh_openrouter_catalog(openrouter_client):
+    try:
+        catalog = _fetch_openrouter_catalog()
+    except Exception as e:
+        print(f"Warning: failed to refresh the OpenRouter model catalog: {e}")
+        return
+    _register_openrouter_catalog(catalog, openrouter_client)
 
 
-def init_openrouter(api_key):
-    base_url = "https://openrouter.ai/api/v1"
-    openrouter_client = OpenAI(api_key=api_key, base_url=base_url)
-    models_json = requests.get(f"{base_url}/models").json()
-    openrouter_models.extend([model['id'] for model in models_json['data']])
-    pricing_list = [(model['pricing']['prompt'], model['pricing']
-                     ['completion']) for model in models_json['data']]
-    pricing_list = [(float(p[0])*1e6, float(p[1])*1e6) if float(p[0]) > 0 else (0, 0)
-                    for p in pricing_list]
-    for i, model in enumerate(openrouter_models):
-        client_for_model[model] = openrouter_client
-        set_pricing({model: pricing_list[i]})
+def init_openrouter(api_key, refresh=False):
+    """
+    Registers the OpenRouter client for every model in the OpenRouter catalog.
+
+    The catalog and its pricing are read from the on-disk cache. The network is only hit synchronously
+    when there is no cached catalog (or refresh=True); a stale catalog is used as-is and refreshed
+    in a background thread. If there is no cached catalog and it can't be fetched, the provider is left
+    uninitialized, and clients initialized from the environment try again at most every
+    INIT_RETRY_INTERVAL seconds.
+
+    Args:
+        api_key (str): The OpenRouter API key.
+        refresh (bool): Whether to fetch the catalog even if a fresh copy is cached.
+    """
+    from openai import OpenAI
+    openrouter_client = OpenAI(api_key=api_key, base_url=OPENROUTER_BASE_URL,
+                               http_client=get_http_client("openrouter"),
+                               timeout=get_transport_config("openrouter").httpx_timeout())
+    entry = openrouter_catalog_cache.get_entry("models")
+    if entry is None or refresh:
+        try:
+            catalog = _fetch_openrouter_catalog()
+        except Exception as e:
+            if entry is None:
+                # without a catalog no model would get the client, so leave the provider uninitialized
+                print(
+                    f"Warning: failed to fetch the OpenRouter model catalog, OpenRouter models are unavailable until it can be fetched: {e}")
+                return
+            print(
+                f"Warning: failed to refresh the OpenRouter model catalog, using the cached one: {e}")
+            catalog = entry[0]
+        _register_openrouter_catalog(catalog, openrouter_client)
+    else:
+        catalog, written_at = entry
+        _register_openrouter_catalog(catalog, openrouter_client)
+        if not openrouter_catalog_cache.is_fresh(written_at):
+            threading.Thread(target=_refresh_openrouter_catalog,
+                             args=(openrouter_client,), daemon=True).start()
+    _initialized_providers.add("openrouter")
+
+
+_init_fns = {
+    "openrouter": init_openrouter,
+    "openai": init_openai,
+    "anthropic": init_anthropic,
+}
+
+
+def _init_from_env():
+    """
+    Initializes clients for every provider whose api key is set and that hasn't been initialized yet.
+    """
+    with _init_lock:
+        for provider, env_var in _providers.items():
+            if provider in _initialized_providers:
+                continue
+            api_key = os.getenv(env_var)
+            if api_key is not None and time.monotonic() >= _retry_after.get(provider, 0):
+                _init_fns[provider](api_key)
+                if provider not in _initialized_providers:
+                    # e.g. the OpenRouter catalog couldn't be fetched
+                    _retry_after[provider] = time.monotonic() + \
+                        INIT_RETRY_INTERVAL
 
 
 def get_client(model):
-    if client_for_model.get("openrouter/auto") is None:
-        api_key = os.getenv("OPENROUTER_API_KEY")
-        if api_key is not None:
-            init_openrouter(api_key)
-    if client_for_model.get(gpt35) is None or \
-            client_for_model.get(gpt4) is None:
-        api_key = os.getenv("OPENAI_API_KEY")
-        if api_key is not None:
-            init_openai(api_key)
-    if client_for_model.get(claude3_haiku) is None or \
-            client_for_model.get(claude3_sonnet) is None or \
-            client_for_model.get(claude3_opus) is None:
-        api_key = os.getenv("ANTHROPIC_API_KEY")
-        if api_key is not None:
-            init_anthropic(api_key)
-    return client_for_model.get(model)
-
-
-def set_client_for_model(model, api_key, base_url, pricing=None):
-    client_for_model[model] = OpenAI(api_key=api_key, base_url=base_url)
+    client = client_for_model.get(model)
+    if client is None and len(_initialized_providers) < len(_providers):
+        _init_from_env()
+        client = client_for_model.get(model)
+    return client
+
+
+def set_client_for_model(model, api_key, base_url, pricing=None, provider=None):
+    """
+    Registers an OpenAI-compatible client for a model.
+
+    Args:
+        model (str): The model name.
+        api_key (str): The api key for the provider.
+        base_url (str): The base url of the OpenAI-compatible API.
+        pricing (Tuple[float, float], optional): Input and output cost per 1M tokens.
+        provider (str, optional): Name of the transport config (see `superpipe.transport`) to use.
+            Models registered with the same provider share a connection pool. Defaults to the base url.
+    """
+    from openai import OpenAI
+    provider = provider or base_url
+    client_for_model[model] = OpenAI(api_key=api_key, base_url=base_url,
+                                     http_client=get_http_client(provider),
+                                     timeout=get_transport_config(provider).httpx_timeout())
     if pricing is not None:
         set_pricing({model: pricing})
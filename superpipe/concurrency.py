@@ -0,0 +1,217 @@
+from __future__ import annotations
+import time
+import threading
+from typing import TYPE_CHECKING, Dict, Optional
+from superpipe.timeouts import DeadlineExceeded
+
+if TYPE_CHECKING:
+    import httpx
+
+# adaptive limiters by provider, providers without one aren't limited
+limiters: Dict[str, AIMDLimiter] = {}
+
+
+class AIMDLimiter:
+    """
+    Adapts the number of requests in flight to a provider with additive increase, multiplicative
+    decrease (AIMD), the way TCP adapts its congestion window.
+
+    Each window of `limit` completed requests raises the limit by one, as long as requests succeed and
+    the window's average latency stays within `latency_tolerance` times the best average seen recently.
+    A rate limit (429), overload (5xx) or timeout, or a window that's too slow, multiplies the limit by
+    `backoff`, at most once per window. Requests beyond the limit wait for a slot.
+
+    Attributes:
+        limit (float): The current limit on requests in flight.
+        min_limit (int): The limit never goes below this.
+        max_limit (int): The limit never goes above this.
+        backoff (float): Factor the limit is multiplied by on overload.
+        latency_tolerance (float, optional): How much slower than the recent best a window may be before
+            backing off. None to only back off on errors.
+        in_flight (int): Requests currently in flight.
+        num_backoffs (int): Times the limit was decreased.
+    """
+
+    def __init__(self,
+                 initial_limit: int = 8,
+                 min_limit: int = 1,
+                 max_limit: int = 256,
+                 backoff: float = 0.5,
+                 latency_tolerance: Optional[float] = 2.0):
+        if not 0 < backoff < 1:
+            raise ValueError("backoff must be between 0 and 1")
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.num_backoffs = 0
+        self._cond = threading.Condition()
+        self._baseline = None
+        self._window_latency = 0.0
+        self._window_count = 0
+        self._window_successes = 0
+        self._window_failed = False
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency: float, overloaded: bool = False):
+        """
+        Releases a slot and adapts the limit to the outcome of the request.
+
+        Args:
+            latency (float): Seconds the request took.
+            overloaded (bool): Whether the provider was rate limiting, overloaded or timed out.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if overloaded:
+                if not self._window_failed:
+                    self._decrease()
+                    self._window_failed = True
+            else:
+                self._window_latency += latency
+                self._window_successes += 1
+            self._window_count += 1
+            if self._window_count >= int(self.limit):
+                self._end_window()
+            self._cond.notify_all()
+
+    def _decrease(self):
+        self.limit = max(float(self.min_limit), self.limit * self.backoff)
+        self.num_backoffs += 1
+
+    def _end_window(self):
+        if not self._window_failed and self._window_successes > 0:
+            average = self._window_latency / self._window_successes
+            # the baseline drifts up slowly, so a provider that got slower for good isn't penalized forever
+            self._baseline = average if self._baseline is None else min(
+                self._baseline * 1.05, average)
+            if self.latency_tolerance is not None and average > self.latency_tolerance * self._baseline:
+                self._decrease()
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1)
+        self._window_latency = 0.0
+        self._window_count = 0
+        self._window_successes = 0
+        self._window_failed = False
+
+
+class _Slot:
+    """
+    A request slot of a limiter. Call `overloaded()` if the provider's response shows it's overloaded.
+    """
+
+    def __init__(self, limiter: Optional[AIMDLimiter]):
+        self.limiter = limiter
+        self._overloaded = False
+
+    def overloaded(self):
+        self._overloaded = True
+
+    def __enter__(self):
+        if self.limiter is not None:
+            self.limiter.acquire()
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.limiter is not None:
+            if exc is not None and is_overload_error(exc):
+                self._overloaded = True
+            self.limiter.release(time.perf_counter() -
+                                 self._start, self._overloaded)
+        return False
+
+
+class AdaptiveTransport:
+    """
+    An httpx transport that sends each request, including SDK retries, through its provider's limiter.
+    The pooled clients of providers with adaptive concurrency use it. Implements httpx.BaseTransport's
+    interface without subclassing it, so httpx is only imported when a client is created.
+    """
+
+    def __init__(self, provider: str, transport: httpx.BaseTransport):
+        self.provider = provider
+        self.transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        limiter = limiters.get(self.provider)
+        if limiter is None:
+            return self.transport.handle_request(request)
+        with _Slot(limiter) as slot:
+            response = self.transport.handle_request(request)
+            if response.status_code == 429 or response.status_code >= 500:
+                slot.overloaded()
+            return response
+
+    def close(self):
+        self.transport.close()
+
+    def __enter__(self):
+        self.transport.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.transport.__exit__(*args)
+
+
+def is_overload_error(e: BaseException) -> bool:
+    """
+    Returns whether an exception shows the provider is overloaded: a rate limit, a server error or a timeout.
+    """
+    if isinstance(e, DeadlineExceeded):
+        # raised before the request was sent
+        return False
+    status = getattr(e, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(e, TimeoutError) or "Timeout" in type(e).__name__
+
+
+def is_unavailable_error(e: BaseException) -> bool:
+    """
+    Returns whether an exception shows the provider is unavailable: overloaded, or unreachable.
+    """
+    return is_overload_error(e) or isinstance(e, ConnectionError) or "Connect" in type(e).__name__
+
+
+def set_adaptive_concurrency(provider: str, **kwargs) -> AIMDLimiter:
+    """
+    Turns on adaptive concurrency for a provider's requests. It's off by default. Call it before the
+    provider's first LLM call: the SDK clients that already exist keep sending their requests unlimited.
+    Changing the settings of a provider that already has a limiter takes effect immediately.
+
+    Args:
+        provider (str): The provider name, e.g. "openai", "anthropic", "openrouter" or "serper", or the
+            provider a model was registered with in `set_client_for_model`.
+        **kwargs: Arguments of AIMDLimiter.
+
+    Returns:
+        AIMDLimiter: The provider's limiter.
+    """
+    from superpipe.transport import _http_clients
+    if provider not in limiters and provider in _http_clients:
+        print(f"Warning: {provider}'s HTTP client was created before adaptive concurrency was turned on, "
+              "so its requests aren't limited")
+    limiters[provider] = AIMDLimiter(**kwargs)
+    return limiters[provider]
+
+
+def adaptive_limit(provider: Optional[str]) -> _Slot:
+    """
+    Waits for a request slot of the provider's limiter, if it has one, for the duration of the block.
+    """
+    return _Slot(limiters.get(provider))
+
+
+def concurrency_limits() -> Dict[str, int]:
+    """
+    Returns the current limit on requests in flight for each provider with adaptive concurrency.
+    """
+    return {provider: int(limiter.limit) for provider, limiter in limiters.items()}
@@ -10,3 +10,8 @@ def studio_enabled():
         print("Env var SUPERPIPE_STUDIO_URL or SUPERPIPE_STUDIO_API_KEY must be set for Superpipe Studio logging")
         return False
     return True
+
+
+cache_dir = os.environ.get(
+    "SUPERPIPE_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "superpipe"))
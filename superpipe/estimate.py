@@ -0,0 +1,183 @@
+import threading
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+from superpipe.models import get_cost
+from superpipe.tokenizer import count_tokens, CHARS_PER_TOKEN
+
+# output tokens assumed for a model that hasn't been called yet
+DEFAULT_OUTPUT_TOKENS = 256
+# rough latency model for a model that hasn't been called yet
+DEFAULT_SECONDS_PER_CALL = 0.5
+DEFAULT_SECONDS_PER_OUTPUT_TOKEN = 0.02
+
+# per model: number of successful calls, total output tokens and total latency, across all calls in this process
+_history = defaultdict(lambda: [0, 0, 0.0])
+_history_lock = threading.Lock()
+
+
+def record_call(model: str, output_tokens: int, latency: float):
+    """
+    Records a successful LLM call, used to project output tokens and latency in estimates.
+    """
+    with _history_lock:
+        history = _history[model]
+        history[0] += 1
+        history[1] += output_tokens
+        history[2] += latency
+
+
+def projected_output_tokens(model: str, max_tokens: Optional[int] = None) -> int:
+    num_calls, output_tokens, _ = _history.get(model, (0, 0, 0.0))
+    projected = output_tokens / num_calls if num_calls else DEFAULT_OUTPUT_TOKENS
+    if max_tokens is not None:
+        projected = min(projected, max_tokens)
+    return int(projected)
+
+
+def projected_latency(model: str, output_tokens: int) -> float:
+    num_calls, _, latency = _history.get(model, (0, 0, 0.0))
+    if num_calls:
+        return latency / num_calls
+    return DEFAULT_SECONDS_PER_CALL + DEFAULT_SECONDS_PER_OUTPUT_TOKEN * output_tokens
+
+
+def placeholder_text(num_tokens: int) -> str:
+    """
+    Returns filler text of roughly num_tokens tokens, used in place of outputs of steps that weren't run.
+    """
+    return "lorem " * max(int(num_tokens * CHARS_PER_TOKEN / 6), 1)
+
+
+@dataclass
+class PipelineEstimate:
+    """
+    Projected tokens, cost and latency of running a pipeline, computed without calling any provider.
+
+    Input tokens are counted locally from the rendered prompts. Output tokens and latency are projected
+    from the calls made so far in this process, or rough defaults for models that haven't been called.
+    """
+    num_rows: int = 0
+    num_sampled: int = 0
+    num_unrendered: int = 0
+    input_tokens: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    output_tokens: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    input_cost: float = 0.0
+    output_cost: float = 0.0
+    total_latency: float = 0.0
+
+    @property
+    def total_cost(self):
+        return self.input_cost + self.output_cost
+
+    def __str__(self):
+        from prettytable import PrettyTable
+        table = PrettyTable()
+        table.header = False
+        table.add_row(["num_rows", str(self.num_rows)], divider=True)
+        table.add_row(["num_sampled", str(self.num_sampled)], divider=True)
+        if self.num_unrendered:
+            table.add_row(["num_unrendered", str(
+                self.num_unrendered)], divider=True)
+        table.add_row(["input_tokens", str(
+            dict(self.input_tokens))], divider=True)
+        table.add_row(["output_tokens", str(
+            dict(self.output_tokens))], divider=True)
+        table.add_row(["input_cost", f"${self.input_cost}"], divider=True)
+        table.add_row(["output_cost", f"${self.output_cost}"], divider=True)
+        table.add_row(["total_latency", str(self.total_latency)])
+        return table.get_string()
+
+
+def estimate_pipeline(pipeline, data, sample: Optional[int] = None, random_state: int = 0) -> PipelineEstimate:
+    """
+    Estimates the tokens, cost and latency of running a pipeline on data, without calling any provider.
+
+    Every LLM prompt is rendered through the steps' prompt functions. Outputs of upstream steps that a
+    prompt depends on are filled with placeholder text of the projected length. Rows whose prompts can't
+    be rendered are counted in num_unrendered and extrapolated from the rows that could.
+
+    Args:
+        pipeline (Pipeline): The pipeline to estimate.
+        data (Union[pd.DataFrame, Dict]): The data the pipeline would run on.
+        sample (int, optional): Number of rows to render. The estimate is scaled up to all rows.
+        random_state (int): Seed used to pick the sampled rows.
+
+    Returns:
+        PipelineEstimate: The projected tokens, cost and latency.
+    """
+    from superpipe.util import is_dataframe
+    if is_dataframe(data):
+        num_rows = len(data)
+        sampled = data if sample is None or sample >= num_rows \
+            else data.sample(sample, random_state=random_state)
+        rows = [row.to_dict() for _, row in sampled.iterrows()]
+    else:
+        num_rows = 1
+        rows = [dict(data)]
+
+    estimate = PipelineEstimate(num_rows=num_rows, num_sampled=len(rows))
+    input_tokens = defaultdict(int)
+    output_tokens = defaultdict(int)
+    latency = 0.0
+    rendered = 0
+    for row in rows:
+        try:
+            row_input, row_output, row_latency = _estimate_row(pipeline, row)
+        except Exception:
+            estimate.num_unrendered += 1
+            continue
+        rendered += 1
+        latency += row_latency
+        for model, tokens in row_input.items():
+            input_tokens[model] += tokens
+        for model, tokens in row_output.items():
+            output_tokens[model] += tokens
+
+    if rendered == 0:
+        return estimate
+    scale = num_rows / rendered
+    for model in input_tokens:
+        estimate.input_tokens[model] = round(input_tokens[model] * scale)
+        estimate.output_tokens[model] = round(output_tokens[model] * scale)
+        input_cost, output_cost = get_cost(
+            estimate.input_tokens[model], estimate.output_tokens[model], model)
+        estimate.input_cost += input_cost
+        estimate.output_cost += output_cost
+    estimate.total_latency = latency * scale
+    if estimate.num_unrendered:
+        estimate.num_unrendered = round(estimate.num_unrendered * scale)
+    return estimate
+
+
+def _estimate_row(pipeline, row: Dict):
+    input_tokens = defaultdict(int)
+    output_tokens = defaultdict(int)
+    latency = 0.0
+
+    def placeholder(model, max_tokens=None):
+        return placeholder_text(projected_output_tokens(model, max_tokens))
+
+    for step in pipeline.steps:
+        calls = step._estimate_calls(row, placeholder)
+        for model, prompt, max_tokens in calls:
+            projected = projected_output_tokens(model, max_tokens)
+            input_tokens[model] += count_tokens(prompt, model)
+            output_tokens[model] += projected
+            latency += projected_latency(model, projected)
+        if not calls:
+            num_rows = step.statistics.num_success + \
+                step.statistics.num_failure + step.statistics.num_skipped
+            if num_rows:
+                latency += step.statistics.total_latency / num_rows
+        # fill in the step's outputs so downstream prompts can be rendered
+        fields = step.output_fields()
+        if calls:
+            model, _, max_tokens = calls[-1]
+            text = placeholder_text(
+                projected_output_tokens(model, max_tokens) / len(fields))
+        else:
+            text = placeholder_text(16)
+        for field_name in fields:
+            row.setdefault(field_name, text)
+    return input_tokens, output_tokens, latency
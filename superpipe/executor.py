@@ -0,0 +1,105 @@
+from __future__ import annotations
+import os
+import pickle
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, List, Optional
+from superpipe.config import is_dev
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from superpipe.steps.step import Step, StepResult
+
+# the step each worker process runs, set once per worker by `_init_worker`
+_worker_step = None
+
+
+def _init_worker(step: Step):
+    global _worker_step
+    _worker_step = step
+    step._init_worker()
+
+
+def _run_chunk(chunk: pd.DataFrame) -> List[StepResult]:
+    return _worker_step._run_chunk(chunk)
+
+
+class ProcessExecutor:
+    """
+    Runs a step on DataFrames in a pool of worker processes, for CPU-bound steps (custom transforms,
+    local embedding functions) that threads can't speed up because of the GIL.
+
+    Rows are sent to the workers in chunks. The step is copied to each worker once, when the worker
+    starts, and its `_init_worker` hook sets up per-worker state (e.g. EmbeddingSearchStep's index).
+    Statistics are updated in the calling process as chunks finish. Budgets and live metrics
+    don't see LLM calls made inside the workers, so keep LLM steps in-process.
+
+    Attach it to a step with `step.executor = ProcessExecutor(...)`. It's used whenever the step runs
+    on a DataFrame, e.g. in a pipeline run with `row_wise=False`.
+
+    Args:
+        max_workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        chunk_size (int): Number of rows sent to a worker at a time.
+        start_method (str, optional): The multiprocessing start method. By default workers are forked when
+            the calling process runs no other threads, which lets them inherit the step (including lambdas
+            and built indexes) without pickling it. Forking a process with running threads (e.g. a LogSink,
+            live metrics or a progress bar) can deadlock the workers on locks those threads held, so then
+            "forkserver" is used where it's available and "spawn" elsewhere, and the step must be picklable.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, chunk_size: int = 1000, start_method: Optional[str] = None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.start_method = start_method
+
+    def _start_method(self) -> str:
+        if self.start_method is not None:
+            return self.start_method
+        methods = multiprocessing.get_all_start_methods()
+        if "fork" in methods and threading.active_count() == 1:
+            return "fork"
+        return "forkserver" if "forkserver" in methods else "spawn"
+
+    def run(self, step: Step, data: pd.DataFrame, verbose=True) -> List[StepResult]:
+        """
+        Applies a step to every row of a DataFrame in the worker processes.
+
+        Args:
+            step (Step): The step to run.
+            data (pd.DataFrame): The data to run the step on.
+            verbose (bool): Whether to show progress.
+
+        Returns:
+            List[StepResult]: The result for each row, in the order of the rows.
+        """
+        chunks = [data.iloc[start:start + self.chunk_size]
+                  for start in range(0, len(data), self.chunk_size)]
+        if not chunks:
+            return []
+        start_method = self._start_method()
+        if start_method != "fork":
+            try:
+                pickle.dumps(step)
+            except Exception as e:
+                raise ValueError(
+                    f"Step {step.name} can't be sent to {start_method} worker processes because it can't be pickled, "
+                    "e.g. because it uses a lambda. Use module-level functions, or start_method=\"fork\" if "
+                    f"no other threads are running: {e}") from e
+        results = []
+        with ProcessPoolExecutor(
+                max_workers=min(self.max_workers, len(chunks)),
+                mp_context=multiprocessing.get_context(start_method),
+                initializer=_init_worker,
+                initargs=(step,)) as pool:
+            futures = [pool.submit(_run_chunk, chunk) for chunk in chunks]
+            if verbose and is_dev:
+                from tqdm import tqdm
+                futures = tqdm(
+                    futures, desc=f"Applying step {step.name} ({self.max_workers} processes)")
+            for future in futures:
+                chunk_results = future.result()
+                for result in chunk_results:
+                    step._record_result(result)
+                results.extend(chunk_results)
+        return results
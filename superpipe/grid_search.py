@@ -1,11 +1,18 @@
+from __future__ import annotations
 import itertools
 import json
 import os
 import pandas as pd
-from typing import Dict, List
+from contextlib import ExitStack
+from typing import TYPE_CHECKING, Dict, List, Optional, Union
+from superpipe.arrow import ParquetSink
 from superpipe.pipeline import Pipeline
-from superpipe.util import df_apply_gradients
+from superpipe.util import df_apply_gradients, is_arrow
 from superpipe.config import studio_enabled
+from superpipe.budget import Budget
+
+if TYPE_CHECKING:
+    import pyarrow as pa
 
 
 class GridSearch:
@@ -53,7 +60,8 @@ class GridSearch:
         return params_grid_list
 
     def _update_best(self):
-        if self.results is not None and not self.results.empty:
+        if self.results is not None and not self.results.empty \
+                and self.results['score'].notna().any():
             best_row = self.results.loc[self.results['score'].idxmax()]
             self.best_score = best_row['score']
             best_params = {key: best_row[key]
@@ -87,6 +95,39 @@ class GridSearch:
                 for step, params in params_dict.items()
                 for param, value in params.items()}
 
+    def estimate(self, df: pd.DataFrame, sample: Optional[int] = None, styled=True):
+        """
+        Estimates the tokens, cost and latency of every configuration in the grid, without calling any provider.
+        Use it to prune expensive configurations from the grid before running it.
+
+        Args:
+            df (pd.DataFrame): The DataFrame the grid search would run on.
+            sample (int, optional): Number of rows to render prompts for in each configuration.
+
+        Returns:
+            pd.DataFrame: One row per configuration with its projected tokens, cost and latency.
+        """
+        estimates = []
+        for params in self.params_list:
+            self.pipeline.update_params(params)
+            estimate = self.pipeline.estimate(df, sample)
+            estimates.append({
+                **GridSearch._flatten_params_dict(params),
+                'input_cost': estimate.input_cost,
+                'output_cost': estimate.output_cost,
+                'total_cost': estimate.total_cost,
+                'total_latency': estimate.total_latency,
+                'input_tokens': dict(estimate.input_tokens),
+                'output_tokens': dict(estimate.output_tokens),
+                'index': GridSearch._hash_params(params)
+            })
+        estimates = pd.DataFrame(estimates)
+        if styled:
+            lower_columns = ['input_cost', 'output_cost',
+                             'total_cost', 'total_latency']
+            return df_apply_gradients(estimates, [], lower_columns)
+        return estimates
+
     def run_experiment(self, data, verbose=False):
         if not studio_enabled():
             raise ValueError(
@@ -120,6 +161,7 @@ class GridSearch:
                 'output_tokens': self.pipeline.statistics.output_tokens,
                 'num_success': self.pipeline.statistics.num_success,
                 'num_failure': self.pipeline.statistics.num_failure,
+                'num_skipped': self.pipeline.statistics.num_skipped,
                 'index': index
             }
             if verbose:
@@ -128,47 +170,100 @@ class GridSearch:
         self.results = pd.DataFrame(results)
         self._update_best()
 
-    def run(self, df: pd.DataFrame, output_dir=None, verbose=False, styled=True):
+    def run(self,
+            df: Union[pd.DataFrame, pa.Table, pa.RecordBatchReader],
+            output_dir=None,
+            verbose=False,
+            styled=True,
+            budget: Optional[Budget] = None,
+            output_format: str = "csv",
+            row_group_size: int = 10_000):
         """
-        Applies the grid search on a given DataFrame and optionally saves the results to CSV files.
+        Applies the grid search on a given DataFrame and optionally saves the results to CSV or Parquet files.
 
         Args:
-            df (pd.DataFrame): The DataFrame to apply the grid search on.
-            output_dir (str, optional): The directory to save the result CSV files. If None, files are not saved.
+            df (Union[pd.DataFrame, pa.Table, pa.RecordBatchReader]): The data to apply the grid search on.
+                A RecordBatchReader is read into a Table first, since every configuration runs on it.
+            output_dir (str, optional): The directory to save the result files. If None, files are not saved.
+            budget (Budget, optional): Limits on what all the configurations together can spend. Once it's exhausted
+                the current configuration stops and the remaining ones are skipped.
+            output_format (str): "csv" to save each configuration's result as a CSV file, or "parquet" to
+                write it to a Parquet file in row groups of `row_group_size` rows as the rows are processed,
+                and to append each configuration's summary to `summary.parquet` as soon as it finishes.
+                Parquet requires pyarrow.
+            row_group_size (int): Rows per row group of the Parquet files.
 
         Returns:
             pd.DataFrame: A DataFrame containing the results of the grid search.
         """
+        if output_format not in ("csv", "parquet"):
+            raise ValueError(
+                f"Unknown output format {output_format}, expected csv or parquet")
+        parquet = output_format == "parquet"
+        full_path = None
+        if output_dir is not None:
+            full_path = os.path.join(os.getcwd(), output_dir)
+            if not os.path.exists(full_path):
+                os.makedirs(full_path)
+        if is_arrow(df):
+            import pyarrow as pa
+            if isinstance(df, pa.RecordBatchReader):
+                df = df.read_all()
+        batches = None
+        if parquet and full_path is not None:
+            from superpipe.arrow import to_arrow
+            table = df if is_arrow(df) else to_arrow(df)
+            batches = table.to_batches(max_chunksize=row_group_size)
         results = []
-        n = len(self.params_list)
-        for i, params in enumerate(self.params_list):
-            # TODO: check for duplicate params because of steps overriding global params
-            if verbose:
-                print(f"Iteration {i+1} of {n}")
-                print("Params: ", params)
-            self.pipeline.update_params(params)
-            df_result = self.pipeline.run(df.copy(), verbose)
-            index = GridSearch._hash_params(params)
-            if output_dir is not None:
-                full_path = os.path.join(os.getcwd(), output_dir)
-                if not os.path.exists(full_path):
-                    os.makedirs(full_path)
-                df_result.to_csv(f"{full_path}/{index}.csv")
-            result = {
-                **GridSearch._flatten_params_dict(params),
-                'score': self.pipeline.score,
-                'input_cost': self.pipeline.statistics.input_cost,
-                'output_cost': self.pipeline.statistics.output_cost,
-                'total_latency': self.pipeline.statistics.total_latency,
-                'input_tokens': self.pipeline.statistics.input_tokens,
-                'output_tokens': self.pipeline.statistics.output_tokens,
-                'num_success': self.pipeline.statistics.num_success,
-                'num_failure': self.pipeline.statistics.num_failure,
-                'index': index
-            }
-            if verbose:
-                print("Result: ", result)
-            results.append(result)
+        with ExitStack() as stack:
+            summary = None
+            if batches is not None:
+                summary = stack.enter_context(ParquetSink(
+                    f"{full_path}/summary.parquet", types=GridSearch._summary_types()))
+            n = len(self.params_list)
+            for i, params in enumerate(self.params_list):
+                # TODO: check for duplicate params because of steps overriding global params
+                if budget is not None and budget.exhausted:
+                    print(
+                        f"Budget exhausted, skipping the remaining {n - i} configurations")
+                    break
+                if verbose:
+                    print(f"Iteration {i+1} of {n}")
+                    print("Params: ", params)
+                self.pipeline.update_params(params)
+                index = GridSearch._hash_params(params)
+                if batches is not None:
+                    import pyarrow as pa
+                    # each configuration reads the batches afresh, and its outputs are written as they finish
+                    with ParquetSink(f"{full_path}/{index}.parquet", row_group_size) as sink:
+                        self.pipeline.run(pa.RecordBatchReader.from_batches(table.schema, batches),
+                                          verbose=verbose, budget=budget, sink=sink)
+                else:
+                    df_result = self.pipeline.run(
+                        df if is_arrow(df) else df.copy(), verbose=verbose, budget=budget)
+                    if full_path is not None:
+                        if is_arrow(df_result):
+                            df_result = df_result.to_pandas()
+                        df_result.to_csv(f"{full_path}/{index}.csv")
+                result = {
+                    **GridSearch._flatten_params_dict(params),
+                    'score': self.pipeline.score,
+                    'input_cost': self.pipeline.statistics.input_cost,
+                    'output_cost': self.pipeline.statistics.output_cost,
+                    'total_latency': self.pipeline.statistics.total_latency,
+                    'input_tokens': self.pipeline.statistics.input_tokens,
+                    'output_tokens': self.pipeline.statistics.output_tokens,
+                    'num_success': self.pipeline.statistics.num_success,
+                    'num_failure': self.pipeline.statistics.num_failure,
+                    'num_skipped': self.pipeline.statistics.num_skipped,
+                    'budget_exhausted': self.pipeline.statistics.budget_exhausted,
+                    'index': index
+                }
+                if verbose:
+                    print("Result: ", result)
+                results.append(result)
+                if summary is not None:
+                    summary.write(pd.DataFrame([result]))
         self.results = pd.DataFrame(results)
         self._update_best()
 
@@ -177,3 +272,24 @@ class GridSearch:
             lower_columns = ['input_cost', 'output_cost', 'total_latency']
             return df_apply_gradients(self.results, higher_columns, lower_columns)
         return self.results
+
+    def _summary_types() -> Dict:
+        """
+        Returns the Arrow types of the summary columns, so every configuration's row has the same schema,
+        e.g. a score that's None for some configurations is still a float column.
+        """
+        import pyarrow as pa
+        tokens = pa.map_(pa.string(), pa.int64())
+        return {
+            'score': pa.float64(),
+            'input_cost': pa.float64(),
+            'output_cost': pa.float64(),
+            'total_latency': pa.float64(),
+            'input_tokens': tokens,
+            'output_tokens': tokens,
+            'num_success': pa.int64(),
+            'num_failure': pa.int64(),
+            'num_skipped': pa.int64(),
+            'budget_exhausted': pa.bool_(),
+            'index': pa.int64()
+        }
@@ -0,0 +1,103 @@
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Optional
+
+# the hedge policy that applies to LLM calls made in the current context
+_active_policy: ContextVar[Optional["HedgePolicy"]] = ContextVar(
+    "hedge_policy", default=None)
+
+
+class HedgePolicy:
+    """
+    Hedged requests for the LLM calls of a step, to cut tail latency. When a call hasn't returned after
+    the given percentile of the latencies observed so far for its model, a duplicate request is sent,
+    to the same model or a backup model, and whichever response arrives first is used.
+
+    The losing request isn't cancelled; its cost is added to `wasted_cost` when it finishes, and shows
+    up as `hedge_cost` in the pipeline statistics. Budgets and live metrics see both requests.
+
+    Attach it to a step with `step.hedge = HedgePolicy(...)`.
+
+    Attributes:
+        percentile (float): Latency percentile, between 0 and 1, after which a call is hedged.
+        model (str, optional): The model the duplicate request is sent to. Defaults to the call's model.
+        min_samples (int): Calls to a model that must complete before its calls are hedged.
+        window (int): Number of recent latencies per model the percentile is computed from.
+        num_calls (int): Calls made under the policy.
+        num_hedged (int): Calls for which a duplicate request was sent.
+        num_hedge_wins (int): Hedged calls where the duplicate request returned first.
+        wasted_cost (float): Cost in dollars of the requests whose responses weren't used.
+    """
+
+    def __init__(self,
+                 percentile: float = 0.95,
+                 model: Optional[str] = None,
+                 min_samples: int = 20,
+                 window: int = 1000):
+        if not 0 < percentile < 1:
+            raise ValueError("percentile must be between 0 and 1")
+        self.percentile = percentile
+        self.model = model
+        self.min_samples = min_samples
+        self.window = window
+        self._lock = threading.Lock()
+        self._latencies = defaultdict(lambda: deque(maxlen=self.window))
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the counters. Observed latencies are kept.
+        """
+        with self._lock:
+            self.num_calls = 0
+            self.num_hedged = 0
+            self.num_hedge_wins = 0
+            self.wasted_cost = 0.0
+
+    def threshold(self, model: str) -> Optional[float]:
+        """
+        Returns the seconds after which a call to the model is hedged, or None if too few calls completed.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies[model])
+        if len(latencies) < max(1, self.min_samples):
+            return None
+        return latencies[min(len(latencies) - 1, int(self.percentile * len(latencies)))]
+
+    def observe(self, model: str, latency: float):
+        with self._lock:
+            self._latencies[model].append(latency)
+
+    def record_call(self, hedged: bool = False, hedge_won: bool = False):
+        with self._lock:
+            self.num_calls += 1
+            self.num_hedged += hedged
+            self.num_hedge_wins += hedge_won
+
+    def record_wasted(self, cost: float):
+        with self._lock:
+            self.wasted_cost += cost
+
+
+def hedging(policy: Optional[HedgePolicy]):
+    """
+    Applies a hedge policy to the LLM calls made inside the block.
+    """
+    if policy is None:
+        return nullcontext()
+    return _hedging(policy)
+
+
+@contextmanager
+def _hedging(policy: HedgePolicy):
+    token = _active_policy.set(policy)
+    try:
+        yield
+    finally:
+        _active_policy.reset(token)
+
+
+def active_hedge_policy() -> Optional[HedgePolicy]:
+    return _active_policy.get()
@@ -1,71 +1,435 @@
+from __future__ import annotations
 import time
-import json
+import queue
+import threading
+import contextvars
+from contextlib import closing, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
 from pydantic import BaseModel
-from typing import Optional
-from openai.types.chat.completion_create_params import CompletionCreateParamsNonStreaming
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Type
 from superpipe.models import *
+from superpipe.parsing import InvalidOutput, StreamingJSONParser, parse_json_output, repair_prompt
 from superpipe.clients import get_client, openrouter_models
+from superpipe.metrics import track_request
+from superpipe.concurrency import is_unavailable_error
+from superpipe.budget import spend
+from superpipe.estimate import record_call
+from superpipe.hedge import active_hedge_policy
+from superpipe.router import get_router
+from superpipe.timeouts import with_timeout, has_deadline
+from superpipe.tokenizer import count_tokens
+
+if TYPE_CHECKING:
+    from openai.types.chat.completion_create_params import CompletionCreateParamsNonStreaming
+
+
+STRUCTURED_SYSTEM_PROMPT = "You are a helpful assistant designed to output JSON."
+ANTHROPIC_STRUCTURED_SYSTEM_PROMPT = "You are a helpful assistant designed to output JSON. Return only JSON, nothing else."
+
+# decides when to stop a streamed response, given its next chunk: returns the reason to stop, or None
+StreamStop = Callable[[str], Optional[str]]
+
+# call lists of the `collect_llm_calls` blocks active in the current context
+_call_collectors: ContextVar[tuple] = ContextVar(
+    "llm_call_collectors", default=())
 
 
 class LLMResponse(BaseModel):
     input_tokens: int = 0
     output_tokens: int = 0
+    # prompt tokens read from and written to the provider's prompt cache, included in input_tokens
+    cached_input_tokens: int = 0
+    cache_write_input_tokens: int = 0
     input_cost: float = 0.0
     output_cost: float = 0.0
     success: bool = False
     error: Optional[str] = None
     latency: float = 0.0
     content: str = ""
+    # the model that served the response, which differs from the requested one when a hedge won or
+    # a router failed over
+    model: Optional[str] = None
+    # the HTTP status of a failed call, if the provider returned one
+    status_code: Optional[int] = None
+    # whether the call failed because the provider was unavailable: rate limited, overloaded, timed out
+    # or unreachable, as opposed to rejecting the request
+    unavailable: bool = False
+    # for streamed calls: seconds until the first token arrived, output tokens per second after that,
+    # and why the stream was stopped before the response was complete, if it was
+    time_to_first_token: Optional[float] = None
+    tokens_per_second: Optional[float] = None
+    stopped_early: Optional[str] = None
 
 
 class StructuredLLMResponse(LLMResponse):
     content: dict = {}
+    # the output of a call that succeeded but had no valid JSON object
+    invalid_output: Optional[str] = None
+    # whether the content comes from a call that repaired invalid output
+    repaired: bool = False
+
+
+@contextmanager
+def collect_llm_calls():
+    """
+    Collects the LLM calls that complete successfully inside the block, e.g. the calls made by
+    a CustomStep's transform, so their tokens and cost can be attributed to the step.
+
+    Yields:
+        List[Tuple[str, LLMResponse]]: (model, response) for each call, appended as calls complete.
+    """
+    calls: List[Tuple[str, LLMResponse]] = []
+    token = _call_collectors.set(_call_collectors.get() + (calls,))
+    try:
+        yield calls
+    finally:
+        _call_collectors.reset(token)
+
+
+def _record_response(model: str, response: LLMResponse):
+    record_call(model, response.output_tokens, response.latency)
+    for calls in _call_collectors.get():
+        calls.append((model, response))
+
+
+def _hedged(call: Callable[[str], LLMResponse], model: str) -> LLMResponse:
+    """
+    Makes an LLM call, hedged by the active hedge policy: if the call hasn't returned after the policy's
+    latency percentile for the model, a duplicate call is started and the first successful response is used.
+
+    Args:
+        call (Callable[[str], LLMResponse]): Makes the call to the given model.
+        model (str): The model of the original call.
+    """
+    policy = active_hedge_policy()
+    threshold = policy.threshold(model) if policy is not None else None
+    if threshold is None:
+        response = call(model)
+        if policy is not None:
+            policy.record_call()
+            if response.success:
+                policy.observe(model, response.latency)
+        return response
+
+    results = queue.Queue()
+    collectors = _call_collectors.get()
+
+    def attempt(i, m):
+        # only the response that's used is reported to the collectors, by the calling thread
+        _call_collectors.set(())
+        try:
+            response = call(m)
+            if response.success:
+                policy.observe(m, response.latency)
+        except Exception as e:
+            response = e
+        results.put((i, m, response))
+
+    def start(i, m):
+        threading.Thread(target=contextvars.copy_context().run,
+                         args=(attempt, i, m), daemon=True).start()
+
+    def ok(result):
+        return isinstance(result[2], LLMResponse) and result[2].success
+
+    def cost(result):
+        return result[2].input_cost + result[2].output_cost if isinstance(result[2], LLMResponse) else 0.0
+
+    start(0, model)
+    try:
+        winner = results.get(timeout=threshold)
+        hedged = False
+    except queue.Empty:
+        start(1, policy.model or model)
+        winner = results.get()
+        hedged = True
+    if hedged and not ok(winner):
+        # the first call to return failed, wait for the other one
+        other = results.get()
+        if ok(other):
+            winner, other = other, winner
+        policy.record_wasted(cost(other))
+    elif hedged:
+        def wait_for_loser():
+            policy.record_wasted(cost(results.get()))
+        threading.Thread(target=wait_for_loser, daemon=True).start()
+    policy.record_call(hedged=hedged, hedge_won=winner[0] == 1)
+    _, winning_model, response = winner
+    if isinstance(response, Exception):
+        raise response
+    if response.success:
+        for calls in collectors:
+            calls.append((winning_model, response))
+    return response
+
+
+def _get_limited_client(model: str):
+    """
+    Returns the client for a model. Under a deadline, SDK retries are turned off, since each retry
+    would get the full timeout again.
+    """
+    client = get_client(model)
+    if client is not None and has_deadline():
+        client = client.with_options(max_retries=0)
+    return client
+
+
+def _routed(call: Callable[[str], LLMResponse], model: str) -> LLMResponse:
+    """
+    Makes an LLM call, through the model's router if the model is the name of one.
+    """
+    router = get_router(model)
+    if router is None:
+        return call(model)
+    return router.call(call)
+
+
+def _openai_cached_tokens(usage) -> int:
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+
+def _anthropic_system(args, system: Optional[str]):
+    """
+    Returns the args with `system` appended to the system prompt, as a single block marked for
+    Anthropic's prompt cache.
+    """
+    if system is None:
+        return args
+    text = "\n\n".join(s for s in (args.get("system"), system) if s)
+    return {**args, "system": [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]}
+
+
+def _system_text(system) -> str:
+    if isinstance(system, list):
+        return "\n".join(block.get("text", "") for block in system)
+    return system or ""
 
 
 def get_llm_response(
         prompt: str,
         model: str = gpt35,
-        args={}) -> LLMResponse:
-    if model in openrouter_models:
-        return get_llm_response_openrouter(prompt, model, args)
-    if model in [claude3_haiku, claude3_sonnet, claude3_opus]:
-        return get_llm_response_anthropic(prompt, model, args)
-    return get_llm_response_openai(prompt, model, args)
+        args={},
+        system: Optional[str] = None,
+        stream: bool = False,
+        max_stream_tokens: Optional[int] = None) -> LLMResponse:
+    """
+    Gets a response from an LLM.
 
+    Args:
+        prompt (str): The prompt, sent as the user message.
+        model (str): The model, or the name of a router.
+        args (Dict): Additional arguments for the provider's API.
+        system (str, optional): Instructions that are the same for every call, sent ahead of the prompt as a
+            system message. Providers cache a stable prefix like this one, so repeated calls are cheaper
+            and faster.
+        stream (bool): Whether to stream the response, which records its time to first token and tokens
+            per second.
+        max_stream_tokens (int, optional): When streaming, the response is cut off once it's longer than
+            this many tokens.
+    """
+    def call(m): return _get_llm_response(
+        prompt, m, args, system, stream, _stream_stop(m, max_stream_tokens))
+    return _hedged(lambda m: _routed(call, m), model)
 
-def get_llm_response_openrouter(
+
+def _get_llm_response(
         prompt: str,
-        model: str = "openrouter/auto",
+        model: str = gpt35,
         args={},
-        system: str = None,) -> LLMResponse:
-    response = LLMResponse()
-    res = None
-    client = get_client(model)
-    if client is None:
-        raise ValueError("Unsupported model: ", model)
-    try:
-        messages = []
-        if system is not None:
-            messages.append({"role": "system", "content": system})
-        messages.append({"role": "user", "content": prompt})
-        start_time = time.perf_counter()
+        system: Optional[str] = None,
+        stream: bool = False,
+        stop: Optional[StreamStop] = None) -> LLMResponse:
+    if model in openrouter_models:
+        return get_llm_response_openrouter(prompt, model, args, system, stream, stop)
+    if model in [claude3_haiku, claude3_sonnet, claude3_opus]:
+        return get_llm_response_anthropic(prompt, model, args, system, stream, stop)
+    return get_llm_response_openai(prompt, model, args, system, stream, stop)
+
+
+def _stream_stop(
+        model: str,
+        max_stream_tokens: Optional[int] = None,
+        complete: Optional[Callable[[str], bool]] = None) -> Optional[StreamStop]:
+    """
+    Returns the function that decides when to stop streaming a response: once `complete` returns True for
+    a chunk ("complete"), or the output is longer than `max_stream_tokens` ("max_tokens"). Each call needs
+    its own, since it keeps count of the output.
+    """
+    if max_stream_tokens is None and complete is None:
+        return None
+    tokens = 0
+
+    def stop(chunk: str) -> Optional[str]:
+        nonlocal tokens
+        if complete is not None and complete(chunk):
+            return "complete"
+        if max_stream_tokens is not None:
+            tokens += count_tokens(chunk, model)
+            if tokens > max_stream_tokens:
+                return "max_tokens"
+        return None
+    return stop
+
+
+@dataclass
+class _Completion:
+    """
+    The output and usage of a completed call, streamed or not.
+    """
+    content: str
+    input_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+    cached_tokens: int = 0
+    cache_write_tokens: int = 0
+    # time.perf_counter() when the first token arrived, for streamed calls
+    first_token_time: Optional[float] = None
+    stopped_early: Optional[str] = None
+
+    def estimate_usage(self, prompt: str, model: str):
+        """
+        Counts the tokens locally when the provider didn't report them, e.g. for a stream that was stopped.
+        """
+        if self.input_tokens is None:
+            self.input_tokens = count_tokens(prompt, model)
+        if self.output_tokens is None:
+            self.output_tokens = count_tokens(self.content, model)
+
+
+class _StreamReader:
+    """
+    Accumulates the chunks of a streamed response and applies its stop function.
+    """
+
+    def __init__(self, stop: Optional[StreamStop]):
+        self.stop = stop
+        self.parts = []
+        self.first_token_time = None
+        self.stopped_early = None
+
+    def add(self, chunk: str) -> bool:
+        """
+        Adds a chunk of output. Returns True if the stream should be stopped.
+        """
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        self.parts.append(chunk)
+        if self.stop is not None:
+            self.stopped_early = self.stop(chunk)
+        return self.stopped_early is not None
+
+    def completion(self, **usage) -> _Completion:
+        return _Completion(content="".join(self.parts), first_token_time=self.first_token_time,
+                           stopped_early=self.stopped_early, **usage)
+
+
+def _openai_completion(client, model: str, messages: List[Dict], args, stream: bool,
+                       stop: Optional[StreamStop]) -> _Completion:
+    if not stream:
         res = client.chat.completions.create(
             model=model,
             messages=messages,
-            **args
+            **with_timeout(args)
         )
-        end_time = time.perf_counter()
-        response.latency = end_time - start_time
-        response.input_tokens = res.usage.prompt_tokens
-        response.output_tokens = res.usage.completion_tokens
-        response.input_cost, response.output_cost = get_cost(
-            response.input_tokens, response.output_tokens, model)
-        response.content = res.choices[0].message.content
-        response.success = True
-    except Exception as e:
-        response.success = False
-        response.error = str(e)
-    return response
+        return _Completion(res.choices[0].message.content, res.usage.prompt_tokens, res.usage.completion_tokens,
+                           _openai_cached_tokens(res.usage))
+    # ask for the usage in the last chunk, through extra_body so older SDKs accept it too
+    extra_body = {**args.get("extra_body", {}), "stream_options": {"include_usage": True}}
+    chunks = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        **with_timeout({**args, "extra_body": extra_body})
+    )
+    reader = _StreamReader(stop)
+    res_usage = None
+    with closing(chunks):
+        for chunk in chunks:
+            if chunk.usage is not None:
+                res_usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content and reader.add(chunk.choices[0].delta.content):
+                # closing the stream drops the connection, so the provider stops generating
+                break
+    if res_usage is None:
+        return reader.completion()
+    return reader.completion(input_tokens=res_usage.prompt_tokens, output_tokens=res_usage.completion_tokens,
+                             cached_tokens=_openai_cached_tokens(res_usage))
+
+
+def _anthropic_completion(client, model: str, prompt: str, args, stream: bool,
+                          stop: Optional[StreamStop]) -> _Completion:
+    kwargs = {"max_tokens": 4096, **with_timeout(args)}
+    messages = [{"role": "user", "content": prompt}]
+    if not stream:
+        res = client.messages.create(model=model, messages=messages, **kwargs)
+        return _Completion(res.content[0].text, **_anthropic_usage(res.usage), output_tokens=res.usage.output_tokens)
+    events = client.messages.create(model=model, messages=messages, stream=True, **kwargs)
+    reader = _StreamReader(stop)
+    usage = {}
+    with closing(events):
+        for event in events:
+            if event.type == "message_start":
+                usage.update(_anthropic_usage(event.message.usage))
+            elif event.type == "message_delta":
+                usage["output_tokens"] = event.usage.output_tokens
+            elif event.type == "content_block_delta" and getattr(event.delta, "text", None):
+                if reader.add(event.delta.text):
+                    break
+    return reader.completion(**usage)
+
+
+def _anthropic_usage(usage) -> Dict:
+    # input_tokens only counts the tokens after the last cache breakpoint
+    cached_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write_tokens = getattr(usage, "cache_creation_input_tokens", None) or 0
+    return {
+        "input_tokens": usage.input_tokens + cached_tokens + cache_write_tokens,
+        "cached_tokens": cached_tokens,
+        "cache_write_tokens": cache_write_tokens,
+    }
+
+
+def _completed_response(response: LLMResponse, completion: _Completion, model: str, start_time: float):
+    """
+    Fills in a response from a completed call.
+    """
+    end_time = time.perf_counter()
+    response.latency = end_time - start_time
+    response.input_tokens = completion.input_tokens
+    response.output_tokens = completion.output_tokens
+    response.cached_input_tokens = completion.cached_tokens
+    response.cache_write_input_tokens = completion.cache_write_tokens
+    response.input_cost, response.output_cost = get_cost(
+        response.input_tokens, response.output_tokens, model, completion.cached_tokens,
+        completion.cache_write_tokens)
+    response.content = completion.content
+    response.success = True
+    response.model = model
+    if completion.first_token_time is not None:
+        response.time_to_first_token = completion.first_token_time - start_time
+        generation_time = end_time - completion.first_token_time
+        if generation_time > 0:
+            response.tokens_per_second = response.output_tokens / generation_time
+    response.stopped_early = completion.stopped_early
+
+
+def _failed_response(response: LLMResponse, e: Exception, start_time: float):
+    response.success = False
+    response.error = str(e)
+    response.status_code = getattr(e, "status_code", None)
+    response.unavailable = is_unavailable_error(e)
+    response.latency = time.perf_counter() - start_time
+
+
+def get_llm_response_openrouter(
+        prompt: str,
+        model: str = "openrouter/auto",
+        args={},
+        system: str = None,
+        stream: bool = False,
+        stop: Optional[StreamStop] = None) -> LLMResponse:
+    return get_llm_response_openai(prompt, model, args, system, stream, stop)
 
 
 def get_structured_llm_response_openrouter(
@@ -79,32 +443,28 @@ def get_structured_llm_response_openrouter(
 def get_llm_response_anthropic(
         prompt: str,
         model: str = claude3_haiku,
-        args={}) -> LLMResponse:
+        args={},
+        system: str = None,
+        stream: bool = False,
+        stop: Optional[StreamStop] = None) -> LLMResponse:
     response = LLMResponse()
-    res = None
-    client = get_client(model)
+    client = _get_limited_client(model)
     if client is None:
         raise ValueError(f"""Unsupported model: {model}. Currently Superpipe only supports OpenAI, Anthropic and OpenRouter models.
                          If you're trying to use a supported model, you might be missing the appropriate api key.""")
+    args = _anthropic_system(args, system)
+    prompt_text = _system_text(args.get("system")) + prompt
+    start_time = time.perf_counter()
     try:
-        start_time = time.perf_counter()
-        res = client.messages.create(
-            model=model,
-            max_tokens=4096,
-            messages=[{"role": "user", "content": prompt}],
-            **args
-        )
-        end_time = time.perf_counter()
-        response.latency = end_time - start_time
-        response.input_tokens = res.usage.input_tokens
-        response.output_tokens = res.usage.output_tokens
-        response.input_cost, response.output_cost = get_cost(
-            response.input_tokens, response.output_tokens, model)
-        response.content = res.content[0].text
-        response.success = True
+        with track_request(), spend(model, prompt_text, args) as usage:
+            completion = _anthropic_completion(client, model, prompt, args, stream, stop)
+            completion.estimate_usage(prompt_text, model)
+            usage.record(completion.input_tokens, completion.output_tokens,
+                         completion.cached_tokens, completion.cache_write_tokens)
+        _completed_response(response, completion, model, start_time)
+        _record_response(model, response)
     except Exception as e:
-        response.success = False
-        response.error = str(e)
+        _failed_response(response, e, start_time)
     return response
 
 
@@ -112,95 +472,168 @@ def get_llm_response_openai(
         prompt: str,
         model=gpt35,
         args: CompletionCreateParamsNonStreaming = {},
-        system: str = None,) -> LLMResponse:
+        system: str = None,
+        stream: bool = False,
+        stop: Optional[StreamStop] = None) -> LLMResponse:
     response = LLMResponse()
-    res = None
-    client = get_client(model)
+    client = _get_limited_client(model)
     if client is None:
         raise ValueError("Unsupported model: ", model)
+    messages = []
+    if system is not None:
+        messages.append({"role": "system", "content": system})
+    messages.append({"role": "user", "content": prompt})
+    prompt_text = "\n".join(m["content"] for m in messages)
+    start_time = time.perf_counter()
     try:
-        messages = []
-        if system is not None:
-            messages.append({"role": "system", "content": system})
-        messages.append({"role": "user", "content": prompt})
-        start_time = time.perf_counter()
-        res = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            **args
-        )
-        end_time = time.perf_counter()
-        response.latency = end_time - start_time
-        response.input_tokens = res.usage.prompt_tokens
-        response.output_tokens = res.usage.completion_tokens
-        response.input_cost, response.output_cost = get_cost(
-            response.input_tokens, response.output_tokens, model)
-        response.content = res.choices[0].message.content
-        response.success = True
+        with track_request(), spend(model, prompt_text, args) as usage:
+            completion = _openai_completion(client, model, messages, args, stream, stop)
+            completion.estimate_usage(prompt_text, model)
+            usage.record(completion.input_tokens, completion.output_tokens, completion.cached_tokens)
+        _completed_response(response, completion, model, start_time)
+        _record_response(model, response)
     except Exception as e:
-        response.success = False
-        response.error = str(e)
+        _failed_response(response, e, start_time)
     return response
 
 
 def get_structured_llm_response(
         prompt: str,
         model: str = gpt35,
-        args={}) -> StructuredLLMResponse:
+        args={},
+        system: Optional[str] = None,
+        out_schema: Optional[Type[BaseModel]] = None,
+        repair: bool = True,
+        stream: bool = False,
+        max_stream_tokens: Optional[int] = None) -> StructuredLLMResponse:
+    """
+    Gets a JSON response from an LLM. The JSON object is parsed locally, from fenced or chatty output too,
+    and validated against `out_schema` if given. If the output has no valid object, a single call is made
+    to the model that served the response to repair it, and its usage is added to the response.
+
+    A streamed response is parsed while it arrives, and the stream is stopped as soon as it has a complete
+    object matching the schema, so trailing text isn't waited for.
+
+    Args:
+        prompt (str): The prompt, sent as the user message.
+        model (str): The model, or the name of a router.
+        args (Dict): Additional arguments for the provider's API.
+        system (str, optional): Instructions that are the same for every call, e.g. the output schema, added
+            to the system message ahead of the prompt so providers can cache them.
+        out_schema (Type[BaseModel], optional): The Pydantic model the response must match.
+        repair (bool): Whether to make a repair call for invalid output. Only applies with `out_schema`.
+        stream (bool): Whether to stream the response, which records its time to first token and tokens
+            per second.
+        max_stream_tokens (int, optional): When streaming, the response is cut off once it's longer than
+            this many tokens. A response that was cut off before it had a valid object fails without a
+            repair call.
+    """
+    def call(m):
+        complete = StreamingJSONParser(out_schema).feed if stream else None
+        return _get_json_llm_response(prompt, m, args, system, stream,
+                                      _stream_stop(m, max_stream_tokens, complete))
+    response = _structured_response(
+        _hedged(lambda m: _routed(call, m), model), out_schema)
+    if response.invalid_output is None or out_schema is None or not repair:
+        return response
+    if response.stopped_early == "max_tokens":
+        response.error = f"Output exceeded max_stream_tokens ({max_stream_tokens}): {response.error}"
+        return response
+    fixed = get_structured_llm_response(
+        repair_prompt(response.invalid_output, response.error, out_schema),
+        response.model or model, args, out_schema=out_schema, repair=False, stream=stream)
+    return _with_repair(response, fixed)
+
+
+def _get_json_llm_response(
+        prompt: str,
+        model: str = gpt35,
+        args={},
+        system: Optional[str] = None,
+        stream: bool = False,
+        stop: Optional[StreamStop] = None) -> LLMResponse:
+    """
+    Makes an LLM call that asks for JSON, and returns the raw output.
+    """
     if model in [claude3_haiku, claude3_sonnet, claude3_opus]:
-        return get_structured_llm_response_anthropic(prompt, model, args)
-    return get_structured_llm_response_openai(prompt, model, args)
+        # Anthropic has no JSON mode, the output is parsed locally
+        updated_args = {**args, "system": ANTHROPIC_STRUCTURED_SYSTEM_PROMPT}
+        return get_llm_response_anthropic(prompt, model, updated_args, system, stream, stop)
+    updated_args = {**args, "response_format": {"type": "json_object"}}
+    return get_llm_response_openai(prompt, model, updated_args, _structured_system_prompt(system), stream, stop)
+
+
+def _structured_system_prompt(system: Optional[str]) -> str:
+    return STRUCTURED_SYSTEM_PROMPT if system is None else f"{STRUCTURED_SYSTEM_PROMPT}\n\n{system}"
+
+
+def _structured_response(
+        response: LLMResponse,
+        out_schema: Optional[Type[BaseModel]] = None) -> StructuredLLMResponse:
+    """
+    Parses the output of a successful call. Output without a valid JSON object fails the response and is
+    kept in `invalid_output`.
+    """
+    structured = StructuredLLMResponse(
+        **response.model_dump(exclude={"content"}))
+    if response.success:
+        try:
+            structured.content = parse_json_output(response.content, out_schema)
+        except InvalidOutput as e:
+            structured.success = False
+            structured.error = str(e)
+            structured.invalid_output = response.content
+    return structured
+
+
+def _with_repair(response: StructuredLLMResponse, fixed: StructuredLLMResponse) -> StructuredLLMResponse:
+    """
+    Returns the response of a repair call, with the usage of the call whose output it repaired added in.
+    """
+    return fixed.model_copy(update={
+        "input_tokens": response.input_tokens + fixed.input_tokens,
+        "output_tokens": response.output_tokens + fixed.output_tokens,
+        "cached_input_tokens": response.cached_input_tokens + fixed.cached_input_tokens,
+        "cache_write_input_tokens": response.cache_write_input_tokens + fixed.cache_write_input_tokens,
+        "input_cost": response.input_cost + fixed.input_cost,
+        "output_cost": response.output_cost + fixed.output_cost,
+        "latency": response.latency + fixed.latency,
+        "time_to_first_token": response.time_to_first_token,
+        "repaired": fixed.success,
+    })
 
 
 def get_structured_llm_response_openrouter(
         prompt: str,
         model: str = "openrouter/auto",
-        args={}) -> StructuredLLMResponse:
+        args={},
+        system: str = None,
+        out_schema: Optional[Type[BaseModel]] = None) -> StructuredLLMResponse:
     print("Warning: Not all OpenRouter models support structured output, this may cause unexpected issues.")
-    system = "You are a helpful assistant designed to output JSON."
     updated_args = {**args, "response_format": {"type": "json_object"}}
-    response = get_llm_response_openrouter(prompt, model, updated_args, system)
-    return StructuredLLMResponse(
-        input_tokens=response.input_tokens,
-        output_tokens=response.output_tokens,
-        input_cost=response.input_cost,
-        output_cost=response.output_cost,
-        success=response.success,
-        error=response.error,
-        latency=response.latency,
-        content=json.loads(response.content) if response.success else {},
-    )
+    response = get_llm_response_openrouter(
+        prompt, model, updated_args, _structured_system_prompt(system))
+    return _structured_response(response, out_schema)
 
 
 def get_structured_llm_response_anthropic(
         prompt: str,
         model: str = claude3_haiku,
-        args={}) -> StructuredLLMResponse:
-    print("Warning: Anthropic models do not support structured output, this may cause unexpected issues.")
-    updated_args = {
-        **args,
-        "system": "You are a helpful assistant designed to output JSON. Return only JSON, nothing else."
-    }
-    return get_llm_response_anthropic(
-        prompt,
-        model,
-        args=updated_args)
+        args={},
+        system: str = None,
+        out_schema: Optional[Type[BaseModel]] = None) -> StructuredLLMResponse:
+    updated_args = {**args, "system": ANTHROPIC_STRUCTURED_SYSTEM_PROMPT}
+    response = get_llm_response_anthropic(prompt, model, updated_args, system)
+    return _structured_response(response, out_schema)
 
 
 def get_structured_llm_response_openai(
         prompt: str,
         model=gpt35,
-        args: CompletionCreateParamsNonStreaming = {}) -> StructuredLLMResponse:
-    system = "You are a helpful assistant designed to output JSON."
+        args: CompletionCreateParamsNonStreaming = {},
+        system: str = None,
+        out_schema: Optional[Type[BaseModel]] = None) -> StructuredLLMResponse:
     updated_args = {**args, "response_format": {"type": "json_object"}}
-    response = get_llm_response_openai(prompt, model, updated_args, system)
-    return StructuredLLMResponse(
-        input_tokens=response.input_tokens,
-        output_tokens=response.output_tokens,
-        input_cost=response.input_cost,
-        output_cost=response.output_cost,
-        success=response.success,
-        error=response.error,
-        latency=response.latency,
-        content=json.loads(response.content) if response.success else {},
-    )
+    response = get_llm_response_openai(
+        prompt, model, updated_args, _structured_system_prompt(system))
+    return _structured_response(response, out_schema)
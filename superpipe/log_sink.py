@@ -0,0 +1,355 @@
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+from superpipe.transport import get_requests_session, get_transport_config
+
+# maximum seconds between attempts to re-send spilled records while the endpoint is down
+MAX_RESEND_BACKOFF = 60.0
+
+
+def _json_default(obj):
+    # numpy scalars and arrays, pandas timestamps etc.
+    if hasattr(obj, "item"):
+        try:
+            return obj.item()
+        except (ValueError, TypeError):
+            pass
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    return str(obj)
+
+
+@dataclass
+class LogSinkStatistics:
+    num_logged: int = 0
+    num_sent: int = 0
+    num_dropped: int = 0
+    num_spilled: int = 0
+    num_failed_batches: int = 0
+
+
+class LogSink:
+    """
+    Ships row-level logs to an HTTP endpoint in batches from a background thread, so logging
+    doesn't add to per-row latency and a slow or unavailable log server doesn't stall the pipeline.
+
+    Records are buffered in a bounded queue. When the queue is full, or a batch can't be delivered after
+    max_retries attempts, records are dropped or spilled to a JSON lines file, depending on overflow.
+    Spilled records are re-sent in batches while the sink is idle, backing off while the endpoint is down.
+    Pending records are flushed on exit.
+
+    Each batch is sent as a POST with a JSON body of the form {"records": [...]}.
+
+    Attributes:
+        url (str): The endpoint to POST batches to.
+        api_key (str, optional): Sent as a bearer token in the Authorization header.
+        batch_size (int): Maximum number of records per request.
+        flush_interval (float): Maximum number of seconds a record waits before its batch is sent.
+        max_queue_size (int): Maximum number of records buffered in memory.
+        overflow (str): What to do with records that can't be buffered or delivered, "drop" or "spill".
+        spill_path (str, optional): The JSON lines file records are spilled to.
+        max_retries (int): Number of attempts to deliver a batch.
+        statistics (LogSinkStatistics): Counts of logged, sent, dropped and spilled records.
+    """
+
+    def __init__(self,
+                 url: str,
+                 api_key: Optional[str] = None,
+                 batch_size: int = 100,
+                 flush_interval: float = 1.0,
+                 max_queue_size: int = 10000,
+                 overflow: str = "drop",
+                 spill_path: Optional[str] = None,
+                 max_retries: int = 3):
+        if overflow not in ("drop", "spill"):
+            raise ValueError("overflow must be one of 'drop' or 'spill'")
+        if overflow == "spill" and spill_path is None:
+            raise ValueError("spill_path must be set when overflow is 'spill'")
+        self.url = url
+        self.api_key = api_key
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.max_retries = max_retries
+        self.statistics = LogSinkStatistics()
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._spill_lock = threading.Lock()
+        # byte offset in the spill file being re-sent up to which records were delivered
+        self._resend_offset = 0
+        self._resend_backoff = flush_interval
+        # time.monotonic() before which spilled records aren't re-sent
+        self._resend_after = 0.0
+        self._closed = threading.Event()
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def log(self, record: Dict):
+        """
+        Enqueues a record to be shipped. Never blocks.
+
+        Args:
+            record (Dict): A JSON serializable record.
+        """
+        self.statistics.num_logged += 1
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._overflow([record])
+
+    def with_logging(self, run_steps: Callable, pipeline, **extra):
+        """
+        Wraps a pipeline's per-row function so each processed row is logged.
+
+        Args:
+            run_steps (Callable): The function that runs all steps on a row.
+            pipeline (Pipeline): The pipeline being run.
+            **extra: Additional fields to include in each record, e.g. experiment_id.
+
+        Returns:
+            Callable: The wrapped function.
+        """
+        row_record = self.row_recorder(pipeline, **extra)
+
+        def run_steps_with_logging(row, *args):
+            row = run_steps(row, *args)
+            self.log(row_record(row))
+            return row
+        return run_steps_with_logging
+
+    def row_recorder(self, pipeline, **extra) -> Callable[[Any], Dict]:
+        """
+        Returns a function that builds the record of a row the pipeline processed.
+        """
+        group_id = pipeline.fingerprint()
+
+        def row_record(row) -> Dict:
+            return {
+                "pipeline": pipeline.name,
+                "group_id": group_id,
+                "timestamp": time.time(),
+                **extra,
+                "data": dict(row),
+            }
+        return row_record
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until all enqueued records have been sent, dropped or spilled.
+
+        Args:
+            timeout (float, optional): Maximum number of seconds to wait.
+
+        Returns:
+            bool: True if the queue was fully drained.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks > 0 and self._worker.is_alive():
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return self._queue.unfinished_tasks == 0
+
+    def close(self, timeout: Optional[float] = 10.0):
+        """
+        Flushes pending records and stops the background thread.
+        """
+        if self._closed.is_set():
+            return
+        self.flush(timeout)
+        self._closed.set()
+        self._worker.join(timeout=self.flush_interval + 1)
+
+    def _next_batch(self) -> List[Dict]:
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _work(self):
+        while not self._closed.is_set():
+            batch = self._next_batch()
+            if batch:
+                if not self._send(batch):
+                    self._overflow(batch)
+                for _ in batch:
+                    self._queue.task_done()
+            else:
+                self._resend_spilled()
+
+    def _send(self, records: List[Dict]) -> bool:
+        headers = {"Content-Type": "application/json"}
+        if self.api_key is not None:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        body = json.dumps({"records": records}, default=_json_default)
+        session = get_requests_session("studio")
+        if self._with_retries(lambda: session.post(
+                self.url, data=body, headers=headers,
+                timeout=get_transport_config("studio").requests_timeout()).ok):
+            self.statistics.num_sent += len(records)
+            return True
+        self.statistics.num_failed_batches += 1
+        return False
+
+    def _with_retries(self, send: Callable[[], bool]) -> bool:
+        for attempt in range(self.max_retries):
+            try:
+                if send():
+                    return True
+            except Exception:
+                pass
+            if attempt < self.max_retries - 1:
+                time.sleep(min(2 ** attempt * 0.1, 5))
+        return False
+
+    def _overflow(self, records: List[Dict]):
+        if self.overflow == "drop":
+            self.statistics.num_dropped += len(records)
+            return
+        self._spill(records)
+        self.statistics.num_spilled += len(records)
+
+    def _spill(self, records: List[Dict]):
+        with self._spill_lock:
+            with open(self.spill_path, "a") as f:
+                for record in records:
+                    f.write(json.dumps(record, default=_json_default) + "\n")
+
+    def _resend_spilled(self):
+        """
+        Re-sends spilled records while the sink is idle, one batch at a time. The spill file is first moved
+        aside, so new spills go to a fresh file, and is read from the end of the last delivered batch, so a
+        large file is never loaded at once or rewritten. While the endpoint is down, attempts back off.
+        """
+        if self.spill_path is None or time.monotonic() < self._resend_after:
+            return
+        sending = self.spill_path + ".sending"
+        if not os.path.exists(sending):
+            with self._spill_lock:
+                if not os.path.exists(self.spill_path):
+                    return
+                os.replace(self.spill_path, sending)
+            self._resend_offset = 0
+        with open(sending, "rb") as f:
+            f.seek(self._resend_offset)
+            while not self._closed.is_set():
+                batch = []
+                while len(batch) < self.batch_size:
+                    line = f.readline()
+                    if not line:
+                        break
+                    if line.strip():
+                        batch.append(json.loads(line))
+                if not batch:
+                    break
+                if not self._send(batch):
+                    # the endpoint is still down, try again from the same batch later
+                    self._resend_after = time.monotonic() + self._resend_backoff
+                    self._resend_backoff = min(
+                        self._resend_backoff * 2, MAX_RESEND_BACKOFF)
+                    return
+                self._resend_offset = f.tell()
+                self._resend_backoff = self.flush_interval
+                if not self._queue.empty():
+                    # new records go first, the rest of the file is sent the next time the sink is idle
+                    return
+            else:
+                return
+        os.remove(sending)
+        self._resend_offset = 0
+
+
+class StudioLogSink(LogSink):
+    """
+    A LogSink that ships rows to Superpipe Studio, through the same Studio API calls as
+    `enable_logging=True` and `run_experiment`, so logging doesn't add a Studio request to each row.
+    Requires the `superpipe-studio` package.
+
+    Studio takes one row per request, so each record of a batch is sent on its own. A row logged with an
+    experiment_id is inserted into that experiment, any other row into the pipeline's logs.
+    Takes the keyword arguments of LogSink, except url.
+    """
+
+    def __init__(self, **kwargs):
+        from studio.urls import superpipe_studio_url
+        super().__init__(url=superpipe_studio_url, **kwargs)
+
+    def row_recorder(self, pipeline, experiment_id: Optional[str] = None) -> Callable[[Any], Dict]:
+        from studio.logs import get_steps
+        # computed once per run rather than for every row
+        fingerprint = pipeline.fingerprint(deep=True)
+        parameters = pipeline.get_params()
+        evaluation_column = None if pipeline.evaluation_fn is None \
+            else f"__{pipeline.evaluation_fn.__name__}__"
+        # the columns the pipeline added, which aren't logged as inputs
+        output_columns = {field for step in pipeline.steps for field in step.output_fields()} | \
+            {f"__{step.name}__" for step in pipeline.steps} | {evaluation_column}
+
+        def row_record(row) -> Dict:
+            record = {
+                "steps": get_steps(pipeline, row),
+                "final_output_columns": pipeline.output_fields,
+                "accuracy": None if evaluation_column is None else row.get(evaluation_column),
+            }
+            if experiment_id is not None:
+                return {**record, "experiment_id": experiment_id, "dataset_row_fingerprint": row.name}
+            return {
+                **record,
+                "inputs": [{"name": k, "value": str(v)} for k, v in row.items() if k not in output_columns],
+                "fingerprint": fingerprint,
+                "name": pipeline.name,
+                "parameters": parameters,
+            }
+        return row_record
+
+    def _send(self, records: List[Dict]) -> bool:
+        for i, record in enumerate(records):
+            # numpy scalars etc. aren't JSON serializable by Studio's client
+            record = json.loads(json.dumps(record, default=_json_default))
+            if not self._with_retries(lambda: self._insert(dict(record))):
+                self.statistics.num_failed_batches += 1
+                if i == 0:
+                    return False
+                # the rows before it were delivered, only the rest can't be
+                self._overflow(records[i:])
+                return True
+            self.statistics.num_sent += 1
+        return True
+
+    def _insert(self, record: Dict) -> bool:
+        from studio import experiment_insert, insert_log
+        if "experiment_id" in record:
+            # raises if Studio doesn't accept the row
+            experiment_insert(id=record.pop("experiment_id"), **record)
+            return True
+        return insert_log(**record).is_success
+
+
+_studio_log_sink = None
+_studio_log_sink_lock = threading.Lock()
+
+
+def studio_log_sink() -> StudioLogSink:
+    """
+    Returns the StudioLogSink used by `pipeline.run(enable_logging=True)`, creating it on first use.
+    """
+    global _studio_log_sink
+    with _studio_log_sink_lock:
+        if _studio_log_sink is None:
+            _studio_log_sink = StudioLogSink()
+        return _studio_log_sink
@@ -0,0 +1,250 @@
+import time
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional
+from superpipe.concurrency import concurrency_limits
+
+# the metrics of the runs the current context is part of, updated by their steps and LLM calls.
+# A ContextVar, so concurrent pipelines in other threads don't record into each other's metrics.
+_active_metrics: ContextVar[tuple] = ContextVar("active_metrics", default=())
+
+
+class RunMetrics:
+    """
+    Live progress and throughput metrics for a pipeline run.
+
+    Metrics are updated incrementally as each step finishes a row, and can be read at any time with
+    `snapshot()`, pushed to a callback every `interval` seconds, or scraped in Prometheus text format
+    from a local HTTP server started with `serve()`.
+
+    Attributes:
+        callback (Callable[[Dict], None], optional): Called with a snapshot every interval seconds while the
+            run is in progress, and once when it finishes.
+        interval (float): Seconds between callback invocations.
+        window (float): Seconds of history used to compute the current rows/sec.
+    """
+
+    def __init__(self,
+                 callback: Optional[Callable[[Dict], None]] = None,
+                 interval: float = 5.0,
+                 window: float = 60.0):
+        self.callback = callback
+        self.interval = interval
+        self.window = window
+        self._lock = threading.Lock()
+        self._server = None
+        self._stop = threading.Event()
+        self.reset()
+
+    def reset(self, total_rows: Optional[int] = None, last_step: Optional[str] = None):
+        with self._lock:
+            self.total_rows = total_rows
+            self.last_step = last_step
+            self.start_time = time.time()
+            self.end_time = None
+            self.rows_completed = 0
+            self.step_rows = 0
+            self.step_failures = 0
+            self.in_flight = 0
+            self.input_tokens = defaultdict(int)
+            self.output_tokens = defaultdict(int)
+            self.cost = defaultdict(float)
+            self._completions = deque()
+
+    def record_step_row(self, step, statistics):
+        """
+        Records the statistics of a step that finished processing a row. Tokens and cost are attributed to
+        the models that served the row's calls, e.g. a router's fallback or a structuring model, when the
+        statistics record them, and to the step's model otherwise.
+        """
+        model = getattr(step, "model", None) or "none"
+        input_tokens = statistics.input_tokens_by_model or {model: statistics.input_tokens}
+        output_tokens = statistics.output_tokens_by_model or {model: statistics.output_tokens}
+        cost = statistics.cost_by_model or {model: statistics.input_cost + statistics.output_cost}
+        with self._lock:
+            self.step_rows += 1
+            if not statistics.success:
+                self.step_failures += 1
+            for model, tokens in input_tokens.items():
+                self.input_tokens[model] += tokens
+            for model, tokens in output_tokens.items():
+                self.output_tokens[model] += tokens
+            for model, model_cost in cost.items():
+                self.cost[model] += model_cost
+            if step.name == self.last_step:
+                self.rows_completed += 1
+                now = time.time()
+                self._completions.append(now)
+                while self._completions and self._completions[0] < now - self.window:
+                    self._completions.popleft()
+
+    def snapshot(self) -> Dict:
+        """
+        Returns the current value of every metric.
+        """
+        with self._lock:
+            now = self.end_time or time.time()
+            elapsed = max(now - self.start_time, 1e-9)
+            recent = [t for t in self._completions if t >= now - self.window]
+            window = min(self.window, elapsed)
+            rows_per_sec = len(recent) / window if window > 0 else 0.0
+            total_cost = sum(self.cost.values())
+            remaining = None if self.total_rows is None \
+                else max(self.total_rows - self.rows_completed, 0)
+            eta = None
+            if remaining is not None and rows_per_sec > 0:
+                eta = remaining / rows_per_sec
+            return {
+                "rows_total": self.total_rows,
+                "rows_completed": self.rows_completed,
+                "rows_per_sec": rows_per_sec,
+                "rows_per_sec_avg": self.rows_completed / elapsed,
+                "in_flight_requests": self.in_flight,
+                "concurrency_limits": concurrency_limits(),
+                "error_rate": self.step_failures / self.step_rows if self.step_rows else 0.0,
+                "input_tokens": dict(self.input_tokens),
+                "output_tokens": dict(self.output_tokens),
+                "cost": dict(self.cost),
+                "cost_per_sec": total_cost / elapsed,
+                "elapsed_seconds": elapsed,
+                "eta_seconds": eta,
+            }
+
+    def to_prometheus(self) -> str:
+        """
+        Renders the current metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def gauge(name, help, value, labels=None):
+            if value is None:
+                return
+            label_str = "" if not labels else \
+                "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+            if not any(line.startswith(f"# TYPE superpipe_{name} ") for line in lines):
+                lines.append(f"# HELP superpipe_{name} {help}")
+                lines.append(f"# TYPE superpipe_{name} gauge")
+            lines.append(f"superpipe_{name}{label_str} {value}")
+
+        gauge("rows_total", "Number of rows in the run.", snapshot["rows_total"])
+        gauge("rows_completed", "Number of rows that finished all steps.",
+              snapshot["rows_completed"])
+        gauge("rows_per_second", "Rows completed per second over the recent window.",
+              snapshot["rows_per_sec"])
+        gauge("in_flight_requests", "Number of provider requests in flight.",
+              snapshot["in_flight_requests"])
+        gauge("error_rate", "Fraction of step rows that failed.",
+              snapshot["error_rate"])
+        for provider, limit in snapshot["concurrency_limits"].items():
+            gauge("concurrency_limit", "Adaptive limit on requests in flight.",
+                  limit, {"provider": provider})
+        for model, tokens in snapshot["input_tokens"].items():
+            gauge("input_tokens", "Input tokens used.", tokens, {"model": model})
+        for model, tokens in snapshot["output_tokens"].items():
+            gauge("output_tokens", "Output tokens used.", tokens, {"model": model})
+        for model, cost in snapshot["cost"].items():
+            gauge("cost_dollars", "Cost in dollars.", cost, {"model": model})
+        gauge("cost_dollars_per_second", "Cost burn rate in dollars per second.",
+              snapshot["cost_per_sec"])
+        gauge("eta_seconds", "Estimated seconds until the run completes.",
+              snapshot["eta_seconds"])
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int = 9464, host: str = "127.0.0.1"):
+        """
+        Serves the metrics in Prometheus text format at http://host:port/metrics from a background thread.
+
+        Returns:
+            int: The port the server is listening on (useful when port=0).
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_port
+
+    def shutdown(self):
+        """
+        Stops the metrics server if it's running.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _report(self):
+        while not self._stop.wait(self.interval):
+            self.callback(self.snapshot())
+
+    @contextmanager
+    def track(self, total_rows: Optional[int] = None, last_step: Optional[str] = None):
+        """
+        Activates the metrics for the duration of a run, so steps and LLM calls update them.
+
+        Args:
+            total_rows (int, optional): Number of rows in the run, used for the ETA.
+            last_step (str, optional): Name of the last step; a row is complete when this step finishes it.
+        """
+        self.reset(total_rows, last_step)
+        self._stop.clear()
+        reporter = None
+        if self.callback is not None:
+            reporter = threading.Thread(target=self._report, daemon=True)
+            reporter.start()
+        token = _active_metrics.set(_active_metrics.get() + (self,))
+        try:
+            yield self
+        finally:
+            _active_metrics.reset(token)
+            with self._lock:
+                self.end_time = time.time()
+            self._stop.set()
+            if reporter is not None:
+                reporter.join()
+                self.callback(self.snapshot())
+
+
+def record_step_row(step, statistics):
+    """
+    Records a finished step row on every active RunMetrics.
+    """
+    for metrics in _active_metrics.get():
+        metrics.record_step_row(step, statistics)
+
+
+@contextmanager
+def track_request():
+    """
+    Counts a provider request as in flight on every active RunMetrics for the duration of the block.
+    """
+    active = _active_metrics.get()
+    for metrics in active:
+        with metrics._lock:
+            metrics.in_flight += 1
+    try:
+        yield
+    finally:
+        for metrics in active:
+            with metrics._lock:
+                metrics.in_flight -= 1
@@ -0,0 +1,391 @@
+import re
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from superpipe.tokenizer import count_tokens
+
+FILLER_WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+
+
+def constant(value: float) -> Callable[[random.Random], float]:
+    return lambda rng: value
+
+
+def uniform(low: float, high: float) -> Callable[[random.Random], float]:
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal(median: float, sigma: float = 0.5) -> Callable[[random.Random], float]:
+    """
+    A long-tailed distribution, a good fit for LLM latencies. `median` is in the same unit as the samples.
+    """
+    import math
+    mu = math.log(median)
+    return lambda rng: rng.lognormvariate(mu, sigma)
+
+
+def _as_distribution(value):
+    return value if callable(value) else constant(value)
+
+
+class MockLLMServer:
+    """
+    A local server that speaks the OpenAI chat completions and Anthropic messages APIs, for running
+    pipelines and benchmarks offline and deterministically.
+
+    Latency, output token counts and failures are drawn from seeded distributions, so a run is
+    reproducible for a given seed and request order. Prompt token counts are computed locally with
+    `superpipe.tokenizer.count_tokens`.
+
+    Args:
+        host (str): The host to bind to.
+        port (int): The port to bind to, 0 picks a free port.
+        latency (float or Callable[[random.Random], float]): Seconds to wait before responding, either
+            a constant or a distribution like `lognormal(0.5)`.
+        output_tokens (int or Callable[[random.Random], float]): Number of completion tokens reported.
+        error_rate (float): Fraction of requests that fail with a 500 error.
+        rate_limit_rate (float): Fraction of requests that fail with a 429 error.
+        content (str, dict or Callable[[Dict], Union[str, dict]], optional): The response content, or a
+            function of the request body returning it. Dicts are serialized as JSON. Defaults to filler
+            text, wrapped in a JSON object when the request asks for JSON.
+        seed (int): Seed for the latency, token count and error distributions.
+        token_latency (float): Seconds between the chunks of a streamed response. The first chunk is sent after
+            `latency`.
+        cache_min_tokens (int): Simulates the providers' prompt caches for prompt prefixes of at least this many
+            tokens: the system messages of OpenAI requests, and the system blocks marked with `cache_control`
+            of Anthropic requests. Repeated prefixes are reported as cached tokens in the usage.
+    """
+
+    def __init__(
+            self,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            latency: Union[float, Callable[[random.Random], float]] = 0.0,
+            output_tokens: Union[int, Callable[[random.Random], float]] = 20,
+            error_rate: float = 0.0,
+            rate_limit_rate: float = 0.0,
+            content: Optional[Union[str, dict, Callable[[Dict], Union[str, dict]]]] = None,
+            seed: int = 0,
+            token_latency: float = 0.0,
+            cache_min_tokens: int = 1024):
+        self.host = host
+        self.port = port
+        self.latency = _as_distribution(latency)
+        self.output_tokens = _as_distribution(output_tokens)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.content = content
+        self.seed = seed
+        self.token_latency = token_latency
+        self.cache_min_tokens = cache_min_tokens
+        self.num_requests = 0
+        self._cached_prefixes = set()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self) -> "MockLLMServer":
+        """
+        Starts serving in a background thread.
+        """
+        self._server = ThreadingHTTPServer((self.host, self.port), _handler(self))
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def register(self, models: List[str], pricing: Optional[Tuple[float, float]] = None):
+        """
+        Points the given models at this server. Anthropic models are served through the Anthropic
+        client (which points every Claude model at the server), other models are registered as
+        OpenAI-compatible models with `set_client_for_model`.
+
+        Args:
+            models (List[str]): The model names.
+            pricing (Tuple[float, float], optional): Input and output cost per 1M tokens to use for the models.
+        """
+        from superpipe.clients import set_client_for_model, init_anthropic
+        from superpipe.models import claude3_haiku, claude3_sonnet, claude3_opus, set_pricing
+        claude_models = [m for m in models if m in (claude3_haiku, claude3_sonnet, claude3_opus)]
+        if claude_models:
+            init_anthropic("mock", base_url=self.url)
+            if pricing is not None:
+                set_pricing({model: pricing for model in claude_models})
+        for model in models:
+            if model not in claude_models:
+                set_client_for_model(model, "mock", f"{self.url}/v1", pricing=pricing, provider="mock")
+
+    def _sample(self):
+        with self._lock:
+            self.num_requests += 1
+            latency = max(0.0, self.latency(self._rng))
+            output_tokens = max(1, int(self.output_tokens(self._rng)))
+            failure = self._rng.random()
+        if failure < self.rate_limit_rate:
+            error = 429
+        elif failure < self.rate_limit_rate + self.error_rate:
+            error = 500
+        else:
+            error = None
+        return latency, output_tokens, error
+
+    def _cache(self, prefix: str, model: str) -> Tuple[int, bool]:
+        """
+        Returns the number of tokens of a cacheable prompt prefix, 0 if it's too short to be cached, and
+        whether it was already cached.
+        """
+        tokens = count_tokens(prefix, model) if prefix else 0
+        if tokens < self.cache_min_tokens:
+            return 0, False
+        with self._lock:
+            hit = prefix in self._cached_prefixes
+            self._cached_prefixes.add(prefix)
+        return tokens, hit
+
+    def _usage(self, body: Dict, path: str, model: str, output_tokens: int) -> Dict:
+        input_tokens = count_tokens(_prompt_text(body), model)
+        if path == "/v1/messages":
+            system = body.get("system")
+            blocks = system if isinstance(system, list) else []
+            marked = [i for i, block in enumerate(blocks) if block.get("cache_control")]
+            prefix = "".join(block.get("text", "") for block in blocks[:marked[-1] + 1]) if marked else ""
+            tokens, hit = self._cache(prefix, model)
+            return {
+                "input_tokens": input_tokens - tokens,
+                "output_tokens": output_tokens,
+                "cache_read_input_tokens": tokens if hit else 0,
+                "cache_creation_input_tokens": 0 if hit else tokens,
+            }
+        prefix = "".join(m.get("content", "") for m in body.get("messages", [])
+                         if m.get("role") == "system" and isinstance(m.get("content"), str))
+        tokens, hit = self._cache(prefix, model)
+        return {
+            "prompt_tokens": input_tokens,
+            "completion_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+            "prompt_tokens_details": {"cached_tokens": tokens if hit else 0},
+        }
+
+    def _content(self, body: Dict, output_tokens: int) -> str:
+        content = self.content
+        if callable(content):
+            content = content(body)
+        if content is None:
+            filler = " ".join(FILLER_WORDS[i % len(FILLER_WORDS)] for i in range(output_tokens))
+            wants_json = body.get("response_format", {}).get("type") in ("json_object", "json_schema") or \
+                "JSON" in _system_text(body.get("system"))
+            content = {"text": filler} if wants_json else filler
+        return content if isinstance(content, str) else json.dumps(content)
+
+
+def _system_text(system) -> str:
+    if isinstance(system, list):
+        return "".join(block.get("text", "") for block in system if isinstance(block, dict))
+    return system or ""
+
+
+def _prompt_text(body: Dict) -> str:
+    parts = [_system_text(body.get("system"))] if body.get("system") else []
+    for message in body.get("messages", []):
+        content = message.get("content", "")
+        if isinstance(content, list):
+            content = "".join(block.get("text", "") for block in content if isinstance(block, dict))
+        parts.append(content)
+    return "\n".join(parts)
+
+
+def _openai_response(model, content, usage):
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": usage,
+    }
+
+
+def _openai_events(model, content, usage, include_usage):
+    id = f"chatcmpl-{uuid.uuid4().hex}"
+
+    def chunk(choices, usage=None):
+        return {"id": id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": choices, "usage": usage}
+    for i, piece in enumerate(_pieces(content)):
+        delta = {"role": "assistant", "content": piece} if i == 0 else {"content": piece}
+        yield None, chunk([{"index": 0, "delta": delta, "finish_reason": None}])
+    yield None, chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+    if include_usage:
+        yield None, chunk([], usage)
+
+
+def _anthropic_events(model, content, usage):
+    output_tokens = usage["output_tokens"]
+    message = {**_anthropic_response(model, "", {**usage, "output_tokens": 1}), "content": [], "stop_reason": None}
+    yield "message_start", {"type": "message_start", "message": message}
+    yield "content_block_start", {"type": "content_block_start", "index": 0,
+                                  "content_block": {"type": "text", "text": ""}}
+    for piece in _pieces(content):
+        yield "content_block_delta", {"type": "content_block_delta", "index": 0,
+                                      "delta": {"type": "text_delta", "text": piece}}
+    yield "content_block_stop", {"type": "content_block_stop", "index": 0}
+    yield "message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                            "usage": {"output_tokens": output_tokens}}
+    yield "message_stop", {"type": "message_stop"}
+
+
+def _pieces(content: str) -> List[str]:
+    # a word per chunk, like the one or few tokens per chunk providers send
+    return re.findall(r"\s*\S+", content) or [content]
+
+
+def _anthropic_response(model, content, usage):
+    return {
+        "id": f"msg_{uuid.uuid4().hex}",
+        "type": "message",
+        "role": "assistant",
+        "model": model,
+        "content": [{"type": "text", "text": content}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": usage,
+    }
+
+
+def _handler(server: MockLLMServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def handle(self):
+            try:
+                super().handle()
+            except (BrokenPipeError, ConnectionResetError):
+                # the client dropped the connection after a response, e.g. it stopped reading a stream early
+                self.close_connection = True
+
+        def _send(self, status, payload, headers={}):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            try:
+                self.end_headers()
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # the client gave up on the request, e.g. it timed out or a hedged request won
+                self.close_connection = True
+
+        def _send_stream(self, events, done: bool = False):
+            """
+            Sends server-sent events, one chunk of the chunked response per event, ending with a
+            `[DONE]` message if `done` is set.
+            """
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            try:
+                self.end_headers()
+                for i, (event, payload) in enumerate(events):
+                    if i > 0 and server.token_latency:
+                        time.sleep(server.token_latency)
+                    data = (f"event: {event}\n" if event else "") + f"data: {json.dumps(payload)}\n\n"
+                    self._write_chunk(data.encode("utf-8"))
+                if done:
+                    self._write_chunk(b"data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # the client stopped reading the stream
+                self.close_connection = True
+
+        def _write_chunk(self, data: bytes):
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def do_POST(self):
+            path = self.path.split("?")[0].rstrip("/")
+            if path not in ("/v1/chat/completions", "/v1/messages"):
+                return self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            latency, output_tokens, error = server._sample()
+            time.sleep(latency)
+            if error == 429:
+                return self._send(429, {"error": {"type": "rate_limit_error", "message": "Mock rate limit"}},
+                                  {"retry-after": "0"})
+            if error == 500:
+                return self._send(500, {"error": {"type": "api_error", "message": "Mock server error"}})
+            model = body.get("model", "mock")
+            usage = server._usage(body, path, model, output_tokens)
+            content = server._content(body, output_tokens)
+            if body.get("stream"):
+                if path == "/v1/messages":
+                    return self._send_stream(_anthropic_events(model, content, usage))
+                include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+                return self._send_stream(_openai_events(model, content, usage, include_usage), done=True)
+            if path == "/v1/messages":
+                return self._send(200, _anthropic_response(model, content, usage))
+            return self._send(200, _openai_response(model, content, usage))
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a mock OpenAI/Anthropic chat server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Median latency in seconds.")
+    parser.add_argument("--latency-sigma", type=float, default=0.0,
+                        help="Sigma of a lognormal latency distribution, 0 for a constant latency.")
+    parser.add_argument("--output-tokens", type=int, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--token-latency", type=float, default=0.0,
+                        help="Seconds between the chunks of a streamed response.")
+    parser.add_argument("--cache-min-tokens", type=int, default=1024,
+                        help="Minimum length of a prompt prefix that's reported as cached when repeated.")
+    args = parser.parse_args()
+    latency = lognormal(args.latency, args.latency_sigma) \
+        if args.latency > 0 and args.latency_sigma > 0 else args.latency
+    mock = MockLLMServer(args.host, args.port, latency, args.output_tokens,
+                         args.error_rate, args.rate_limit_rate, seed=args.seed,
+                         token_latency=args.token_latency, cache_min_tokens=args.cache_min_tokens).start()
+    print(f"Mock LLM server listening on {mock.url}")
+    try:
+        mock._thread.join()
+    except KeyboardInterrupt:
+        mock.stop()
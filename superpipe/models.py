@@ -28,16 +28,42 @@ _pricing = {
 }
 
 
+# price of cached prompt tokens as a fraction of the input price (cache reads, cache writes).
+# Models that aren't listed are charged the full input price for both.
+_cache_pricing = {
+    gpt4o: (0.5, 1),
+    claude3_opus: (0.1, 1.25),
+    claude3_sonnet: (0.1, 1.25),
+    claude3_haiku: (0.1, 1.25)
+}
+
+
 def set_pricing(pricing: Dict[str, Tuple[float, float]]):
     global _pricing
     _pricing.update(pricing)
 
 
-def get_cost(prompt_tokens: int, completion_tokens: int, model: str):
+def set_cache_pricing(pricing: Dict[str, Tuple[float, float]]):
+    """
+    Sets the price of cached prompt tokens, as fractions of the input price (cache reads, cache writes).
+    """
+    global _cache_pricing
+    _cache_pricing.update(pricing)
+
+
+def get_cost(prompt_tokens: int, completion_tokens: int, model: str,
+             cached_tokens: int = 0, cache_write_tokens: int = 0):
     """
     Return the cost of a completion based on the number of tokens in the prompt and completion.
+    `prompt_tokens` includes the `cached_tokens` read from the provider's prompt cache and the
+    `cache_write_tokens` written to it, which are priced with the model's cache pricing.
     """
     pricing = _pricing.get(model)
     if not pricing or prompt_tokens is None or completion_tokens is None:
         return (0, 0)
-    return (pricing[0]*prompt_tokens/1e6, pricing[1]*completion_tokens/1e6)
+    cached_tokens = cached_tokens or 0
+    cache_write_tokens = cache_write_tokens or 0
+    read_price, write_price = _cache_pricing.get(model, (1, 1))
+    uncached_tokens = prompt_tokens - cached_tokens - cache_write_tokens
+    input_tokens = uncached_tokens + read_price * cached_tokens + write_price * cache_write_tokens
+    return (pricing[0]*input_tokens/1e6, pricing[1]*completion_tokens/1e6)
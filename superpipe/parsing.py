@@ -0,0 +1,172 @@
+import re
+import json
+from itertools import chain
+from typing import Dict, Iterator, Optional, Tuple, Type
+from pydantic import BaseModel, ValidationError
+from superpipe.pydantic import describe_pydantic_model
+
+# ```json ... ``` blocks, the most common way models wrap JSON in chatty output
+_FENCED = re.compile(r"```(?:json|JSON)?\s*\n?(.*?)```", re.DOTALL)
+# objects tried per output before giving up, so a long output full of braces stays cheap
+_MAX_CANDIDATES = 8
+
+REPAIR_PROMPT = """
+The output below should be a JSON object in the format given below as a Pydantic model schema, but it isn't valid:
+{error}
+
+Output:
+{output}
+
+Format:
+{output_schema}
+
+Return only the corrected JSON object.
+"""
+
+
+class InvalidOutput(ValueError):
+    """
+    Raised when an LLM's output doesn't contain a JSON object matching the expected schema.
+
+    Attributes:
+        output (str): The output that couldn't be parsed.
+    """
+
+    def __init__(self, message: str, output: str):
+        super().__init__(message)
+        self.output = output
+
+
+def _candidates(text: str) -> Iterator[Tuple[str, Optional[Dict]]]:
+    """
+    Yields the substrings of an output that could hold a JSON object, most likely first: the fenced
+    blocks, then each object embedded in surrounding text, already decoded.
+    """
+    for block in _FENCED.findall(text):
+        yield block.strip(), None
+    decoder = json.JSONDecoder()
+    start = text.find("{")
+    tried = 0
+    while start != -1 and tried < _MAX_CANDIDATES:
+        tried += 1
+        try:
+            value, end = decoder.raw_decode(text, start)
+        except ValueError:
+            start = text.find("{", start + 1)
+            continue
+        yield text[start:end], value
+        start = text.find("{", end)
+
+
+def parse_json_output(text: str, out_schema: Optional[Type[BaseModel]] = None) -> Dict:
+    """
+    Parses the JSON object in an LLM's output, validated against a schema if given. The output is first
+    validated as is; if it isn't valid JSON, the object is extracted from a fenced code block or from
+    the text around it. No LLM calls are made.
+
+    Args:
+        text (str): The LLM's output.
+        out_schema (Type[BaseModel], optional): The Pydantic model the object must match.
+
+    Returns:
+        Dict: The object, with the schema's defaults filled in if a schema is given.
+
+    Raises:
+        InvalidOutput: If no JSON object in the output matches the schema.
+    """
+    error = None
+    candidates = _candidates(text)
+    if text.lstrip().startswith("{"):
+        candidates = chain([(text, None)], candidates)
+    for candidate, value in candidates:
+        try:
+            if out_schema is not None:
+                # validating the raw JSON skips building an intermediate dict
+                model = out_schema.model_validate_json(candidate) if value is None \
+                    else out_schema.model_validate(value)
+                return model.model_dump()
+            value = json.loads(candidate) if value is None else value
+            if isinstance(value, dict):
+                return value
+            error = "Output is JSON but not an object"
+        except ValidationError as e:
+            if not any(err["type"] == "json_invalid" for err in e.errors()):
+                # a JSON object that doesn't match the schema is the most useful error to report
+                error = str(e)
+            elif error is None:
+                error = "Output is not valid JSON"
+        except ValueError:
+            if error is None:
+                error = "Output is not valid JSON"
+    raise InvalidOutput(error or "No JSON object found in the output", text)
+
+
+def repair_prompt(output: str, error: str, out_schema: Type[BaseModel]) -> str:
+    """
+    Returns the prompt for a call that fixes an invalid output, quoting the output and what's wrong with it.
+    """
+    return REPAIR_PROMPT.format(error=error, output=output,
+                                output_schema=describe_pydantic_model(out_schema))
+
+
+class StreamingJSONParser:
+    """
+    Finds the first complete JSON object in a streamed output that matches a schema, while the output
+    arrives. Each chunk is scanned once, so the cost is linear in the output length, and an object is only
+    validated once its closing brace arrives.
+
+    Attributes:
+        out_schema (Type[BaseModel], optional): The Pydantic model the object must match.
+        result (Dict, optional): The first matching object, once one was seen.
+    """
+
+    def __init__(self, out_schema: Optional[Type[BaseModel]] = None):
+        self.out_schema = out_schema
+        self.result: Optional[Dict] = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        # the chunks of the object being scanned
+        self._object = []
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Scans the next chunk of output.
+
+        Returns:
+            bool: Whether a complete object matching the schema has been seen.
+        """
+        if self.result is not None:
+            return True
+        start = 0 if self._depth else None
+        for i, char in enumerate(chunk):
+            if self._depth == 0:
+                if char == "{":
+                    self._depth = 1
+                    self._object = []
+                    start = i
+            elif self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._object.append(chunk[start:i + 1])
+                    start = None
+                    try:
+                        self.result = parse_json_output("".join(self._object), self.out_schema)
+                        return True
+                    except InvalidOutput:
+                        # e.g. an example object in the text before the answer
+                        continue
+        if self._depth:
+            self._object.append(chunk[start:])
+        return False
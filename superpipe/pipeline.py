@@ -1,12 +1,29 @@
+from __future__ import annotations
 import pickle
 import hashlib
-from typing import List, Callable, Union, Dict, Optional
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import TYPE_CHECKING, List, Callable, Union, Dict, Optional, Set
 from collections import defaultdict
+from contextlib import ExitStack, nullcontext
 from dataclasses import dataclass, field
-import pandas as pd
-from prettytable import PrettyTable
-from superpipe.steps import Step, LLMStep, LLMStructuredStep, LLMStructuredCompositeStep
+from superpipe.steps import Step
+from superpipe.steps.step import SKIP_FIELD
 from superpipe.config import is_dev, studio_enabled
+from superpipe.util import is_arrow, is_dataframe, is_series
+from superpipe.budget import any_budget_exhausted
+from superpipe.concurrency import concurrency_limits
+from superpipe.timeouts import row_deadline as row_deadline_scope
+from superpipe.estimate import PipelineEstimate, estimate_pipeline
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
+    from superpipe.arrow import ParquetSink
+    from superpipe.log_sink import LogSink, StudioLogSink
+    from superpipe.metrics import RunMetrics
+    from superpipe.budget import Budget
+    from superpipe.scheduler import StageScheduler
 
 
 @dataclass
@@ -14,13 +31,21 @@ class PipelineStatistics:
     score: Optional[float] = None
     input_tokens: dict = field(default_factory=lambda: defaultdict(int))
     output_tokens: dict = field(default_factory=lambda: defaultdict(int))
+    # input tokens read from the providers' prompt caches, included in input_tokens
+    cached_input_tokens: int = 0
     input_cost: float = 0.0
     output_cost: float = 0.0
     num_success: int = 0
     num_failure: int = 0
+    num_skipped: int = 0
     total_latency: float = 0.0
+    hedge_cost: float = 0.0
+    # the adaptive concurrency limit of each provider that has one, when the run finished
+    concurrency_limits: dict = field(default_factory=dict)
+    budget_exhausted: bool = False
 
     def __str__(self):
+        from prettytable import PrettyTable
         table = PrettyTable()
         table.header = False
         if self.score is not None:
@@ -29,15 +54,43 @@ class PipelineStatistics:
             dict(self.input_tokens))], divider=True)
         table.add_row(["output_tokens", str(
             dict(self.output_tokens))], divider=True)
+        if self.cached_input_tokens:
+            table.add_row(["cached_input_tokens", str(
+                self.cached_input_tokens)], divider=True)
         table.add_row(["input_cost", f"${self.input_cost}"], divider=True)
         table.add_row(
             ["output_cost", f"${self.output_cost}"], divider=True)
         table.add_row(["num_success", str(self.num_success)], divider=True)
         table.add_row(["num_failure", str(self.num_failure)], divider=True)
+        if self.num_skipped:
+            table.add_row(["num_skipped", str(self.num_skipped)], divider=True)
         table.add_row(["total_latency", str(self.total_latency)])
+        if self.hedge_cost:
+            table.add_row(["hedge_cost", f"${self.hedge_cost}"])
+        if self.concurrency_limits:
+            table.add_row(["concurrency_limits", str(self.concurrency_limits)])
+        if self.budget_exhausted:
+            table.add_row(["budget_exhausted", "True"])
         return table.get_string()
 
 
+def step_success(metadata) -> bool:
+    # rows that never reached the step (e.g. because a budget was exhausted) have no metadata and count as
+    # failures. Rows the step skipped, or where it fell back to its default output, don't fail.
+    return isinstance(metadata, dict) and bool(
+        metadata.get("success") or metadata.get("fallback") or "skipped" in metadata)
+
+
+def step_skipped(metadata) -> bool:
+    return isinstance(metadata, dict) and "skipped" in metadata
+
+
+def _run_step_row(step: Step, row: Dict):
+    # Step.run applies the step's budget, which running a single row directly skips
+    with step.budget.track() if step.budget is not None else nullcontext():
+        return step._run_row(row)
+
+
 class Pipeline:
     """
     A class representing a pipeline of steps to process data.
@@ -70,11 +123,18 @@ class Pipeline:
         self.score = None
         self.name = name or self.__class__.__name__
         self.statistics = PipelineStatistics()
+        # the indexes of the steps each step depends on, None when no step declares its inputs
+        self.dependencies = self._build_dependencies()
+        # index labels of the rows of the current run that failed in some step (None for a single dict row)
+        self._failed_rows = set()
+        # index labels of the rows of the current run that some step skipped
+        self._skipped_rows = set()
 
-    def run_experiment(self, data, verbose=True, description=None):
+    def run_experiment(self, data, verbose=True, description=None, log_sink: Optional[StudioLogSink] = None):
         def run_steps(row: pd.Series):
             for step in self.steps:
                 step.run(row, verbose)
+            self._record_row(row)
             if self.evaluation_fn is not None:
                 row[f"__{self.evaluation_fn.__name__}__"] = float(self.evaluation_fn(
                     row))
@@ -83,9 +143,13 @@ class Pipeline:
         if not studio_enabled():
             raise ValueError(
                 "Superpipe Studio must be enabled to run experiments")
+        from superpipe.log_sink import StudioLogSink
+        if log_sink is not None and not isinstance(log_sink, StudioLogSink):
+            raise ValueError(
+                "Experiments are logged to Superpipe Studio, so log_sink must be a StudioLogSink")
 
         from studio import run_pipeline_with_experiment, Dataset, create_experiment
-        if isinstance(data, pd.DataFrame):
+        if is_dataframe(data):
             dataset = Dataset(data=data, name=f"{self.name}_dataset")
             print(f"Created dataset {dataset.id}")
         elif isinstance(data, str):
@@ -99,8 +163,14 @@ class Pipeline:
             group_id=self.fingerprint(),
             description=description)
         print(f"Created experiment {experiment_id}")
-        run_steps = run_pipeline_with_experiment(
-            experiment_id, run_steps, self)
+        self._failed_rows = set()
+        self._skipped_rows = set()
+        if log_sink is not None:
+            run_steps = log_sink.with_logging(
+                run_steps, self, experiment_id=experiment_id)
+        else:
+            run_steps = run_pipeline_with_experiment(
+                experiment_id, run_steps, self)
         df = dataset.data.copy()
         if verbose and is_dev:
             from tqdm import tqdm
@@ -114,42 +184,237 @@ class Pipeline:
         return df
 
     def run(self,
-            data: Union[pd.DataFrame, Dict],
+            data: Union[pd.DataFrame, Dict, pa.Table, pa.RecordBatchReader],
             enable_logging=False,
             row_wise=True,
-            verbose=True):
-        def run_steps(row):
-            for step in self.steps:
-                step.run(row, verbose)
-            if self.evaluation_fn is not None:
+            verbose=True,
+            log_sink: Optional[LogSink] = None,
+            metrics: Optional[RunMetrics] = None,
+            budget: Optional[Budget] = None,
+            scheduler: Optional[StageScheduler] = None,
+            row_deadline: Optional[float] = None,
+            sink: Optional[ParquetSink] = None):
+        """
+        Runs the pipeline on a DataFrame, a single row, or a pyarrow Table or RecordBatchReader.
+
+        Args:
+            data (Union[pd.DataFrame, Dict, pa.Table, pa.RecordBatchReader]): The data to run the pipeline on.
+                Arrow data is run one record batch at a time, see `_run_arrow`.
+            enable_logging (bool): Whether to log each row to Superpipe Studio, from a background thread.
+                See `superpipe.log_sink.studio_log_sink`.
+            row_wise (bool): Whether to run all steps on each row before moving to the next row,
+                or each step on all rows before moving to the next step.
+            verbose (bool): Whether to show progress.
+            log_sink (LogSink, optional): Ships each processed row to a log endpoint in the background.
+                Takes the place of `enable_logging`.
+            metrics (RunMetrics, optional): Live progress and throughput metrics, updated as rows finish.
+            budget (Budget, optional): Limits on what the run's LLM calls can spend. Once it's exhausted
+                the remaining rows (or steps, when running step-wise) are skipped.
+            scheduler (StageScheduler, optional): Runs the steps of a DataFrame run as concurrent stages with
+                their own workers and queues, instead of row-wise or step-wise. Rows are passed to steps as dicts.
+            row_deadline (float, optional): Maximum seconds the steps may spend on each row, summed over the
+                steps. Steps that start after it fail on the row, and calls get at most the time left.
+            sink (ParquetSink, optional): With Arrow data, writes the outputs of each record batch to a Parquet
+                file as soon as the batch finishes, instead of returning them.
+
+        Returns:
+            Union[pd.DataFrame, Dict, pa.Table]: The data with the outputs of each step added, as a Table for
+                Arrow data, or None if the outputs were written to `sink`.
+        """
+        if log_sink is None and enable_logging and studio_enabled():
+            from superpipe.log_sink import studio_log_sink
+            log_sink = studio_log_sink()
+        if is_arrow(data):
+            return self._run_arrow(data, sink, enable_logging=enable_logging, row_wise=row_wise,
+                                   verbose=verbose, log_sink=log_sink, metrics=metrics, budget=budget,
+                                   scheduler=scheduler, row_deadline=row_deadline)
+
+        def finish_row(row, index=None):
+            self._record_row(row, index)
+            # the row that exhausted the budget is missing the outputs of the refused call
+            if self.evaluation_fn is not None and not any_budget_exhausted():
                 row[f"__{self.evaluation_fn.__name__}__"] = float(self.evaluation_fn(
                     row))
             return row
 
-        # Note: currently running row-wise is ~40% slower than step-wise (because of memory overhead?)
-        if row_wise:
-            if enable_logging and studio_enabled():
-                from studio import run_pipeline_with_log
-                run_steps = run_pipeline_with_log(run_steps, self)
-            if isinstance(data, pd.DataFrame):
-                if verbose and is_dev:
-                    from tqdm import tqdm
-                    tqdm.pandas(desc=f"Running pipeline row-wise")
-                    results = data.progress_apply(run_steps, axis=1)
-                else:
-                    results = data.apply(run_steps, axis=1)
+        def run_steps(row):
+            if any_budget_exhausted():
+                self._record_row(row)
+                return row
+            if pool is not None:
+                row = self._run_row_concurrently(row, pool)
+            else:
+                for step in self.steps:
+                    # a refused call exhausts the budget mid-row, and the later steps would read its
+                    # missing outputs
+                    if any_budget_exhausted():
+                        break
+                    step.run(row, verbose)
+            return finish_row(row)
+
+        staged = scheduler is not None and is_dataframe(data)
+        self._failed_rows = set()
+        self._skipped_rows = set()
+        with ExitStack() as stack:
+            pool = None
+            self.dependencies = self._build_dependencies()
+            if self.dependencies is not None and row_wise and not staged:
+                self._validate_inputs(data)
+                pool = stack.enter_context(
+                    ThreadPoolExecutor(max_workers=len(self.steps)))
+            if metrics is not None:
+                total_rows = len(data) if is_dataframe(data) else 1
+                stack.enter_context(metrics.track(
+                    total_rows, self.steps[-1].name))
+            if budget is not None:
+                stack.enter_context(budget.track())
+            stack.enter_context(row_deadline_scope(row_deadline))
+            # Note: currently running row-wise is ~35% slower than step-wise, see benchmarks/pipeline.py
+            if staged:
+                import pandas as pd
+                if log_sink is not None:
+                    finish_row = log_sink.with_logging(finish_row, self)
+                rows = scheduler.run(self.steps, data, finish_row, verbose)
+                results = pd.DataFrame(rows, index=data.index)
                 data[results.columns] = results
+            elif row_wise:
+                if log_sink is not None:
+                    run_steps = log_sink.with_logging(run_steps, self)
+                if is_dataframe(data):
+                    if verbose and is_dev:
+                        from tqdm import tqdm
+                        tqdm.pandas(desc=f"Running pipeline row-wise")
+                        results = data.progress_apply(run_steps, axis=1)
+                    else:
+                        results = data.apply(run_steps, axis=1)
+                    data[results.columns] = results
+                else:
+                    run_steps(data)
             else:
-                run_steps(data)
-        else:
-            # logging not supported for step-wise execution
-            for step in self.steps:
-                step.run(data, verbose)
+                for step in self.steps:
+                    if any_budget_exhausted():
+                        break
+                    step.run(data, verbose)
+                    if is_dataframe(data):
+                        self._failed_rows.update(step.failed_rows)
+                        self._skipped_rows.update(step.skipped_rows)
+                if not is_dataframe(data):
+                    self._record_row(data)
+                elif any_budget_exhausted():
+                    # some steps didn't run, so no row got through all of them
+                    self._failed_rows.update(data.index)
+            budget_exhausted = any_budget_exhausted()
 
-        self._evaluate(data)
+        if budget_exhausted:
+            print(
+                f"Pipeline {self.name}: budget exhausted, rows processed so far were kept")
+        # once the budget is exhausted rows may be missing the outputs of skipped steps, so only
+        # keep the scores of the rows that were evaluated as they finished
+        if not budget_exhausted or self._evaluated_per_row(data):
+            self._evaluate(data)
+        else:
+            self.score = None
+        if not row_wise and not staged and log_sink is not None:
+            self._log_rows(data, log_sink)
         self._aggregate_statistics(data)
+        self.statistics.budget_exhausted = budget_exhausted
         return data
 
+    def _run_arrow(self,
+                   data: Union[pa.Table, pa.RecordBatchReader],
+                   sink: Optional[ParquetSink] = None,
+                   metrics: Optional[RunMetrics] = None,
+                   budget: Optional[Budget] = None,
+                   **kwargs) -> Optional[pa.Table]:
+        """
+        Runs the pipeline on a Table or a RecordBatchReader one record batch at a time, so a reader over a
+        large Parquet file never has to fit in memory. Each batch is converted to a DataFrame with
+        Arrow-backed dtypes and run like any other DataFrame, with an index continuing the previous batch's.
+        The `__step__` metadata columns are stored as structs, see `superpipe.arrow.metadata_type`. The
+        score, statistics and row outcomes cover all the batches.
+
+        Returns:
+            pa.Table: The outputs of all the batches, or None if they were written to `sink`.
+        """
+        import pandas as pd
+        import pyarrow as pa
+        from superpipe.arrow import metadata_type, record_batches, to_arrow, to_pandas
+        metadata_columns = [f"__{step.name}__" for step in self.steps]
+        # every column a batch's output may have, so the sink's schema has the columns the first batch
+        # lacks, e.g. the outputs of a step that failed on all of its rows. Output types aren't known
+        # before they're seen, so these are strings.
+        columns = {field: pa.string() for step in self.steps for field in step.output_fields()}
+        columns.update({name: metadata_type() for name in metadata_columns})
+        if any(step.on_failure == "skip_downstream" for step in self.steps):
+            columns[SKIP_FIELD] = pa.string()
+        if self.evaluation_fn is not None:
+            columns[f"__{self.evaluation_fn.__name__}__"] = pa.float64()
+        tables = []
+        failed_rows, skipped_rows = set(), set()
+        num_rows = 0
+        # the scores of the batches weighted by their number of rows, None once a batch has no score
+        score = 0.0
+        with ExitStack() as stack:
+            # the metrics and budget cover the whole run, not a single batch
+            if metrics is not None:
+                total_rows = data.num_rows if isinstance(data, pa.Table) else None
+                stack.enter_context(metrics.track(
+                    total_rows, self.steps[-1].name))
+            if budget is not None:
+                stack.enter_context(budget.track())
+            for batch in record_batches(data):
+                if any_budget_exhausted():
+                    break
+                if batch.num_rows == 0:
+                    continue
+                df = to_pandas(batch)
+                df.index = pd.RangeIndex(num_rows, num_rows + len(df))
+                df = self.run(df, **kwargs)
+                failed_rows |= self._failed_rows
+                skipped_rows |= self._skipped_rows
+                if score is not None and self.evaluation_fn is not None:
+                    score = None if self.score is None else score + \
+                        self.score * len(df)
+                num_rows += len(df)
+                if sink is not None:
+                    sink.write(df, metadata_columns, columns)
+                else:
+                    tables.append(to_arrow(df, metadata_columns))
+            budget_exhausted = any_budget_exhausted()
+
+        self._failed_rows = failed_rows
+        self._skipped_rows = skipped_rows
+        self.score = score / num_rows if self.evaluation_fn is not None and score is not None \
+            and num_rows else None
+        self._aggregate_statistics(None, num_rows)
+        self.statistics.budget_exhausted = budget_exhausted
+        if sink is not None:
+            return None
+        if not tables:
+            return pa.Table.from_batches([], schema=data.schema)
+        # a column that's all null in one batch has a different type than in the others
+        return pa.concat_tables(tables, promote_options="permissive")
+
+    def estimate(self, data: Union[pd.DataFrame, Dict], sample: Optional[int] = None) -> PipelineEstimate:
+        """
+        Estimates the tokens, cost and latency of running the pipeline on data, without calling any provider.
+
+        Args:
+            data (Union[pd.DataFrame, Dict]): The data the pipeline would run on.
+            sample (int, optional): Number of rows to render prompts for. The estimate is scaled up to all rows.
+
+        Returns:
+            PipelineEstimate: The projected tokens, cost and latency.
+        """
+        return estimate_pipeline(self, data, sample)
+
+    def _log_rows(self, data: Union[pd.DataFrame, Dict], log_sink: LogSink):
+        row_record = log_sink.row_recorder(self)
+        rows = (row for _, row in data.iterrows()) if is_dataframe(data) \
+            else [data]
+        for row in rows:
+            log_sink.log(row_record(row))
+
     def fingerprint(self, deep=False):
         fingerprint_obj = {
             "name": self.name,
@@ -174,11 +439,109 @@ class Pipeline:
             step_params = params.get(step.name, {})
             step.update_params({**global_params, **step_params})
 
+    def _build_dependencies(self) -> Optional[List[Set[int]]]:
+        """
+        Builds the dependency DAG of the steps from their declared input fields. A step depends on the
+        latest earlier step that produces each of its inputs, and on every earlier step if it doesn't
+        declare its inputs.
+
+        Returns:
+            Optional[List[Set[int]]]: The indexes of the steps each step depends on, or None if no step
+                declares its inputs.
+        """
+        if all(step.input_fields() is None for step in self.steps):
+            return None
+        produced = [set(step.output_fields()) | {f"__{step.name}__"}
+                    for step in self.steps]
+        dependencies = []
+        for i, step in enumerate(self.steps):
+            inputs = step.input_fields()
+            if inputs is None:
+                dependencies.append(set(range(i)))
+                continue
+            step_dependencies = set()
+            for field in inputs:
+                producers = [j for j in range(i) if field in produced[j]]
+                if producers:
+                    step_dependencies.add(producers[-1])
+                elif any(field in produced[j] for j in range(i + 1, len(self.steps))):
+                    raise ValueError(
+                        f"Step {step.name} reads {field}, which is only produced by a later step")
+            dependencies.append(step_dependencies)
+        # steps that can run at the same time on a row mustn't write the same field
+        ancestors = []
+        for i, step_dependencies in enumerate(dependencies):
+            ancestors.append(set(step_dependencies).union(
+                *[ancestors[j] for j in step_dependencies]))
+            for j in range(i):
+                if j in ancestors[i]:
+                    continue
+                shared = set(self.steps[i].output_fields()) & set(self.steps[j].output_fields())
+                if shared:
+                    raise ValueError(
+                        f"Steps {self.steps[j].name} and {self.steps[i].name} both write {', '.join(sorted(shared))} and don't depend on each other")
+        return dependencies
+
+    def _validate_inputs(self, data: Union[pd.DataFrame, Dict]):
+        """
+        Checks that every declared input is either in the data or produced by an earlier step.
+        """
+        columns = set(data.columns if is_dataframe(data) else data.keys())
+        for i, step in enumerate(self.steps):
+            produced = set().union(
+                *[set(s.output_fields()) | {f"__{s.name}__"} for s in self.steps[:i]])
+            missing = [field for field in step.input_fields() or []
+                       if field not in columns and field not in produced]
+            if missing:
+                raise ValueError(
+                    f"Step {step.name} reads {', '.join(missing)}, which isn't in the data or produced by an earlier step")
+
+    def _run_row_concurrently(self, row: Union[pd.Series, Dict], pool: ThreadPoolExecutor) -> Union[pd.Series, Dict]:
+        """
+        Runs the steps on a row following the dependency DAG, starting each step as soon as the steps
+        it depends on have finished, so independent steps run at the same time. Steps get the row as a dict.
+        """
+        values = row.to_dict() if is_series(row) else row
+        remaining = {i: set(d) for i, d in enumerate(self.dependencies)}
+        running = {}
+        while remaining or running:
+            if any_budget_exhausted():
+                # let the steps already running finish, but don't start any more
+                remaining.clear()
+                if not running:
+                    break
+            ready = [i for i, d in remaining.items() if not d]
+            for i in ready:
+                del remaining[i]
+                # each step gets a snapshot of the row, so it never sees the outputs of the steps running
+                # next to it, and only this thread writes to the row
+                running[pool.submit(contextvars.copy_context().run,
+                                    _run_step_row, self.steps[i], dict(values))] = i
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                step = self.steps[i]
+                result = future.result()
+                values.update(result.fields)
+                values[f"__{step.name}__"] = step._get_metadata(result)
+                for d in remaining.values():
+                    d.discard(i)
+        if is_series(row):
+            import pandas as pd
+            return pd.Series(values, name=row.name)
+        return values
+
+    def _evaluated_per_row(self, data: Union[pd.DataFrame, Dict]) -> bool:
+        if self.evaluation_fn is None:
+            return False
+        column = f"__{self.evaluation_fn.__name__}__"
+        return column in (data.columns if is_dataframe(data) else data)
+
     def _evaluate(self, data: Union[pd.DataFrame, Dict]):
         if not self.evaluation_fn:
             return
         fn_name = self.evaluation_fn.__name__
-        if isinstance(data, pd.DataFrame):
+        if is_dataframe(data):
             if f"__{fn_name}__" in data.columns:
                 results = data[f"__{fn_name}__"]
             else:
@@ -194,33 +557,43 @@ class Pipeline:
                 data[f"__{fn_name}__"] = result
             self.score = result
 
-    def _aggregate_statistics(self, data: Union[pd.DataFrame, Dict]):
+    def _record_row(self, row: Union[pd.Series, Dict], index=None):
+        """
+        Records whether every step succeeded on a row, and whether any step skipped it, as soon as the
+        row finishes. Rows passed as Series are identified by their name, dict rows by `index`.
+        """
+        metadata = [row.get(f"__{step.name}__") for step in self.steps]
+        if not all(step_success(m) for m in metadata):
+            self._failed_rows.add(getattr(row, "name", index))
+        elif any(step_skipped(m) for m in metadata):
+            self._skipped_rows.add(getattr(row, "name", index))
+
+    def _aggregate_statistics(self, data: Union[pd.DataFrame, Dict], num_rows: Optional[int] = None):
+        """
+        Aggregates the statistics the steps and the row outcomes collected while running,
+        without another pass over the data. `num_rows` overrides the number of rows in data.
+        """
         self.statistics = PipelineStatistics()
         if self.score is not None:
             self.statistics.score = self.score
-        if isinstance(data, pd.DataFrame):
-            success = data.apply(lambda x: True, axis=1)
-        else:
-            success = True
         for step in self.steps:
             self.statistics.input_cost += step.statistics.input_cost
             self.statistics.output_cost += step.statistics.output_cost
+            self.statistics.cached_input_tokens += step.statistics.cached_input_tokens
             self.statistics.total_latency += step.statistics.total_latency
-            # TODO: this needs to work for CustomSteps that make LLM calls too
-            if isinstance(step, LLMStep) or isinstance(step, LLMStructuredStep) \
-                    or isinstance(step, LLMStructuredCompositeStep):
-                model = step.model
-                # TODO: this assumed that each step has a unique model which is not true for composite step
-                self.statistics.input_tokens[model] += step.statistics.input_tokens
-                self.statistics.output_tokens[model] += step.statistics.output_tokens
-
-                # TODO: success calculation needs to work for non LLM steps too
-                if isinstance(data, pd.DataFrame):
-                    success = success & data.apply(
-                        lambda x: x[f"__{step.name}__"]["success"], axis=1)
-                    self.statistics.num_success = success.sum()
-                    self.statistics.num_failure = len(
-                        data) - self.statistics.num_success
-                else:
-                    success = success & data[f"__{step.name}__"]["success"]
-                    self.statistics.num_success = 1 if success else 0
+            for model, tokens in step.statistics.input_tokens_by_model.items():
+                self.statistics.input_tokens[model] += tokens
+            for model, tokens in step.statistics.output_tokens_by_model.items():
+                self.statistics.output_tokens[model] += tokens
+        # steps can share a hedge policy
+        hedges = {id(step.hedge): step.hedge for step in self.steps if step.hedge is not None}
+        self.statistics.hedge_cost = sum(
+            hedge.wasted_cost for hedge in hedges.values())
+        self.statistics.concurrency_limits = concurrency_limits()
+        if num_rows is None:
+            num_rows = len(data) if is_dataframe(data) else 1
+        # a row that failed in one step and was skipped by the next counts as a failure
+        self.statistics.num_failure = len(self._failed_rows)
+        self.statistics.num_skipped = len(self._skipped_rows - self._failed_rows)
+        self.statistics.num_success = num_rows - \
+            self.statistics.num_failure - self.statistics.num_skipped
@@ -0,0 +1,119 @@
+from __future__ import annotations
+import time
+import threading
+from collections import defaultdict
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+from superpipe.budget import any_budget_exhausted
+from superpipe.clients import get_client
+from superpipe.models import _pricing, set_pricing
+
+if TYPE_CHECKING:
+    from superpipe.llm import LLMResponse
+
+# routers by the model name they're registered under
+routers: Dict[str, ModelRouter] = {}
+
+
+class ModelRouter:
+    """
+    Routes LLM calls across an ordered list of equivalent models, possibly from different providers
+    (e.g. gpt-4o, an OpenRouter mirror of it, claude-3-sonnet). Each call goes to the first healthy model
+    and fails over to the next one when the model is unavailable: rate limited (429), overloaded (5xx),
+    timed out or unreachable. A model that was unavailable is skipped for `cooldown` seconds, so later rows
+    don't wait for it to fail again. Other failures, e.g. a prompt that's too long or a call refused by a
+    budget, are specific to the call and are returned as is. Models whose provider has no client, e.g.
+    because its api key isn't set, are skipped.
+
+    Register a router with `set_router(name, models)` and use its name as the model of a step. Each call
+    is priced at the model that served it, and the serving model is recorded in the row's metadata
+    (`served_by`). The call's arguments must be accepted by every model in the list.
+
+    Attributes:
+        models (List[str]): The models to route to, in order of preference.
+        cooldown (float): Seconds a model is skipped for after it failed.
+        num_served (Dict[str, int]): Calls served by each model.
+        num_failovers (int): Calls that failed on one model and were sent to the next.
+    """
+
+    def __init__(self, models: List[str], cooldown: float = 30.0):
+        if not models:
+            raise ValueError("A router needs at least one model")
+        self.models = list(models)
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        # model -> time.monotonic() until which it's skipped
+        self._unhealthy_until: Dict[str, float] = {}
+        self.num_served: Dict[str, int] = defaultdict(int)
+        self.num_failovers = 0
+
+    def candidates(self) -> List[str]:
+        """
+        Returns the models to try, in order: healthy models first, then the models in cooldown as a last
+        resort, the ones that recover soonest first.
+        """
+        now = time.monotonic()
+        with self._lock:
+            healthy = [m for m in self.models if self._unhealthy_until.get(m, 0) <= now]
+            cooling = sorted((m for m in self.models if m not in healthy),
+                             key=lambda m: self._unhealthy_until[m])
+        return healthy + cooling
+
+    def call(self, call: Callable[[str], LLMResponse]) -> LLMResponse:
+        """
+        Makes a call, failing over across the models while they're unavailable.
+
+        Args:
+            call (Callable[[str], LLMResponse]): Makes the call to the given model.
+
+        Returns:
+            LLMResponse: The first response that succeeded or failed for another reason than the model being
+                unavailable, or the last one.
+        """
+        candidates = self.candidates()
+        # a model whose provider has no client, e.g. because its api key isn't set, can't serve the call.
+        # If none of them has one, the call fails on the first model as it would without a router.
+        candidates = [m for m in candidates if get_client(m) is not None] or candidates[:1]
+        response = None
+        for i, model in enumerate(candidates):
+            if i > 0:
+                # a refused call exhausts the budget, and the run stops
+                if any_budget_exhausted():
+                    break
+                with self._lock:
+                    self.num_failovers += 1
+            response = call(model)
+            if response.success:
+                with self._lock:
+                    self.num_served[model] += 1
+                    self._unhealthy_until.pop(model, None)
+                return response
+            if not response.unavailable:
+                # the request itself was rejected, and would be by the other models too
+                return response
+            with self._lock:
+                self._unhealthy_until[model] = time.monotonic() + \
+                    self.cooldown
+        return response
+
+
+def set_router(name: str, models: List[str], cooldown: float = 30.0) -> ModelRouter:
+    """
+    Registers a router under a model name. Pipeline estimates use the pricing of the first model.
+
+    Args:
+        name (str): The model name steps use to call the router.
+        models (List[str]): The models to route to, in order of preference.
+        cooldown (float): Seconds a model is skipped for after it failed.
+
+    Returns:
+        ModelRouter: The router.
+    """
+    router = ModelRouter(models, cooldown)
+    routers[name] = router
+    if models[0] in _pricing:
+        set_pricing({name: _pricing[models[0]]})
+    return router
+
+
+def get_router(model: str) -> Optional[ModelRouter]:
+    return routers.get(model)
@@ -0,0 +1,228 @@
+from __future__ import annotations
+import queue
+import threading
+import time
+import contextvars
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Union
+from superpipe.budget import any_budget_exhausted
+from superpipe.config import is_dev
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from superpipe.steps.step import Step
+
+# marks the end of a stage's input
+_STOP = object()
+
+
+@dataclass
+class StageStatistics:
+    """
+    Statistics of one stage (step) of a staged run.
+
+    Attributes:
+        name (str): The name of the step.
+        workers (int): Number of worker threads running the step.
+        queue_depth (int): Rows currently waiting in the stage's input queue.
+        max_queue_depth (int): The largest number of rows that waited in the queue at once.
+        processed (int): Rows the stage has finished.
+        busy_time (float): Seconds the workers spent running the step, summed over workers.
+        utilization (float): busy_time over the time the workers were available. A stage whose
+            utilization is close to 1 is the bottleneck; give it more workers.
+    """
+    name: str
+    workers: int
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    processed: int = 0
+    busy_time: float = 0.0
+    utilization: float = 0.0
+
+
+class _Stage:
+    def __init__(self, step: Step, workers: int, queue_size: int):
+        self.step = step
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.running = workers
+        self.max_queue_depth = 0
+        self.processed = 0
+        self.busy_time = 0.0
+        self.started_at = None
+        self.finished_at = None
+
+    def put(self, item):
+        self.queue.put(item)
+        depth = self.queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+    def statistics(self) -> StageStatistics:
+        started_at = self.started_at or time.perf_counter()
+        elapsed = (self.finished_at or time.perf_counter()) - started_at
+        return StageStatistics(
+            name=self.step.name,
+            workers=self.workers,
+            queue_depth=self.queue.qsize(),
+            max_queue_depth=self.max_queue_depth,
+            processed=self.processed,
+            busy_time=self.busy_time,
+            utilization=self.busy_time / (self.workers * elapsed) if elapsed > 0 else 0.0)
+
+
+class StageScheduler:
+    """
+    Runs a pipeline's steps as concurrent stages. Each step gets its own worker threads and a bounded
+    input queue, and a row moves on to the next step as soon as the previous step finishes it, so a slow
+    step (e.g. SERP enrichment) overlaps with the steps after it instead of holding up every row.
+
+    Pass it to `Pipeline.run(data, scheduler=...)`. Use `statistics()` while or after the pipeline runs
+    to find the bottleneck stage: its queue stays full and its utilization is close to 1.
+
+    Args:
+        workers (Union[int, Dict[str, int]]): Worker threads per stage, either for every stage or per step
+            name. Steps missing from the dict get one worker.
+        queue_size (int): Maximum number of rows waiting in each stage's input queue. When a stage's queue
+            is full, the stage before it waits, which bounds the memory held by rows in flight.
+    """
+
+    def __init__(self, workers: Union[int, Dict[str, int]] = 1, queue_size: int = 100):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._stages: List[_Stage] = []
+
+    def _workers_for(self, step: Step) -> int:
+        if isinstance(self.workers, dict):
+            return self.workers.get(step.name, 1)
+        return self.workers
+
+    def statistics(self) -> List[StageStatistics]:
+        """
+        Returns the statistics of each stage of the current (or last) run.
+        """
+        return [stage.statistics() for stage in self._stages]
+
+    def __str__(self):
+        from prettytable import PrettyTable
+        table = PrettyTable()
+        table.field_names = ["stage", "workers", "queue_depth",
+                             "max_queue_depth", "processed", "utilization"]
+        for s in self.statistics():
+            table.add_row([s.name, s.workers, s.queue_depth, s.max_queue_depth,
+                           s.processed, f"{s.utilization:.0%}"])
+        return table.get_string()
+
+    def run(self,
+            steps: List[Step],
+            data: pd.DataFrame,
+            finish_row: Callable[[Dict, object], Dict],
+            verbose=True) -> List[Dict]:
+        """
+        Runs the steps on every row of a DataFrame.
+
+        Args:
+            steps (List[Step]): The steps to run, in order.
+            data (pd.DataFrame): The data to run the steps on.
+            finish_row (Callable[[Dict, object], Dict]): Called with each finished row and its index label,
+                in the calling thread.
+            verbose (bool): Whether to show progress.
+
+        Returns:
+            List[Dict]: The finished rows, in the order of the DataFrame's rows.
+        """
+        self._stages = [_Stage(step, self._workers_for(step), self.queue_size)
+                        for step in steps]
+        done = queue.Queue()
+        abort = threading.Event()
+        errors = []
+
+        def forward(i, item):
+            if i + 1 < len(self._stages):
+                self._stages[i + 1].put(item)
+            else:
+                done.put(item)
+
+        def work(i):
+            stage = self._stages[i]
+            step = stage.step
+            with step.budget.track() if step.budget is not None else nullcontext():
+                while True:
+                    item = stage.queue.get()
+                    if item is _STOP:
+                        break
+                    position, row = item
+                    if not abort.is_set() and not any_budget_exhausted():
+                        start = time.perf_counter()
+                        try:
+                            result = step._run_with_policies(row)
+                        except Exception as e:
+                            errors.append(e)
+                            abort.set()
+                        else:
+                            with stage.lock:
+                                step._record_result(result)
+                            row.update(result.fields)
+                            row[f"__{step.name}__"] = step._get_metadata(result)
+                        with stage.lock:
+                            stage.busy_time += time.perf_counter() - start
+                    with stage.lock:
+                        stage.processed += 1
+                    forward(i, item)
+            with stage.lock:
+                stage.running -= 1
+                last = stage.running == 0
+            if last:
+                stage.finished_at = time.perf_counter()
+                # the last worker of a stage to finish stops the next stage
+                if i + 1 < len(self._stages):
+                    for _ in range(self._stages[i + 1].workers):
+                        self._stages[i + 1].put(_STOP)
+                else:
+                    done.put(_STOP)
+
+        def feed():
+            for position, row in enumerate(data.to_dict("records")):
+                if abort.is_set():
+                    break
+                self._stages[0].put((position, row))
+            for _ in range(self._stages[0].workers):
+                self._stages[0].put(_STOP)
+
+        threads = [threading.Thread(target=contextvars.copy_context().run, args=(feed,), daemon=True)]
+        for i, stage in enumerate(self._stages):
+            stage.started_at = time.perf_counter()
+            threads += [threading.Thread(target=contextvars.copy_context().run, args=(work, i), daemon=True)
+                        for _ in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+
+        rows: List[Optional[Dict]] = [None] * len(data)
+        index = data.index
+        progress = None
+        if verbose and is_dev:
+            from tqdm import tqdm
+            progress = tqdm(total=len(data), desc="Running pipeline in stages")
+        while True:
+            item = done.get()
+            if item is _STOP:
+                break
+            position, row = item
+            if not abort.is_set():
+                try:
+                    row = finish_row(row, index[position])
+                except Exception as e:
+                    errors.append(e)
+                    abort.set()
+            rows[position] = row
+            if progress is not None:
+                progress.update(1)
+        if progress is not None:
+            progress.close()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return rows
@@ -1,7 +1,32 @@
-from .step import *
-from .embedding_search import *
-from .llm_structured import *
-from .custom import *
-from .serp import *
-from .llm_step import *
-from .llm_structured_composite import *
+import importlib
+
+# Maps each public name to the submodule that defines it. Submodules are imported
+# on first attribute access so that using one step doesn't pull in the
+# dependencies of all the others (e.g. faiss for EmbeddingSearchStep).
+_exports = {
+    "Step": ".step",
+    "StepStatistics": ".step",
+    "StepRowStatistics": ".step",
+    "StepResult": ".step",
+    "EmbeddingSearchStep": ".embedding_search",
+    "LLMStructuredStep": ".llm_structured",
+    "CustomStep": ".custom",
+    "SERPEnrichmentStep": ".serp",
+    "LLMStep": ".llm_step",
+    "LLMStructuredCompositeStep": ".llm_structured_composite",
+}
+
+__all__ = list(_exports.keys())
+
+
+def __getattr__(name):
+    module_name = _exports.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(__all__))
@@ -1,9 +1,13 @@
-from typing import Union, Dict, Callable, TypeVar, Generic
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, List, Sequence, Union, Dict, Callable, TypeVar, Generic, Optional
 from pydantic import BaseModel
-import pandas as pd
-from superpipe.steps.step import Step, StepResult
+from superpipe.config import is_dev
+from superpipe.steps.step import Step, StepResult, StepRowStatistics, SKIP_FIELD
 from superpipe.steps.utils import with_statistics
 
+if TYPE_CHECKING:
+    import pandas as pd
+
 T = TypeVar('T', bound=BaseModel)
 
 
@@ -15,13 +19,22 @@ class CustomStep(Step, Generic[T]):
 
     The output of the transformation must conform to a Pydantic model specified by `out_schema`.
 
+    Instead of a per-row `transform`, a `batch_transform` can be given that takes a chunk of rows
+    (a DataFrame, or a pyarrow RecordBatch with batch_format="arrow") and returns one output per row,
+    for transformations that vectorize or batch well. The chunk's statistics are split evenly across its rows.
+
     Methods:
         _run(row: Union[pd.Series, Dict]) -> Dict: Applies the transformation function to a single row of data and ensures the output matches the defined Pydantic model.
     """
 
+    DEFAULT_CHUNK_SIZE = 1000
+
     def __init__(self,
-                 transform: Callable[[Union[pd.Series, Dict]], Dict],
-                 name: str = None):
+                 transform: Optional[Callable[[Union[pd.Series, Dict]], Dict]] = None,
+                 name: str = None,
+                 batch_transform: Optional[Callable[[Any], Sequence]] = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 batch_format: str = "pandas"):
         """
         Initializes a new instance of the CustomStep class.
 
@@ -31,9 +44,24 @@ class CustomStep(Step, Generic[T]):
             out_schema (T): A Pydantic model that the output of the transform function should conform to.
 
             name (str, optional): An optional name for the step. Defaults to None.
+
+            batch_transform (Callable[[Any], Sequence], optional): Used instead of `transform`. Takes a chunk
+                of rows and returns a sequence (list, Series, numpy or pyarrow array) with one output per row.
+
+            chunk_size (int): The number of rows passed to `batch_transform` at a time.
+
+            batch_format (str): "pandas" to pass chunks as DataFrames, "arrow" to pass them as pyarrow RecordBatches.
         """
+        if (transform is None) == (batch_transform is None):
+            raise ValueError(
+                "Exactly one of transform or batch_transform must be provided")
+        if batch_format not in ("pandas", "arrow"):
+            raise ValueError("batch_format must be 'pandas' or 'arrow'")
         super().__init__(name)
         self.transform = transform
+        self.batch_transform = batch_transform
+        self.chunk_size = chunk_size
+        self.batch_format = batch_format
 
     def get_params(self):
         """
@@ -42,6 +70,13 @@ class CustomStep(Step, Generic[T]):
         Returns:
             Dict: A dictionary of the step's parameters.
         """
+        if self.batch_transform is not None:
+            return {
+                **super().get_params(),
+                "batch_transform": self.batch_transform.__name__,
+                "chunk_size": self.chunk_size,
+                "batch_format": self.batch_format
+            }
         return {
             **super().get_params(),
             "transform": self.transform.__name__
@@ -59,7 +94,110 @@ class CustomStep(Step, Generic[T]):
         Returns:
             Dict: The transformed row, with keys corresponding to the fields defined in the `out_schema` Pydantic model.
         """
-        transform = self.transform
-        transformed, statistics = with_statistics(transform)(row)
+        if self.batch_transform is not None:
+            import pandas as pd
+            outputs, statistics = with_statistics(
+                self._transform_chunk)(pd.DataFrame([row]))
+            transformed = outputs[0] if outputs is not None else None
+        else:
+            transform = self.transform
+            transformed, statistics = with_statistics(transform)(row)
         result = {f"{self.name}": transformed}
         return StepResult(fields=result, statistics=statistics)
+
+    def _transform_chunk(self, chunk: pd.DataFrame) -> list:
+        """
+        Applies batch_transform to a chunk of rows and returns the outputs as a list.
+        """
+        if self.batch_format == "arrow":
+            import pyarrow as pa
+            outputs = self.batch_transform(
+                pa.RecordBatch.from_pandas(chunk, preserve_index=False))
+        else:
+            outputs = self.batch_transform(chunk)
+        if hasattr(outputs, "to_pylist"):
+            outputs = outputs.to_pylist()
+        elif hasattr(outputs, "tolist"):
+            outputs = outputs.tolist()
+        else:
+            outputs = list(outputs)
+        if len(outputs) != len(chunk):
+            raise ValueError(
+                f"Step {self.name}: batch_transform returned {len(outputs)} outputs for {len(chunk)} rows")
+        return outputs
+
+    def _run_rows(self, data: pd.DataFrame, verbose=True) -> List[StepResult]:
+        """
+        Applies the step to a DataFrame, a chunk at a time when there's a batch_transform.
+        """
+        if self.batch_transform is None:
+            return super()._run_rows(data, verbose)
+        chunks = range(0, len(data), self.chunk_size)
+        if verbose and is_dev:
+            from tqdm import tqdm
+            chunks = tqdm(chunks, desc=f"Applying step {self.name}")
+        results = []
+        for start in chunks:
+            chunk_results = self._run_chunk(
+                data.iloc[start:start + self.chunk_size])
+            for result in chunk_results:
+                self._record_result(result)
+            results.extend(chunk_results)
+        return results
+
+    def _run_chunk(self, chunk: pd.DataFrame) -> List[StepResult]:
+        if self.batch_transform is None:
+            return super()._run_chunk(chunk)
+        rows = list(chunk.iterrows()) if self.when is not None or SKIP_FIELD in chunk.columns else None
+        results = [None] * len(chunk)
+        if rows is not None:
+            results = [self._skipped_result(row) for _, row in rows]
+            if all(result is not None for result in results):
+                return results
+            chunk = chunk[[result is None for result in results]]
+        outputs, statistics = with_statistics(self._transform_chunk)(chunk)
+        if outputs is None:
+            outputs = [None] * len(chunk)
+        row_statistics = self._split_statistics(statistics, len(chunk))
+        ran = iter(zip(chunk.iterrows(), outputs, row_statistics))
+        for i, result in enumerate(results):
+            if result is None:
+                (_, row), output, stats = next(ran)
+                results[i] = self._apply_failure_policy(
+                    row, StepResult(fields={self.name: output}, statistics=stats))
+        return results
+
+    @staticmethod
+    def _split_statistics(statistics: StepRowStatistics, n: int) -> List[StepRowStatistics]:
+        """
+        Splits the statistics of a chunk evenly across its n rows. Tokens that don't divide evenly
+        go to the first row, so the per-row statistics add up to the chunk's.
+        """
+        def split(tokens, first):
+            return tokens // n + (tokens % n if first else 0)
+
+        def split_by_model(by_model, first):
+            return {model: split(tokens, first) for model, tokens in by_model.items()} if by_model else None
+
+        def row_statistics(first):
+            return StepRowStatistics(
+                input_tokens=split(statistics.input_tokens, first),
+                output_tokens=split(statistics.output_tokens, first),
+                cached_input_tokens=split(statistics.cached_input_tokens, first),
+                input_tokens_by_model=split_by_model(
+                    statistics.input_tokens_by_model, first),
+                output_tokens_by_model=split_by_model(
+                    statistics.output_tokens_by_model, first),
+                cost_by_model={model: cost / n for model, cost in statistics.cost_by_model.items()}
+                if statistics.cost_by_model else None,
+                success=statistics.success,
+                latency=statistics.latency / n,
+                input_cost=statistics.input_cost / n,
+                output_cost=statistics.output_cost / n,
+                served_by=statistics.served_by,
+                time_to_first_token=statistics.time_to_first_token,
+                tokens_per_second=statistics.tokens_per_second,
+                stopped_early=statistics.stopped_early
+            )
+        rest = row_statistics(first=False)
+        return [row_statistics(first=True)] + [rest] * (n - 1)
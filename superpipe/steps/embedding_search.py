@@ -1,11 +1,13 @@
-from typing import Callable, Union, Dict, List, Optional
-import pandas as pd
-import numpy as np
-from numpy.typing import NDArray
-import faiss
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Union, Dict, List, Optional
 from superpipe.steps.step import Step, StepResult
 from superpipe.steps.utils import with_statistics
 
+if TYPE_CHECKING:
+    import pandas as pd
+    import numpy as np
+    from numpy.typing import NDArray
+
 
 class EmbeddingSearchStep(Step):
     """
@@ -109,12 +111,26 @@ class EmbeddingSearchStep(Step):
         Returns:
             faiss.IndexFlatL2: A FAISS index with added embeddings.
         """
+        import faiss
         embeddings = self.embed_fn(texts)
         d = embeddings.shape[1]
         index = faiss.IndexFlatL2(d)
         index.add(embeddings)
         return index
 
+    def __getstate__(self):
+        # FAISS indexes can't be pickled, workers rebuild the index in _init_worker
+        state = self.__dict__.copy()
+        state["index"] = None
+        return state
+
+    def _init_worker(self):
+        import faiss
+        # one search thread per worker process, the processes provide the parallelism
+        faiss.omp_set_num_threads(1)
+        if self.index is None and self.candidates:
+            self.index = self._create_index(self.candidates)
+
     def _run(self, row: Union[pd.Series, Dict]) -> StepResult:
         def run_search():
             if self.candidates_fn:
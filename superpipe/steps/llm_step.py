@@ -1,8 +1,12 @@
-from typing import Callable, Union, Dict
-import pandas as pd
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Optional, Union, Dict
 from superpipe.steps.step import Step, StepResult, StepRowStatistics
+from superpipe.steps.utils import llm_row_statistics
 from superpipe.llm import get_llm_response, LLMResponse
-from openai.types.chat.completion_create_params import CompletionCreateParamsNonStreaming
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from openai.types.chat.completion_create_params import CompletionCreateParamsNonStreaming
 
 
 class LLMStep(Step):
@@ -16,6 +20,11 @@ class LLMStep(Step):
         prompt (Callable[[Union[Dict, pd.Series]], str]): A function that takes input data and returns a prompt string.
         openai_args (CompletionCreateParamsNonStreaming): Additional arguments to pass to the OpenAI API.
         name (str, optional): The name of the step. Defaults to None.
+        system (str, optional): Static instructions sent as a system message ahead of every prompt.
+        stream (bool): Whether to stream responses, which records the time to first token and tokens per
+            second of each row in its statistics. Defaults to False.
+        max_stream_tokens (int, optional): When streaming, responses are cut off once they're longer than
+            this many tokens.
     """
 
     def __init__(
@@ -23,7 +32,8 @@ class LLMStep(Step):
             model: str,
             prompt: Callable[[Union[Dict, pd.Series]], str],
             openai_args: CompletionCreateParamsNonStreaming = {},
-            name: str = None):
+            name: str = None,
+            system: Optional[str] = None):
         """
         Initializes a new instance of the LLMStep class.
 
@@ -31,11 +41,17 @@ class LLMStep(Step):
             model (str): The identifier of the LLM to be used.
             prompt (Callable[[Union[Dict, pd.Series]], str]): A function that takes input data and returns a prompt string.
             name (str, optional): The name of the step. Defaults to None.
+            system (str, optional): Static instructions sent as a system message ahead of every prompt. Keeping
+                the instructions that don't depend on the row here, instead of in the prompt, gives every call the
+                same prefix, which providers cache.
         """
         super().__init__(name)
         self.model = model
         self.prompt = prompt
         self.openai_args = openai_args
+        self.system = system
+        self.stream = False
+        self.max_stream_tokens = None
 
     def get_params(self):
         """
@@ -44,28 +60,30 @@ class LLMStep(Step):
         Returns:
             Dict: A dictionary of the step's parameters.
         """
-        return {
+        params = {
             **super().get_params(),
             "model": self.model,
             "prompt": self.prompt.__name__,
             "openai_args": self.openai_args
         }
+        # only set when used, so the parameters (and fingerprints) of existing steps don't change
+        if self.system is not None:
+            params["system"] = self.system
+        return params
+
+    def _estimate_calls(self, row, placeholder):
+        prompt = self.prompt(row) if self.system is None else f"{self.system}\n{self.prompt(row)}"
+        return [(self.model, prompt, self.openai_args.get("max_tokens"))]
 
-    def _get_row_statistics(self, response: LLMResponse):
+    def _get_row_statistics(self, response: LLMResponse, model: str = None) -> StepRowStatistics:
         """
         Create a StepRowStatistics object based on the response from the LLM.
 
         Args:
             response (LLMResponse): The response from the LLM.
+            model (str, optional): The model that produced the response. Defaults to the step's model.
         """
-        return StepRowStatistics(
-            input_tokens=response.input_tokens,
-            output_tokens=response.output_tokens,
-            latency=response.latency,
-            success=response.success,
-            input_cost=response.input_cost,
-            output_cost=response.output_cost
-        )
+        return llm_row_statistics(response, model or self.model)
 
     def _run(self, row: Union[pd.Series, Dict]) -> StepResult:
         """
@@ -83,7 +101,8 @@ class LLMStep(Step):
         compiled_prompt = self.prompt(row)
         openai_args = self.openai_args
         try:
-            response = get_llm_response(compiled_prompt, model, openai_args)
+            response = get_llm_response(
+                compiled_prompt, model, openai_args, self.system, self.stream, self.max_stream_tokens)
         except Exception as e:
             # TODO: need better error logging here include stacktrace
             response = LLMResponse(
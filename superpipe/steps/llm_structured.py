@@ -1,11 +1,14 @@
-from typing import Callable, Union, Dict, TypeVar, Generic
-import pandas as pd
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Optional, Union, Dict, TypeVar, Generic
 from pydantic import BaseModel
-from openai.types.chat.completion_create_params import CompletionCreateParamsNonStreaming
-from superpipe.llm import get_structured_llm_response, StructuredLLMResponse
+from superpipe.llm import get_structured_llm_response, StructuredLLMResponse, STRUCTURED_SYSTEM_PROMPT
 from superpipe.pydantic import describe_pydantic_model
 from superpipe.steps.llm_step import LLMStep, StepResult
 
+if TYPE_CHECKING:
+    import pandas as pd
+    from openai.types.chat.completion_create_params import CompletionCreateParamsNonStreaming
+
 T = TypeVar('T', bound=BaseModel)
 
 
@@ -16,6 +19,10 @@ Return your response in the format given below as a Pydantic model schema:
 {output_schema}
 """
 
+SCHEMA_PROMPT = """Return your response in the format given below as a Pydantic model schema:
+{output_schema}
+"""
+
 
 class LLMStructuredStep(LLMStep, Generic[T]):
     """
@@ -29,6 +36,9 @@ class LLMStructuredStep(LLMStep, Generic[T]):
         prompt (Callable[[Union[Dict, pd.Series]], str]): A function that takes input data and returns a prompt string.
         out_schema (T): The Pydantic model that defines the expected structure of the LLM's response.
         name (str, optional): The name of the step. Defaults to None.
+        system (str, optional): Static instructions sent as a system message ahead of every prompt.
+        cache_prefix (bool): Whether the output schema is sent in the system message, after `system`, instead
+            of after the prompt.
         statistics (LLMStepStatistics): Statistics about the LLM calls made by this step.
     """
 
@@ -38,7 +48,9 @@ class LLMStructuredStep(LLMStep, Generic[T]):
             prompt: Callable[[Union[Dict, pd.Series]], str],
             out_schema: T,
             openai_args: CompletionCreateParamsNonStreaming = {},
-            name: str = None):
+            name: str = None,
+            system: Optional[str] = None,
+            cache_prefix: bool = False):
         """
         Initializes a new instance of the LLMStructuredStep class.
 
@@ -47,9 +59,14 @@ class LLMStructuredStep(LLMStep, Generic[T]):
             prompt (Callable[[Union[Dict, pd.Series]], str]): A function that takes input data and returns a prompt string.
             out_schema (T): The Pydantic model that defines the expected structure of the LLM's response.
             name (str, optional): The name of the step. Defaults to None.
+            system (str, optional): Static instructions sent as a system message ahead of every prompt.
+            cache_prefix (bool): Whether to send the output schema in the system message, so that the
+                instructions and schema form a prefix that's the same for every row and gets cached by the
+                provider, and only the prompt varies. Defaults to False.
         """
-        super().__init__(model, prompt, openai_args, name)
+        super().__init__(model, prompt, openai_args, name, system)
         self.out_schema = out_schema
+        self.cache_prefix = cache_prefix
 
     def get_params(self):
         """
@@ -58,10 +75,13 @@ class LLMStructuredStep(LLMStep, Generic[T]):
         Returns:
             Dict: A dictionary of the step's parameters.
         """
-        return {
+        params = {
             **super().get_params(),
             "out_schema": self.out_schema.model_json_schema()
         }
+        if self.cache_prefix:
+            params["cache_prefix"] = True
+        return params
 
     def _compile_structured_prompt(self, input: dict):
         """
@@ -75,9 +95,28 @@ class LLMStructuredStep(LLMStep, Generic[T]):
         """
         prompt = self.prompt
         prompt_main = prompt(input)
+        if self.cache_prefix:
+            return prompt_main
         output_schema = describe_pydantic_model(self.out_schema)
         return BASE_PROMPT.format(prompt_main=prompt_main, output_schema=output_schema)
 
+    def _compile_system_prompt(self) -> Optional[str]:
+        """
+        Compiles the static part of the prompt sent in the system message: the step's instructions and,
+        with `cache_prefix`, the output schema.
+        """
+        if not self.cache_prefix:
+            return self.system
+        schema = SCHEMA_PROMPT.format(
+            output_schema=describe_pydantic_model(self.out_schema))
+        return schema if self.system is None else f"{self.system}\n\n{schema}"
+
+    def _estimate_calls(self, row, placeholder):
+        system = self._compile_system_prompt()
+        prompt = "\n".join(
+            p for p in (STRUCTURED_SYSTEM_PROMPT, system, self._compile_structured_prompt(row)) if p)
+        return [(self.model, prompt, self.openai_args.get("max_tokens"))]
+
     def _run(self, row: Union[pd.Series, Dict]) -> Dict:
         """
         Applies the LLM step to a single row of data.
@@ -96,21 +135,17 @@ class LLMStructuredStep(LLMStep, Generic[T]):
         openai_args = self.openai_args
         try:
             response = get_structured_llm_response(
-                compiled_prompt, model, openai_args)
+                compiled_prompt, model, openai_args, self._compile_system_prompt(), self.out_schema,
+                stream=self.stream, max_stream_tokens=self.max_stream_tokens)
         except Exception as e:
             # TODO: need better error logging here include stacktrace
             response = StructuredLLMResponse(
                 success=False, error=str(e), latency=0)
         statistics = self._get_row_statistics(response)
         result = {}
-        # TODO: how should we handle failure cases
         if response.success:
-            content = response.content
+            # the content was validated against out_schema, so every field is there
             for field in fields:
-                # TODO: handle missing fields instead of printing
-                if field not in content:
-                    print(
-                        f"Step {self.name}: Missing field {field} in response {content}")
-                val = content.get(field)
+                val = response.content.get(field)
                 result[field] = val if val is not None else ""
         return StepResult(fields=result, statistics=statistics, error=response.error, input=compiled_prompt)
@@ -1,16 +1,21 @@
-from typing import Callable, Union, Dict, TypeVar, Generic
-import pandas as pd
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Optional, Union, Dict, TypeVar, Generic
 from pydantic import BaseModel
-from openai.types.chat.completion_create_params import CompletionCreateParamsNonStreaming
 from superpipe.llm import (
     get_structured_llm_response,
     StructuredLLMResponse,
-    get_llm_response)
+    get_llm_response,
+    STRUCTURED_SYSTEM_PROMPT)
+from superpipe.parsing import InvalidOutput, parse_json_output
 from superpipe.pydantic import describe_pydantic_model
-from superpipe.steps.llm_step import LLMStep, StepResult
+from superpipe.steps.llm_step import LLMStep, StepResult, StepRowStatistics
 from superpipe.steps.utils import combine_step_row_statistics
 from superpipe.models import gpt35
 
+if TYPE_CHECKING:
+    import pandas as pd
+    from openai.types.chat.completion_create_params import CompletionCreateParamsNonStreaming
+
 T = TypeVar('T', bound=BaseModel)
 
 
@@ -30,19 +35,26 @@ class LLMStructuredCompositeStep(LLMStep, Generic[T]):
             out_schema: T,
             structured_model: str = gpt35,
             openai_args: CompletionCreateParamsNonStreaming = {},
-            name: str = None):
+            name: str = None,
+            system: Optional[str] = None):
         """
         A pipeline step that uses a structured and an unstructured language model to process data.
         Use this step when the model or provider does not support JSON mode natively.
 
+        When the unstructured LLM's response already contains a JSON object matching `out_schema`, it's used
+        without calling the structured LLM. The rows that took this fast path are counted in `num_fast_path`,
+        the others in `num_structured_calls`, and `fast_path_rate` is the fraction of rows that took it.
+
         Attributes:
             model (str): Identifier for the unstructured LLM.
             prompt (Callable[[Union[Dict, pd.Series]], str]): Function generating the prompt from input data.
             out_schema (T): Pydantic model defining the expected structured output.
             structured_model (str): Identifier for the structured LLM. Defaults to gpt35.
             name (str, optional): Name of the step.
+            system (str, optional): Static instructions sent as a system message ahead of every prompt to the
+                unstructured LLM.
         """
-        super().__init__(model, prompt, openai_args, name)
+        super().__init__(model, prompt, openai_args, name, system)
         self.structured_model = structured_model
         self.out_schema = out_schema
 
@@ -62,9 +74,45 @@ class LLMStructuredCompositeStep(LLMStep, Generic[T]):
         output_schema = describe_pydantic_model(self.out_schema)
         return BASE_PROMPT.format(prompt_main=prompt_main, output_schema=output_schema)
 
+    def _estimate_calls(self, row, placeholder):
+        max_tokens = self.openai_args.get("max_tokens")
+        unstructured = placeholder(self.model, max_tokens)
+        structured_prompt = f"{STRUCTURED_SYSTEM_PROMPT}\n{self._compile_structured_prompt(unstructured)}"
+        return [
+            (self.model, self.prompt(row) if self.system is None else f"{self.system}\n{self.prompt(row)}",
+             max_tokens),
+            (self.structured_model, structured_prompt, max_tokens)
+        ]
+
+    def reset_statistics(self):
+        """
+        Resets the statistics for the step, including the fast path counters.
+        """
+        super().reset_statistics()
+        self.num_fast_path = 0
+        self.num_structured_calls = 0
+
+    @property
+    def fast_path_rate(self) -> Optional[float]:
+        """
+        The fraction of rows whose first response already matched `out_schema`, out of the rows that got one.
+        None before any row got a response.
+        """
+        total = self.num_fast_path + self.num_structured_calls
+        return self.num_fast_path / total if total else None
+
+    def _update_statistics(self, statistics: StepRowStatistics):
+        super()._update_statistics(statistics)
+        if statistics.fast_path is not None:
+            if statistics.fast_path:
+                self.num_fast_path += 1
+            else:
+                self.num_structured_calls += 1
+
     def _run(self, row: Union[pd.Series, Dict]) -> Dict:
         """
-        Processes a single row of data. Does one LLM call to generate an unstructured response and another to structure it.
+        Processes a single row of data. Does one LLM call to generate an unstructured response. If the response
+        is already a JSON object matching `out_schema` it's used as is, otherwise another call structures it.
 
         Args:
             row (Union[pd.Series, Dict]): The input data row.
@@ -78,34 +126,40 @@ class LLMStructuredCompositeStep(LLMStep, Generic[T]):
         openai_args = self.openai_args
         fields = self.out_schema.model_fields.keys()
         compiled_prompt = prompt(row)
+        # statistics of the calls that were made
+        call_statistics = []
+        fast_path = None
         try:
-            response = get_llm_response(compiled_prompt, model, openai_args)
-            statistics_first = self._get_row_statistics(response)
+            response = get_llm_response(
+                compiled_prompt, model, openai_args, self.system, self.stream, self.max_stream_tokens)
+            call_statistics.append(self._get_row_statistics(response))
             if response.success:
-                structured_prompt = self._compile_structured_prompt(
-                    response.content)
-                response = get_structured_llm_response(
-                    structured_prompt, structured_model, openai_args)
-            else:
-                response = StructuredLLMResponse(
-                    success=False, error=response.error, latency=0)
+                try:
+                    content = parse_json_output(response.content, self.out_schema)
+                    response = StructuredLLMResponse(
+                        **response.model_dump(exclude={"content"}), content=content)
+                    fast_path = True
+                except InvalidOutput:
+                    fast_path = False
+                    structured_prompt = self._compile_structured_prompt(
+                        response.content)
+                    response = get_structured_llm_response(
+                        structured_prompt, structured_model, openai_args, out_schema=self.out_schema,
+                        stream=self.stream, max_stream_tokens=self.max_stream_tokens)
+                    call_statistics.append(self._get_row_statistics(
+                        response, structured_model))
         except Exception as e:
             # TODO: need better error logging here include stacktrace
             response = StructuredLLMResponse(
                 success=False, error=str(e), latency=0)
-        # TODO: combine model dumps of both LLM calls
-        statistics_second = self._get_row_statistics(response)
-        statistics = combine_step_row_statistics(
-            [statistics_first, statistics_second])
+        statistics = combine_step_row_statistics(call_statistics) if call_statistics \
+            else StepRowStatistics()
+        statistics.success = response.success
+        statistics.fast_path = fast_path
         result = {}
-        # TODO: how should we handle failure cases
         if response.success:
-            content = response.content
+            # the content was validated against out_schema, so every field is there
             for field in fields:
-                # TODO: handle missing fields instead of printing
-                if field not in content:
-                    print(
-                        f"Step {self.name}: Missing field {field} in response {content}")
-                val = content.get(field)
+                val = response.content.get(field)
                 result[field] = val if val is not None else ""
         return StepResult(fields=result, statistics=statistics, error=response.error, input=compiled_prompt)
@@ -1,10 +1,93 @@
+from __future__ import annotations
 import os
-import requests
 import json
-import pandas as pd
-from typing import Callable, Union, Optional, Dict
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Union, Optional, Dict, List
+from superpipe.cache import DiskCache
+from superpipe.concurrency import adaptive_limit
+from superpipe.metrics import track_request
+from superpipe.tokenizer import count_tokens
 from superpipe.steps.step import Step, StepResult
-from superpipe.steps.utils import with_statistics
+from superpipe.steps.utils import with_statistics, ShouldNotInterrupt
+from superpipe.timeouts import call_limits, call_timeout
+from superpipe.transport import get_requests_session, get_transport_config
+from superpipe.util import is_dataframe
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# sections of a serper.dev response kept when compacting, and the fields kept for each
+DEFAULT_COMPACT_FIELDS = {
+    "answerBox": ["title", "answer", "snippet"],
+    "knowledgeGraph": ["title", "type", "description", "attributes"],
+    "organic": ["title", "link", "snippet"],
+}
+
+
+def compact_search_results(search_results: str,
+                           fields: Dict[str, List[str]] = DEFAULT_COMPACT_FIELDS,
+                           top_n: int = 3,
+                           max_tokens: Optional[int] = None) -> str:
+    """
+    Compacts a serper.dev JSON response so it's cheap to embed in a prompt.
+
+    Keeps only the given sections and fields, and the first top_n items of list sections (e.g. organic results).
+    If max_tokens is set, drops trailing list items and then shortens the longest strings until the result
+    fits the budget, as estimated by a local tokenizer.
+
+    Args:
+        search_results (str): The raw JSON response.
+        fields (Dict[str, List[str]]): Section name to the fields to keep from it.
+        top_n (int): Maximum number of items to keep from each list section.
+        max_tokens (Optional[int]): Token budget for the compacted result.
+
+    Returns:
+        str: The compacted JSON. Responses that aren't JSON objects are returned unchanged.
+    """
+    try:
+        parsed = json.loads(search_results)
+    except (TypeError, ValueError):
+        return search_results
+    if not isinstance(parsed, dict):
+        return search_results
+
+    def pick(obj, keep):
+        return {k: obj[k] for k in keep if k in obj} if isinstance(obj, dict) else obj
+
+    compacted = {}
+    for section, keep in fields.items():
+        value = parsed.get(section)
+        if isinstance(value, list):
+            compacted[section] = [pick(item, keep) for item in value[:top_n]]
+        elif value is not None:
+            compacted[section] = pick(value, keep)
+
+    def dump():
+        return json.dumps(compacted, ensure_ascii=False, separators=(",", ":"))
+
+    if max_tokens is None:
+        return dump()
+    while count_tokens(dump()) > max_tokens:
+        lists = [v for v in compacted.values() if isinstance(v, list) and len(v) > 1]
+        if lists:
+            max(lists, key=len).pop()
+            continue
+        # shorten the longest string value by half
+        longest = None
+        for container in compacted.values():
+            for item in container if isinstance(container, list) else [container]:
+                if not isinstance(item, dict):
+                    continue
+                for k, v in item.items():
+                    if isinstance(v, str) and (longest is None or len(v) > len(longest[0][longest[1]])):
+                        longest = (item, k)
+        if longest is None or len(longest[0][longest[1]]) <= 16:
+            break
+        item, k = longest
+        item[k] = item[k][:len(item[k]) // 2] + "..."
+    return dump()
 
 
 class SERPEnrichmentStep(Step):
@@ -19,16 +102,35 @@ class SERPEnrichmentStep(Step):
             a row of data.
         postprocess (Optional[Callable[[str], str]]): An optional callable for post-processing the search results.
         name (Optional[str]): An optional name for the step.
+        endpoint (str): The serper.dev compatible search endpoint.
+        cache_ttl (Optional[float]): Seconds to cache search results on disk for. None disables caching.
+        concurrency (int): Number of concurrent requests when running on a DataFrame.
+        batch_size (int): Number of queries to send per request when running on a DataFrame.
+        compact (bool): Whether to compact search results before they're stored (see `compact_search_results`).
+        compact_fields (Dict[str, List[str]]): Sections and fields kept when compacting.
+        top_n (int): Number of organic (and other list) results kept when compacting.
+        max_tokens (Optional[int]): Token budget for compacted search results.
 
     Methods:
         _get_search_results(q: str) -> str: Fetches search results for a given query string.
+        _get_search_results_batch(qs: List[str]) -> List[str]: Fetches search results for several queries in one request.
         _run(row: Union[pd.Series, Dict]) -> Dict: Applies the SERP enrichment step to a single row of data.
     """
 
+    DEFAULT_ENDPOINT = "https://google.serper.dev/search"
+
     def __init__(self,
                  prompt: Callable[[Union[pd.Series, Dict]], str],
                  postprocess: Optional[Callable[[str], str]] = None,
-                 name=None):
+                 name=None,
+                 endpoint: Optional[str] = None,
+                 cache_ttl: Optional[float] = None,
+                 concurrency: int = 1,
+                 batch_size: int = 1,
+                 compact: bool = False,
+                 compact_fields: Dict[str, List[str]] = DEFAULT_COMPACT_FIELDS,
+                 top_n: int = 3,
+                 max_tokens: Optional[int] = None):
         """
         Initializes the SERPEnrichmentStep with a prompt function, an optional postprocess function, and an optional name.
 
@@ -37,10 +139,31 @@ class SERPEnrichmentStep(Step):
                 a row of data.
             postprocess (Optional[Callable[[str], str]]): An optional callable for post-processing the search results.
             name (Optional[str]): An optional name for the step.
+            endpoint (Optional[str]): The search endpoint. Defaults to $SERPER_ENDPOINT or serper.dev.
+            cache_ttl (Optional[float]): Seconds to cache search results on disk for, keyed by endpoint and query.
+                Defaults to None (no caching).
+            concurrency (int): Number of concurrent requests when running on a DataFrame. Defaults to 1.
+            batch_size (int): Number of queries to send per request when running on a DataFrame. Defaults to 1.
+            compact (bool): Whether to compact search results to the fields in compact_fields, the top_n list items
+                and the max_tokens budget before postprocessing. Defaults to False.
+            compact_fields (Dict[str, List[str]]): Section name to the fields kept from it when compacting.
+            top_n (int): Number of organic (and other list) results kept when compacting. Defaults to 3.
+            max_tokens (Optional[int]): Token budget for compacted search results. Defaults to None (no budget).
         """
         super().__init__(name)
         self.prompt = prompt
         self.postprocess = postprocess
+        self.endpoint = endpoint or os.environ.get(
+            "SERPER_ENDPOINT", self.DEFAULT_ENDPOINT)
+        self.cache_ttl = cache_ttl
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.compact = compact
+        self.compact_fields = compact_fields
+        self.top_n = top_n
+        self.max_tokens = max_tokens
+        # search results fetched ahead of time for a DataFrame run, query -> (result, latency)
+        self._prefetched = {}
 
     def get_params(self):
         """
@@ -52,12 +175,43 @@ class SERPEnrichmentStep(Step):
         return {
             **super().get_params(),
             "prompt": self.prompt.__name__,
-            "postprocess": self.postprocess.__name__ if self.postprocess is not None else None
+            "postprocess": self.postprocess.__name__ if self.postprocess is not None else None,
+            "endpoint": self.endpoint,
+            "compact": self.compact,
+            "top_n": self.top_n,
+            "max_tokens": self.max_tokens
+        }
+
+    def _get_cache(self):
+        if self.cache_ttl is None:
+            return None
+        return DiskCache("serp", ttl=self.cache_ttl)
+
+    def _post(self, payload):
+        headers = {
+            'X-API-KEY': os.environ.get("SERPAPI_API_KEY"),
+            'Content-Type': 'application/json'
         }
+        session = get_requests_session("serper")
+        connect_timeout, read_timeout = get_transport_config(
+            "serper").requests_timeout()
+        import requests
+        try:
+            # the step's timeout and deadline, if any, tighten the read timeout
+            timeout = (connect_timeout, call_timeout(read_timeout))
+            with adaptive_limit("serper") as slot, track_request():
+                response = session.request(
+                    "POST", self.endpoint, headers=headers, data=json.dumps(payload), timeout=timeout)
+                if response.status_code == 429 or response.status_code >= 500:
+                    slot.overloaded()
+                return response
+        except (TimeoutError, requests.exceptions.Timeout) as e:
+            # a timed out search fails the row instead of the run
+            raise ShouldNotInterrupt(str(e)) from e
 
     def _get_search_results(self, q):
         """
-        Fetches search results for a given query string.
+        Fetches search results for a given query string, reading from and writing to the cache if enabled.
 
         Args:
             q (str): The search query string.
@@ -65,21 +219,103 @@ class SERPEnrichmentStep(Step):
         Returns:
             str: The search results.
         """
-        url = "https://google.serper.dev/search"
-        payload = json.dumps({"q": q})
-        headers = {
-            'X-API-KEY': os.environ.get("SERPAPI_API_KEY"),
-            'Content-Type': 'application/json'
-        }
-        response = requests.request("POST", url, headers=headers, data=payload)
+        cache = self._get_cache()
+        cache_key = f"{self.endpoint}\n{q}"
+        if cache is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return cached
+        response = self._post({"q": q})
+        if cache is not None and response.ok:
+            cache.set(cache_key, response.text)
         return response.text
 
+    def _get_search_results_batch(self, qs: List[str]) -> List[str]:
+        """
+        Fetches search results for several query strings in a single request, reading from and writing to
+        the cache if enabled.
+
+        Args:
+            qs (List[str]): The search query strings.
+
+        Returns:
+            List[str]: The search results, in the same order as the queries.
+        """
+        cache = self._get_cache()
+        results = {}
+        if cache is not None:
+            for q in qs:
+                cached = cache.get(f"{self.endpoint}\n{q}")
+                if cached is not None:
+                    results[q] = cached
+        missing = [q for q in qs if q not in results]
+        if len(missing) == 1:
+            results[missing[0]] = self._get_search_results(missing[0])
+        elif len(missing) > 1:
+            response = self._post([{"q": q} for q in missing])
+            response.raise_for_status()
+            for q, result in zip(missing, response.json()):
+                results[q] = json.dumps(result)
+                if cache is not None:
+                    cache.set(f"{self.endpoint}\n{q}", results[q])
+        return [results[q] for q in qs]
+
+    def _prefetch(self, queries: List[str]):
+        """
+        Fetches search results for all unique queries concurrently, in batches of batch_size.
+        The latency of each request is split evenly between the queries in its batch. Queries of batches
+        that fail aren't prefetched, so their rows fetch them on their own.
+        """
+        unique = list(dict.fromkeys(queries))
+        batch_size = max(1, self.batch_size)
+        batches = [unique[i:i+batch_size]
+                   for i in range(0, len(unique), batch_size)]
+
+        import requests
+
+        def fetch(batch):
+            start_time = time.time()
+            try:
+                with call_limits(self.timeout):
+                    results = self._get_search_results_batch(batch)
+            except ShouldNotInterrupt:
+                # the rows fetch their results again, and fail if that times out too
+                return {}
+            except requests.exceptions.RequestException as e:
+                # e.g. a throttled batch; its rows fetch their results again, one request each
+                print(
+                    f"Warning: step {self.name} failed to prefetch {len(batch)} search results: {e}")
+                return {}
+            latency = (time.time() - start_time) / len(batch)
+            return {q: (r, latency) for q, r in zip(batch, results)}
+
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, fetch, batch)
+                       for batch in batches]
+            for future in futures:
+                self._prefetched.update(future.result())
+
+    def run(self, data: Union[pd.DataFrame, Dict, pd.Series], verbose=True):
+        """
+        Applies the step to a DataFrame or dictionary. When running on a DataFrame with concurrency or
+        batch_size greater than 1, search results for all rows the step doesn't skip are fetched up front.
+        """
+        if not is_dataframe(data) or (self.concurrency <= 1 and self.batch_size <= 1):
+            return super().run(data, verbose)
+        # rows the step will skip mustn't cost a search, and may be missing the fields the prompt reads
+        self._prefetch([self.prompt(row) for _, row in data.iterrows()
+                        if self._skipped_result(row) is None])
+        try:
+            return super().run(data, verbose)
+        finally:
+            self._prefetched = {}
+
     def _run(self, row: Union[pd.Series, Dict]) -> StepResult:
         """
         Applies the SERP enrichment step to a single row of data.
 
         This method generates a search query using the prompt function, fetches the search results,
-        optionally applies a post-processing function, and returns the results in a dictionary.
+        optionally compacts them and applies a post-processing function, and returns the results in a dictionary.
 
         Args:
             row (Union[pd.Series, Dict]): A single row of data, either as a pandas Series or a dictionary.
@@ -89,6 +325,20 @@ class SERPEnrichmentStep(Step):
         """
         search_prompt = self.prompt(row)
         postprocess = self.postprocess if self.postprocess is not None else lambda x: x
-        def fn(x): return postprocess(self._get_search_results(x))
-        result, statistics = with_statistics(fn)(search_prompt)
+        if self.compact:
+            user_postprocess = postprocess
+
+            def postprocess(x):
+                return user_postprocess(compact_search_results(
+                    x, self.compact_fields, self.top_n, self.max_tokens))
+        prefetched = self._prefetched.get(search_prompt)
+        if prefetched is not None:
+            search_results, latency = prefetched
+            # only the first row with a given query is charged for fetching it
+            self._prefetched[search_prompt] = (search_results, 0.0)
+            result, statistics = with_statistics(postprocess)(search_results)
+            statistics.latency += latency
+        else:
+            def fn(x): return postprocess(self._get_search_results(x))
+            result, statistics = with_statistics(fn)(search_prompt)
         return StepResult(fields={self.name: result}, statistics=statistics, input=search_prompt)
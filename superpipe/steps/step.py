@@ -1,16 +1,33 @@
+from __future__ import annotations
 import hashlib
 import pickle
-from typing import Union, Dict, Optional
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, Callable, Union, Dict, List, Optional, Tuple
 from pydantic import BaseModel
-import pandas as pd
 from superpipe.config import is_dev
+from superpipe.hedge import hedging
+from superpipe.metrics import record_step_row
+from superpipe.timeouts import call_limits, row_time_left
+from superpipe.util import is_dataframe, is_series
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# field set on a row when a step with on_failure="skip_downstream" fails, holding the step's name
+SKIP_FIELD = "__skip__"
+FAILURE_POLICIES = ("mark_failed", "skip_downstream", "default")
 
 
 class StepStatistics(BaseModel):
     input_tokens: int = 0
     output_tokens: int = 0
+    # input tokens read from the providers' prompt caches
+    cached_input_tokens: int = 0
+    input_tokens_by_model: Dict[str, int] = {}
+    output_tokens_by_model: Dict[str, int] = {}
     num_success: int = 0
     num_failure: int = 0
+    num_skipped: int = 0
     total_latency: float = 0.0
     input_cost: float = 0.0
     output_cost: float = 0.0
@@ -19,10 +36,23 @@ class StepStatistics(BaseModel):
 class StepRowStatistics(BaseModel):
     input_tokens: int = 0
     output_tokens: int = 0
+    cached_input_tokens: int = 0
+    input_tokens_by_model: Optional[Dict[str, int]] = None
+    output_tokens_by_model: Optional[Dict[str, int]] = None
+    cost_by_model: Optional[Dict[str, float]] = None
     success: bool = True
     latency: float = 0.0
     input_cost: float = 0.0
     output_cost: float = 0.0
+    # the model(s) that served the row's LLM calls
+    served_by: Optional[str] = None
+    # whether a LLMStructuredCompositeStep used its first response without a structuring call
+    fast_path: Optional[bool] = None
+    # for streamed calls: seconds until the first token, output tokens per second after it, and why
+    # the stream was stopped early, if it was
+    time_to_first_token: Optional[float] = None
+    tokens_per_second: Optional[float] = None
+    stopped_early: Optional[str] = None
 
 
 class StepResult(BaseModel):
@@ -30,6 +60,10 @@ class StepResult(BaseModel):
     statistics: StepRowStatistics
     error: Optional[str] = None
     input: Optional[str] = None
+    # why the step didn't run on the row, if it was skipped
+    skipped: Optional[str] = None
+    # whether the step failed and its default output was used instead
+    fallback: bool = False
 
 
 class Step():
@@ -41,6 +75,25 @@ class Step():
 
     Attributes:
         name (str): The name of the step. Defaults to the class name if not provided.
+        budget (Budget, optional): Limits on what the LLM calls made by this step can spend.
+        failed_rows (List): Index labels of the rows that failed the last time the step ran on a DataFrame.
+        executor (ProcessExecutor, optional): Runs the step on DataFrames in a pool of worker processes,
+            for CPU-bound steps. See `superpipe.executor`.
+        inputs (List[str], optional): The fields the step reads. Lets a pipeline run the step concurrently
+            with steps it doesn't depend on. None means the step may read anything produced before it.
+        when (Callable[[Union[Dict, pd.Series]], bool], optional): The step only runs on rows for which this
+            returns True, other rows are skipped.
+        on_failure (str): What happens when the step fails on a row. "mark_failed" (the default) records the
+            failure and keeps going, "skip_downstream" also skips the following steps on the row, and "default"
+            uses `default_output` as the step's output.
+        default_output (Union[Dict, Callable[[Union[Dict, pd.Series]], Dict]], optional): The fields used when
+            the step fails and on_failure is "default", or a function of the row returning them. Defaults to
+            None for each output field.
+        timeout (float, optional): Maximum seconds for each LLM or search call the step makes.
+        deadline (float, optional): Maximum seconds the step may spend on a row. Calls get at most the time
+            left as their timeout, and calls that would start after the deadline fail.
+        hedge (HedgePolicy, optional): Sends duplicate requests for the step's slowest LLM calls.
+            See `superpipe.hedge`.
 
     Methods:
         update_params(params): Updates the step's parameters with values from a dictionary.
@@ -56,13 +109,47 @@ class Step():
             name (str, optional): The name of the step. Defaults to the class name if None.
         """
         self.name = name or self.__class__.__name__
+        self.budget = None
+        self.failed_rows = []
+        self.executor = None
+        self.inputs = None
+        self.when = None
+        self.on_failure = "mark_failed"
+        self.default_output = None
+        self.skipped_rows = []
+        self.timeout = None
+        self.deadline = None
+        self.hedge = None
         self.reset_statistics()
 
+    @property
+    def on_failure(self) -> str:
+        return self._on_failure
+
+    @on_failure.setter
+    def on_failure(self, value: str):
+        # checked when it's set, not when the first row fails, possibly deep into a run
+        if value not in FAILURE_POLICIES:
+            raise ValueError(
+                f"Step {self.name}: on_failure must be one of {', '.join(FAILURE_POLICIES)}")
+        self._on_failure = value
+
     def reset_statistics(self):
         """
         Resets the statistics for the step.
         """
         self.statistics = StepStatistics()
+        if self.hedge is not None:
+            self.hedge.reset()
+
+    def input_fields(self) -> Optional[List[str]]:
+        """
+        Returns the fields that the step reads, or None if they weren't declared.
+
+        Returns:
+            Optional[List[str]]: A list of field names.
+        """
+        return self.inputs
 
     def output_fields(self):
         """
@@ -84,6 +171,21 @@ class Step():
         """
         self.statistics.input_tokens += statistics.input_tokens
         self.statistics.output_tokens += statistics.output_tokens
+        self.statistics.cached_input_tokens += statistics.cached_input_tokens
+        input_by_model = statistics.input_tokens_by_model or {}
+        output_by_model = statistics.output_tokens_by_model or {}
+        if not input_by_model and not output_by_model and \
+                (statistics.input_tokens or statistics.output_tokens):
+            # tokens that weren't attributed to a model are attributed to the step's model
+            model = getattr(self, "model", None) or self.name
+            input_by_model = {model: statistics.input_tokens}
+            output_by_model = {model: statistics.output_tokens}
+        for model, tokens in input_by_model.items():
+            self.statistics.input_tokens_by_model[model] = \
+                self.statistics.input_tokens_by_model.get(model, 0) + tokens
+        for model, tokens in output_by_model.items():
+            self.statistics.output_tokens_by_model[model] = \
+                self.statistics.output_tokens_by_model.get(model, 0) + tokens
         self.statistics.total_latency += statistics.latency
         if statistics.success:
             self.statistics.num_success += 1
@@ -91,6 +193,7 @@ class Step():
             self.statistics.num_failure += 1
         self.statistics.input_cost += statistics.input_cost
         self.statistics.output_cost += statistics.output_cost
+        record_step_row(self, statistics)
 
     def fingerprint(self, deep=False):
         fingerprint_obj = {
@@ -139,6 +242,20 @@ class Step():
         """
         raise NotImplementedError
 
+    def _estimate_calls(self, row: Dict, placeholder: Callable[..., str]) -> List[Tuple[str, str, Optional[int]]]:
+        """
+        Returns the LLM calls the step would make for a row, without making them. Used by `Pipeline.estimate`.
+
+        Args:
+            row (Dict): The data row, with placeholders for the outputs of upstream steps.
+            placeholder (Callable[..., str]): Returns placeholder text of the projected output length for
+                a model, for prompts that depend on the output of an earlier call.
+
+        Returns:
+            List[Tuple[str, str, Optional[int]]]: (model, full prompt text, max_tokens) for each call.
+        """
+        return []
+
     def run(self, data: Union[pd.DataFrame, Dict, pd.Series], verbose=True):
         """
         Applies the step's transformation to a DataFrame or dictionary.
@@ -155,33 +272,142 @@ class Step():
         Returns:
             Union[pd.DataFrame, Dict]: The transformed data.
         """
-        def get_metadata(result: StepResult):
-            return {
-                **result.statistics.model_dump(),
-                "error": result.error,
-                "prompt": result.input
-            }
-        if isinstance(data, pd.DataFrame):
-            if verbose and is_dev:
-                from tqdm import tqdm
-                tqdm.pandas(desc=f"Applying step {self.name}")
-                results = data.progress_apply(self._run, axis=1)
+        with self.budget.track() if self.budget is not None else nullcontext():
+            if is_dataframe(data):
+                import pandas as pd
+                if self.executor is not None:
+                    results = self.executor.run(self, data, verbose)
+                else:
+                    results = self._run_rows(data, verbose)
+                fields, metadata, self.failed_rows, self.skipped_rows = [], [], [], []
+                for index, result in zip(data.index, results):
+                    fields.append(result.fields)
+                    metadata.append(self._get_metadata(result))
+                    if result.skipped is not None:
+                        self.skipped_rows.append(index)
+                    elif not result.statistics.success and not result.fallback:
+                        self.failed_rows.append(index)
+                new_fields = pd.DataFrame(fields, index=data.index)
+                metadata = pd.Series(metadata, index=data.index)
+                data[new_fields.columns] = new_fields
+                data[f"__{self.name}__"] = metadata
             else:
-                results = data.apply(self._run, axis=1)
-            for r in results:
-                self._update_statistics(r.statistics)
-            new_fields = pd.DataFrame([r.fields for r in results])
-            metadata = pd.DataFrame([get_metadata(r) for r in results])
-            data[new_fields.columns] = new_fields
-            data[f"__{self.name}__"] = metadata
+                result = self._run_row(data)
+                if is_series(data):
+                    for key, value in result.fields.items():
+                        data.loc[key] = value
+                    data.loc[f"__{self.name}__"] = self._get_metadata(result)
+                else:
+                    data.update(result.fields)
+                    data[f"__{self.name}__"] = self._get_metadata(result)
+        return data
+
+    def _run_rows(self, data: pd.DataFrame, verbose=True) -> List[StepResult]:
+        """
+        Applies the step to every row of a DataFrame in this process, updating the statistics as rows finish.
+        """
+        if verbose and is_dev:
+            from tqdm import tqdm
+            tqdm.pandas(desc=f"Applying step {self.name}")
+            return list(data.progress_apply(self._run_row, axis=1))
+        return list(data.apply(self._run_row, axis=1))
+
+    def _run_chunk(self, chunk: pd.DataFrame) -> List[StepResult]:
+        """
+        Applies the step to a chunk of rows without updating the statistics. Used by executors
+        to run the step in worker processes.
+        """
+        return [self._run_with_policies(row) for _, row in chunk.iterrows()]
+
+    def _init_worker(self):
+        """
+        Called once in each worker process before the step runs there. Override to set up
+        per-worker state, e.g. state that can't be pickled and is dropped in `__getstate__`.
+        """
+        pass
+
+    def _run_row(self, row: Union[pd.Series, Dict]) -> StepResult:
+        """
+        Applies the step to a single row and updates the step's statistics.
+        """
+        result = self._run_with_policies(row)
+        self._record_result(result)
+        return result
+
+    def _run_with_policies(self, row: Union[pd.Series, Dict]) -> StepResult:
+        """
+        Applies the step to a single row, unless the row should be skipped, and applies the failure policy.
+        """
+        skipped = self._skipped_result(row)
+        if skipped is not None:
+            return skipped
+        return self._apply_failure_policy(row, self._run_limited(row))
+
+    def _run_limited(self, row: Union[pd.Series, Dict]) -> StepResult:
+        """
+        Applies the step to a single row under its timeout, deadline and hedge policy and the row deadline.
+        """
+        deadline = self.deadline
+        time_left = row_time_left(row)
+        if time_left is not None:
+            if time_left <= 0:
+                return StepResult(fields={}, statistics=StepRowStatistics(success=False),
+                                  error="Row deadline exceeded")
+            deadline = time_left if deadline is None else min(deadline, time_left)
+        if deadline is None and self.timeout is None and self.hedge is None:
+            return self._run(row)
+        with call_limits(self.timeout, deadline), hedging(self.hedge):
+            return self._run(row)
+
+    def _skipped_result(self, row: Union[pd.Series, Dict]) -> Optional[StepResult]:
+        """
+        Returns the result of skipping the row, or None if the step should run on it.
+        """
+        upstream = row.get(SKIP_FIELD)
+        if isinstance(upstream, str):
+            # carry the marker forward, so it survives step-wise runs replacing the column
+            return StepResult(fields={SKIP_FIELD: upstream}, statistics=StepRowStatistics(),
+                              skipped=f"step {upstream} failed")
+        if self.when is not None and not self.when(row):
+            return StepResult(fields={}, statistics=StepRowStatistics(), skipped="when condition not met")
+        return None
+
+    def _apply_failure_policy(self, row: Union[pd.Series, Dict], result: StepResult) -> StepResult:
+        """
+        Applies the step's on_failure policy to the result of a row.
+        """
+        if result.statistics.success or self.on_failure == "mark_failed":
+            return result
+        if self.on_failure == "skip_downstream":
+            result.fields = {**result.fields, SKIP_FIELD: self.name}
+        elif self.on_failure == "default":
+            default = self.default_output(row) if callable(
+                self.default_output) else self.default_output
+            if default is None:
+                default = {field: None for field in self.output_fields()}
+            result.fields = {**result.fields, **default}
+            result.fallback = True
+        return result
+
+    def _record_result(self, result: StepResult):
+        """
+        Updates the step's statistics with the result of a row. Skipped rows are only counted.
+        """
+        if result.skipped is not None:
+            self.statistics.num_skipped += 1
+            record_step_row(self, result.statistics)
         else:
-            result = self._run(data)
             self._update_statistics(result.statistics)
-            if isinstance(data, pd.Series):
-                for key, value in result.fields.items():
-                    data.loc[key] = value
-                data.loc[f"__{self.name}__"] = get_metadata(result)
-            else:
-                data.update(result.fields)
-                data[f"__{self.name}__"] = get_metadata(result)
-        return data
+
+    def _get_metadata(self, result: StepResult) -> Dict:
+        metadata = {
+            **result.statistics.model_dump(exclude={"input_tokens_by_model", "output_tokens_by_model"},
+                                           exclude_none=True),
+            "error": result.error,
+            "prompt": result.input
+        }
+        if result.skipped is not None:
+            metadata["skipped"] = result.skipped
+        if result.fallback:
+            metadata["fallback"] = True
+        return metadata
@@ -1,7 +1,8 @@
 import time
 from functools import wraps
 from superpipe.steps.step import StepRowStatistics
-from typing import List
+from superpipe.llm import collect_llm_calls
+from typing import Dict, List
 
 
 class ShouldNotInterrupt(Exception):
@@ -14,6 +15,7 @@ class ShouldNotInterrupt(Exception):
 def with_statistics(fn):
     """
     Decorator for adding statistics to a step's transformation function.
+    LLM calls made by the function are counted in the statistics' tokens and cost.
 
     Args:
         fn (Callable): The transformation function to decorate.
@@ -26,9 +28,11 @@ def with_statistics(fn):
         """
         Applies the transformation function to a single row of data and updates the step's statistics.
         """
+        calls = []
         try:
             start_time = time.time()
-            result = fn(*args, **kwargs)
+            with collect_llm_calls() as calls:
+                result = fn(*args, **kwargs)
             success = True
         except ShouldNotInterrupt:
             result = None
@@ -39,12 +43,57 @@ def with_statistics(fn):
         finally:
             end_time = time.time()
             latency = end_time - start_time
-            statistics = StepRowStatistics(latency=latency, success=success)
+            if calls:
+                statistics = combine_step_row_statistics(
+                    [llm_row_statistics(response, model) for model, response in calls])
+                statistics.latency = latency
+                statistics.success = success
+            else:
+                statistics = StepRowStatistics(latency=latency, success=success)
         return result, statistics
 
     return wrapper
 
 
+def llm_row_statistics(response, model: str) -> StepRowStatistics:
+    """
+    Creates a StepRowStatistics object for a single LLM call.
+
+    Args:
+        response (LLMResponse): The response from the LLM.
+        model (str): The model the call was made to. The model that served the response, if recorded,
+            takes precedence.
+
+    Returns:
+        StepRowStatistics: The statistics of the call.
+    """
+    model = getattr(response, "model", None) or model
+    return StepRowStatistics(
+        input_tokens=response.input_tokens,
+        output_tokens=response.output_tokens,
+        cached_input_tokens=getattr(response, "cached_input_tokens", 0),
+        input_tokens_by_model={model: response.input_tokens},
+        output_tokens_by_model={model: response.output_tokens},
+        cost_by_model={model: response.input_cost + response.output_cost},
+        latency=response.latency,
+        success=response.success,
+        input_cost=response.input_cost,
+        output_cost=response.output_cost,
+        served_by=getattr(response, "model", None),
+        time_to_first_token=getattr(response, "time_to_first_token", None),
+        tokens_per_second=getattr(response, "tokens_per_second", None),
+        stopped_early=getattr(response, "stopped_early", None)
+    )
+
+
+def _merge_by_model(dicts: List[Dict[str, float]]) -> Dict[str, float]:
+    merged = {}
+    for d in dicts:
+        for model, tokens in (d or {}).items():
+            merged[model] = merged.get(model, 0) + tokens
+    return merged
+
+
 def combine_step_row_statistics(statistics_list: List[StepRowStatistics]) -> StepRowStatistics:
     """
     Combines a list of StepRowStatistics into a single StepRowStatistics object.
@@ -57,15 +106,36 @@ def combine_step_row_statistics(statistics_list: List[StepRowStatistics]) -> Ste
     """
     input_tokens = sum(stat.input_tokens for stat in statistics_list)
     output_tokens = sum(stat.output_tokens for stat in statistics_list)
+    cached_input_tokens = sum(stat.cached_input_tokens for stat in statistics_list)
     success = all(stat.success for stat in statistics_list)
     latency = sum(stat.latency for stat in statistics_list)
     input_cost = sum(stat.input_cost for stat in statistics_list)
     output_cost = sum(stat.output_cost for stat in statistics_list)
+    served_by = list(dict.fromkeys(
+        stat.served_by for stat in statistics_list if stat.served_by))
+    streamed = [stat for stat in statistics_list if stat.time_to_first_token is not None]
+    # tokens per second over the time spent generating, across the streamed calls
+    timed = [stat for stat in streamed if stat.tokens_per_second]
+    generation_time = sum(stat.output_tokens / stat.tokens_per_second for stat in timed)
+    tokens_per_second = sum(stat.output_tokens for stat in timed) / \
+        generation_time if generation_time else None
+    stopped_early = [stat.stopped_early for stat in statistics_list if stat.stopped_early]
     return StepRowStatistics(
         input_tokens=input_tokens,
         output_tokens=output_tokens,
+        cached_input_tokens=cached_input_tokens,
+        input_tokens_by_model=_merge_by_model(
+            [stat.input_tokens_by_model for stat in statistics_list]),
+        output_tokens_by_model=_merge_by_model(
+            [stat.output_tokens_by_model for stat in statistics_list]),
+        cost_by_model=_merge_by_model(
+            [stat.cost_by_model for stat in statistics_list]),
         success=success,
         latency=latency,
         input_cost=input_cost,
-        output_cost=output_cost
+        output_cost=output_cost,
+        served_by=", ".join(served_by) if served_by else None,
+        time_to_first_token=streamed[0].time_to_first_token if streamed else None,
+        tokens_per_second=tokens_per_second,
+        stopped_early=stopped_early[-1] if stopped_early else None
     )
@@ -0,0 +1,110 @@
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+# (per-call timeout in seconds, absolute deadline on the time.monotonic() clock) for calls made in
+# the current context
+_call_limits: ContextVar[tuple] = ContextVar("call_limits", default=(None, None))
+# the time the steps of a pipeline may spend on each row, set by `Pipeline.run(row_deadline=...)`
+_row_deadline: ContextVar[Optional[float]] = ContextVar(
+    "row_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised before a call that would start after its step's or row's deadline. The call is not made.
+    """
+    pass
+
+
+@contextmanager
+def call_limits(timeout: Optional[float] = None, deadline: Optional[float] = None):
+    """
+    Limits the LLM and search calls made inside the block. Nested blocks can only tighten the limits.
+
+    Args:
+        timeout (float, optional): Maximum seconds for a single call.
+        deadline (float, optional): Seconds from now by which every call made inside the block must finish.
+            Calls get a timeout of at most the time left, and calls that would start after it raise
+            DeadlineExceeded.
+    """
+    current_timeout, current_deadline = _call_limits.get()
+    if timeout is not None and current_timeout is not None:
+        timeout = min(timeout, current_timeout)
+    elif timeout is None:
+        timeout = current_timeout
+    if deadline is not None:
+        deadline = time.monotonic() + deadline
+        if current_deadline is not None:
+            deadline = min(deadline, current_deadline)
+    else:
+        deadline = current_deadline
+    token = _call_limits.set((timeout, deadline))
+    try:
+        yield
+    finally:
+        _call_limits.reset(token)
+
+
+def call_timeout(timeout: Optional[float] = None) -> Optional[float]:
+    """
+    Returns the timeout for a call starting now: the smallest of `timeout`, the per-call timeout and the
+    time left before the deadline. None if there is no limit.
+
+    Raises:
+        DeadlineExceeded: If the deadline has passed.
+    """
+    scope_timeout, deadline = _call_limits.get()
+    limits = [t for t in (timeout, scope_timeout) if t is not None]
+    if deadline is not None:
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise DeadlineExceeded("Deadline exceeded before the call started")
+        limits.append(left)
+    return min(limits) if limits else None
+
+
+def has_deadline() -> bool:
+    return _call_limits.get()[1] is not None
+
+
+def with_timeout(args: Dict) -> Dict:
+    """
+    Returns the SDK arguments for a call with the current timeout added, keeping a smaller `timeout`
+    already in args.
+    """
+    timeout = call_timeout(args.get("timeout"))
+    return args if timeout is None else {**args, "timeout": timeout}
+
+
+def row_deadline(seconds: Optional[float]):
+    """
+    Limits the time the steps of a pipeline may spend on each row, summed over the steps. Used by
+    `Pipeline.run`.
+    """
+    if seconds is None:
+        return nullcontext()
+    return _row_deadline_scope(seconds)
+
+
+@contextmanager
+def _row_deadline_scope(seconds: float):
+    token = _row_deadline.set(seconds)
+    try:
+        yield
+    finally:
+        _row_deadline.reset(token)
+
+
+def row_time_left(row) -> Optional[float]:
+    """
+    Returns the seconds left before the row deadline, from the latency the steps that already ran
+    recorded in the row's metadata. None if there's no row deadline.
+    """
+    seconds = _row_deadline.get()
+    if seconds is None:
+        return None
+    spent = sum(metadata.get("latency") or 0 for key, metadata in row.items()
+                if isinstance(key, str) and key.startswith("__") and isinstance(metadata, dict))
+    return seconds - spent
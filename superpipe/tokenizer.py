@@ -0,0 +1,39 @@
+from functools import lru_cache
+from typing import Optional
+
+# rough number of characters per token for English text, used when tiktoken isn't installed
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: Optional[str]):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except (KeyError, TypeError):
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """
+    Estimates the number of tokens in a string locally, without calling a provider.
+
+    Uses tiktoken if it's installed (the model's encoding for OpenAI models, cl100k_base otherwise),
+    and falls back to a characters-per-token heuristic. Counts for non-OpenAI models are estimates.
+
+    Args:
+        text (str): The text to count tokens for.
+        model (str, optional): The model the text will be sent to.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,154 @@
+import threading
+from dataclasses import dataclass, replace
+from typing import Dict, Optional
+
+
+@dataclass
+class TransportConfig:
+    """
+    Connection settings for the HTTP clients used to talk to a provider.
+
+    Attributes:
+        max_connections (int): Maximum number of concurrent connections in the pool.
+        max_keepalive_connections (int): Maximum number of idle connections kept open for reuse.
+        keepalive_expiry (float): Seconds an idle connection is kept open.
+        http2 (bool): Whether to use HTTP/2. Requires the `h2` package (`pip install httpx[http2]`).
+        timeout (float): Read/write timeout in seconds for a single request.
+        connect_timeout (float): Timeout in seconds for establishing a connection.
+        proxy (str, optional): URL of a proxy to route requests through.
+        cassette (str, optional): Path of a cassette file to record responses to and replay them from.
+        cassette_mode (str): "record", "replay" or "auto". See `superpipe.cassette.CassetteTransport`.
+    """
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 5.0
+    http2: bool = False
+    timeout: float = 600.0
+    connect_timeout: float = 5.0
+    proxy: Optional[str] = None
+    cassette: Optional[str] = None
+    cassette_mode: str = "auto"
+
+    def httpx_timeout(self):
+        import httpx
+        return httpx.Timeout(self.timeout, connect=self.connect_timeout)
+
+    def requests_timeout(self):
+        return (self.connect_timeout, self.timeout)
+
+
+DEFAULT = "default"
+
+# transport config per provider, providers without an entry use the default config
+transport_configs: Dict[str, TransportConfig] = {DEFAULT: TransportConfig()}
+
+_http_clients = {}
+_requests_sessions = {}
+# the cassette transports of the pooled clients, by provider
+_cassettes = {}
+_lock = threading.Lock()
+
+
+def get_transport_config(provider: str = DEFAULT) -> TransportConfig:
+    return transport_configs.get(provider) or transport_configs[DEFAULT]
+
+
+def set_transport_config(provider: str = DEFAULT, **kwargs):
+    """
+    Updates the transport config for a provider, starting from its current config.
+    Pooled clients built after this call use the new settings. SDK clients that were already
+    initialized keep their existing pool, so set transport configs before the first LLM call.
+
+    Args:
+        provider (str): The provider name, e.g. "openai", "anthropic", "openrouter", "serper" or "default".
+        **kwargs: Fields of TransportConfig to update.
+    """
+    with _lock:
+        transport_configs[provider] = replace(
+            get_transport_config(provider), **kwargs)
+        providers = list(_http_clients.keys()) + \
+            list(_requests_sessions.keys())
+        # changing the default config affects every provider without its own config
+        stale = [p for p in set(providers)
+                 if p == provider or (provider == DEFAULT and p not in transport_configs)]
+        for p in stale:
+            _http_clients.pop(p, None)
+            _requests_sessions.pop(p, None)
+            # the stale client may still be in use, but its recordings should be on disk for the new one
+            cassette = _cassettes.pop(p, None)
+            if cassette is not None:
+                cassette.flush()
+
+
+def get_http_client(provider: str = DEFAULT):
+    """
+    Returns the shared, pooled httpx client for a provider, creating it on first use.
+    Pass it as `http_client` to the OpenAI and Anthropic SDK clients.
+
+    Args:
+        provider (str): The provider name.
+
+    Returns:
+        httpx.Client: The pooled client.
+    """
+    client = _http_clients.get(provider)
+    if client is not None:
+        return client
+    import httpx
+    with _lock:
+        if provider not in _http_clients:
+            config = get_transport_config(provider)
+            limits = httpx.Limits(
+                max_connections=config.max_connections,
+                max_keepalive_connections=config.max_keepalive_connections,
+                keepalive_expiry=config.keepalive_expiry)
+            from superpipe.concurrency import AdaptiveTransport, limiters
+            kwargs = {"proxy": config.proxy} if config.proxy else {}
+            transport = httpx.HTTPTransport(
+                limits=limits, http2=config.http2, **kwargs)
+            if provider in limiters:
+                # requests go through the provider's adaptive concurrency limiter
+                transport = AdaptiveTransport(provider, transport)
+            if config.cassette:
+                from superpipe.cassette import CassetteTransport
+                transport = CassetteTransport(
+                    config.cassette, config.cassette_mode, transport)
+                _cassettes[provider] = transport
+            _http_clients[provider] = httpx.Client(
+                limits=limits,
+                timeout=config.httpx_timeout(),
+                http2=config.http2,
+                follow_redirects=True,
+                transport=transport)
+        return _http_clients[provider]
+
+
+def get_requests_session(provider: str = DEFAULT):
+    """
+    Returns the shared, pooled requests session for a provider, creating it on first use.
+    Used for plain HTTP APIs like serper.dev. requests doesn't support HTTP/2 or a session-wide
+    timeout, so pass `get_transport_config(provider).requests_timeout()` with each request.
+
+    Args:
+        provider (str): The provider name.
+
+    Returns:
+        requests.Session: The pooled session.
+    """
+    session = _requests_sessions.get(provider)
+    if session is not None:
+        return session
+    import requests
+    from requests.adapters import HTTPAdapter
+    with _lock:
+        if provider not in _requests_sessions:
+            config = get_transport_config(provider)
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=config.max_connections)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            if config.proxy:
+                session.proxies = {"http": config.proxy,
+                                   "https": config.proxy}
+            _requests_sessions[provider] = session
+        return _requests_sessions[provider]
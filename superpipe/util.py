@@ -1,8 +1,33 @@
-import pandas as pd
+import sys
 from typing import TypedDict, Type, Dict, get_type_hints
 from pydantic import create_model
 
 
+def is_dataframe(data) -> bool:
+    """
+    Returns True if data is a pandas DataFrame, without importing pandas.
+    If pandas hasn't been imported yet, data can't be a DataFrame.
+    """
+    pd = sys.modules.get("pandas")
+    return pd is not None and isinstance(data, pd.DataFrame)
+
+
+def is_series(data) -> bool:
+    """
+    Returns True if data is a pandas Series, without importing pandas.
+    """
+    pd = sys.modules.get("pandas")
+    return pd is not None and isinstance(data, pd.Series)
+
+
+def is_arrow(data) -> bool:
+    """
+    Returns True if data is a pyarrow Table or RecordBatchReader, without importing pyarrow.
+    """
+    pa = sys.modules.get("pyarrow")
+    return pa is not None and isinstance(data, (pa.Table, pa.RecordBatchReader))
+
+
 def validate_dict(dict: Dict, type: Type[TypedDict]) -> Dict:
     field_definitions = get_type_hints(type)
     pydantic_model = create_model(
@@ -11,6 +36,7 @@ def validate_dict(dict: Dict, type: Type[TypedDict]) -> Dict:
 
 
 def gradient_color(val, min_val, median_val, max_val, reverse=False):
+    import pandas as pd
     if pd.isna(val):
         return 'background-color: white; color: black'  # Handle NaN values
 